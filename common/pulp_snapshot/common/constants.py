@@ -11,5 +11,138 @@ STATE_SKIPPED = 'SKIPPED'
 COMPLETE_STATES = (STATE_COMPLETE, STATE_FAILED, STATE_SKIPPED)
 
 PUBLISH_SNAPSHOT = 'publish_snapshot'
+PUBLISH_GROUP_SNAPSHOT = 'publish_group_snapshot'
 
-PUBLISH_STEPS = (PUBLISH_SNAPSHOT, )
+PUBLISH_STEPS = (PUBLISH_SNAPSHOT, PUBLISH_GROUP_SNAPSHOT)
+
+# -- configuration keys -------------------------------------------------------
+
+# Publishes of the same repository requested within this many seconds of
+# each other are coalesced into one snapshot run, which starts once no
+# publish has been requested for that long; 0 publishes right away. A
+# publish with no other request in the preceding window runs right away
+# too, so only the publishes of a burst are delayed. The run holds a lease
+# on the repository, renewed while it runs, which expires after
+# coalesce_lease_timeout seconds if its worker dies.
+CONFIG_COALESCE_WINDOW = 'coalesce_window'
+DEFAULT_COALESCE_WINDOW = 0
+CONFIG_COALESCE_LEASE_TIMEOUT = 'coalesce_lease_timeout'
+DEFAULT_COALESCE_LEASE_TIMEOUT = 3600
+
+# Number of unit associations requested from the database per cursor batch
+CONFIG_FETCH_BATCH_SIZE = 'fetch_batch_size'
+DEFAULT_FETCH_BATCH_SIZE = 5000
+# With more than one fetch thread, the units of the repository and of its
+# last snapshot are read with one query per unit type, this many running at
+# a time; otherwise each repository is read with a single query
+CONFIG_FETCH_THREADS = 'fetch_threads'
+DEFAULT_FETCH_THREADS = 1
+
+# How the repository is compared with its last snapshot: with sets in the
+# worker, by an aggregation on the database server, or by a merge join of
+# two sorted cursors
+CONFIG_DIFF_ENGINE = 'diff_engine'
+DIFF_ENGINE_PYTHON = 'python'
+DIFF_ENGINE_AGGREGATE = 'aggregate'
+DIFF_ENGINE_MERGE = 'merge'
+DIFF_ENGINES = (DIFF_ENGINE_PYTHON, DIFF_ENGINE_AGGREGATE, DIFF_ENGINE_MERGE)
+DEFAULT_DIFF_ENGINE = DIFF_ENGINE_PYTHON
+
+# Snapshot associations are written with unordered bulk inserts of this many
+# documents, each retried this many times on transient errors
+CONFIG_COPY_BATCH_SIZE = 'copy_batch_size'
+DEFAULT_COPY_BATCH_SIZE = 1000
+CONFIG_COPY_RETRIES = 'copy_retries'
+DEFAULT_COPY_RETRIES = 3
+# Write concern ("w" value) for the snapshot associations, e.g. 1 or
+# "majority"; the database default is used if not set
+CONFIG_COPY_WRITE_CONCERN = 'copy_write_concern'
+# Where the associations of a new snapshot are copied: in the worker, which
+# reads and inserts them, or on the database server, by an aggregation
+# merging them into the collection (MongoDB 4.4 and later). The worker
+# copies them if the server is older or the aggregation fails. The server
+# cannot compute a snapshot's digest: unless the worker read the units
+# while comparing them, a snapshot copied on the server has none until a
+# later publish compares with it.
+CONFIG_COPY_ENGINE = 'copy_engine'
+COPY_ENGINE_CLIENT = 'client'
+COPY_ENGINE_SERVER = 'server'
+COPY_ENGINES = (COPY_ENGINE_CLIENT, COPY_ENGINE_SERVER)
+DEFAULT_COPY_ENGINE = COPY_ENGINE_CLIENT
+
+# With deferred bookkeeping, a publish returns once the associations of a
+# new snapshot are written; adding the snapshot to its repository's groups
+# and setting its unit counts is left to a background task, which handles
+# the snapshots of many publishes at once
+CONFIG_DEFER_BOOKKEEPING = 'defer_bookkeeping'
+DEFAULT_DEFER_BOOKKEEPING = False
+
+# Maximum number of repositories snapshotted concurrently by the group
+# distributor
+CONFIG_GROUP_THREADS = 'group_threads'
+DEFAULT_GROUP_THREADS = 4
+
+# Only the units of the included types, if any are listed, and none of the
+# excluded types are snapshotted; both are lists of unit type ids. The unit
+# criteria further restrict the units by fields of their association, as
+# {field: value} or {field: {operator: value}}.
+CONFIG_INCLUDE_TYPES = 'include_types'
+CONFIG_EXCLUDE_TYPES = 'exclude_types'
+CONFIG_UNIT_CRITERIA = 'unit_criteria'
+UNIT_CRITERIA_FIELDS = ('created', 'unit_id', 'updated')
+UNIT_CRITERIA_OPERATORS = ('$eq', '$gt', '$gte', '$in', '$lt', '$lte', '$ne',
+                           '$nin', '$regex')
+
+# Bytes of memory a worker may use to keep the unit keys of recently
+# created snapshots, so that the next publish of a repository compares it
+# with its last snapshot without reading the snapshot; 0 disables the cache
+# for the repository. The worker's cache is shared by all repositories and
+# takes the largest size any of them configures.
+CONFIG_UNIT_CACHE_SIZE = 'unit_cache_size'
+DEFAULT_UNIT_CACHE_SIZE = 0
+
+# Write a manifest of the unit keys of the repository's current snapshot,
+# for diffing it offline or importing it on another server, to
+# manifest_dir, which is required with write_manifest: the publish working
+# directory is deleted when the publish task ends
+CONFIG_WRITE_MANIFEST = 'write_manifest'
+DEFAULT_WRITE_MANIFEST = False
+CONFIG_MANIFEST_DIR = 'manifest_dir'
+
+# Explain the queries a publish relies on and warn in the publish log about
+# those that scan a whole collection, sort in memory, or do not use the
+# index they rely on, which means an index Pulp or the plugin creates is
+# missing
+CONFIG_CHECK_QUERY_PLANS = 'check_query_plans'
+DEFAULT_CHECK_QUERY_PLANS = False
+
+# Publishing with this key set, usually as an override, restores the
+# repository to one of its snapshots instead of snapshotting it
+CONFIG_RESTORE_SNAPSHOT = 'restore_snapshot'
+
+# Retention policy for a repository's snapshots; a snapshot is kept if any
+# of the configured rules keeps it, and all snapshots are kept if none is
+# configured
+CONFIG_RETAIN_LAST = 'retain_last'
+CONFIG_RETAIN_DAYS = 'retain_days'
+CONFIG_RETAIN_DAILY = 'retain_daily'
+CONFIG_RETAIN_WEEKLY = 'retain_weekly'
+# Expired snapshots are deleted by the bookkeeping task this many at a
+# time, pausing this many seconds between batches
+CONFIG_PRUNE_BATCH_SIZE = 'prune_batch_size'
+DEFAULT_PRUNE_BATCH_SIZE = 10
+CONFIG_PRUNE_DELAY = 'prune_delay'
+DEFAULT_PRUNE_DELAY = 1.0
+
+# How snapshot associations are stored: a full copy of the repository's
+# associations, or only the units added and removed since the previous
+# snapshot, with a full checkpoint every checkpoint_interval snapshots.
+# Delta snapshot repositories have a snapshot distributor: publishing one
+# writes its associations. Deleting a snapshot's base writes them too.
+CONFIG_SNAPSHOT_STORAGE = 'snapshot_storage'
+SNAPSHOT_STORAGE_FULL = 'full'
+SNAPSHOT_STORAGE_DELTA = 'delta'
+SNAPSHOT_STORAGES = (SNAPSHOT_STORAGE_FULL, SNAPSHOT_STORAGE_DELTA)
+DEFAULT_SNAPSHOT_STORAGE = SNAPSHOT_STORAGE_FULL
+CONFIG_CHECKPOINT_INTERVAL = 'checkpoint_interval'
+DEFAULT_CHECKPOINT_INTERVAL = 10
@@ -1,5 +1,6 @@
 # Copyright SAS Institite, Inc.
 
 TYPE_ID_DISTRIBUTOR_SNAPSHOT = "snapshot_distributor"
+TYPE_ID_GROUP_DISTRIBUTOR_SNAPSHOT = "snapshot_group_distributor"
 
 SUPPORTED_TYPES = set()
@@ -0,0 +1,172 @@
+import logging
+
+import celery
+from gettext import gettext as _
+from pulp.server.async.tasks import Task
+from pulp.server.db import connection
+
+# The distributors' entry point modules import this one, so that the task
+# is registered in every worker process. pymongo and the server's models
+# are only imported when they are needed.
+
+_LOG = logging.getLogger(__name__)
+
+# Snapshots whose groups and unit counts are yet to be updated, one
+# document per snapshot
+PENDING_COLLECTION = 'repo_snapshot_bookkeeping'
+# Expired snapshots yet to be deleted, one document per snapshot, with the
+# pruning settings of the publish that expired it
+PRUNE_COLLECTION = 'repo_snapshot_prunes'
+
+# Seconds the task waits after being scheduled, so it picks up the
+# snapshots of a burst of publishes together
+DELAY = 5
+# Number of snapshots updated per bulk write
+BATCH_SIZE = 500
+
+
+def get_collection():
+    """
+    :return: the collection holding the pending updates
+    :rtype:  pymongo.collection.Collection
+    """
+    return connection.get_collection(PENDING_COLLECTION, create=True)
+
+
+def get_prune_collection():
+    """
+    :return: the collection holding the pending deletions
+    :rtype:  pymongo.collection.Collection
+    """
+    return connection.get_collection(PRUNE_COLLECTION, create=True)
+
+
+def group_requests(snapshots):
+    """
+    :param snapshots: (repository id, snapshot id) pairs
+    :type  snapshots: iterable of tuple
+    :return: the bulk write requests adding the snapshots to the groups
+             their repositories belong to
+    :rtype:  list of pymongo.UpdateMany
+    """
+    from pymongo import UpdateMany
+    return [UpdateMany(dict(repo_ids=repo_id),
+                       {'$addToSet': dict(repo_ids=snapshot_id)})
+            for repo_id, snapshot_id in snapshots]
+
+
+def defer(repo_id, snapshot_id, counts=None):
+    """
+    Record that a snapshot is to be added to its repository's groups, and
+    given its unit counts, by the next run of update_snapshots.
+
+    :param repo_id: repository the snapshot was taken of
+    :type  repo_id: str
+    :param counts: the snapshot's number of units of each type, if they are
+                   to be set
+    :type  counts: dict
+    """
+    update = {'repo_id': repo_id}
+    if counts is not None:
+        update['counts'] = dict(counts)
+    get_collection().update_one({'_id': snapshot_id}, {'$set': update},
+                                upsert=True)
+
+
+def defer_prune(snapshot_ids, batch_size, delay, copy_batch_size,
+                copy_retries):
+    """
+    Record that snapshots are to be deleted by the next run of
+    update_snapshots, with the arguments of retention.prune.
+
+    :param snapshot_ids: ids of the snapshots to delete
+    :type  snapshot_ids: list of str
+    """
+    from pymongo import UpdateOne
+    settings = dict(batch_size=batch_size, delay=delay,
+                    copy_batch_size=copy_batch_size,
+                    copy_retries=copy_retries)
+    get_prune_collection().bulk_write(
+        [UpdateOne({'_id': x}, {'$set': settings}, upsert=True)
+         for x in snapshot_ids], ordered=False)
+
+
+def schedule():
+    """
+    Queue a run of update_snapshots.
+    """
+    update_snapshots.apply_async(countdown=DELAY)
+
+
+@celery.task(base=Task)
+def update_snapshots():
+    """
+    Add the deferred snapshots to their groups and set their unit counts, a
+    batch at a time, then delete the expired snapshots. Running it again,
+    or concurrently, does no harm: updates are only forgotten once they
+    have been applied, and applying them twice changes nothing.
+
+    :return: number of snapshots updated
+    :rtype:  int
+    """
+    from pymongo import UpdateOne
+    from pulp.server.db.model.repo_group import RepoGroup
+    pending_coll = get_collection()
+    repos_coll = connection.get_collection('repos')
+    total = 0
+    while True:
+        pending = list(pending_coll.find(limit=BATCH_SIZE))
+        if not pending:
+            break
+        snapshot_ids = [x['_id'] for x in pending]
+        # Snapshots pruned in the meantime are left out
+        existing = set(x['repo_id'] for x in repos_coll.find(
+            {'repo_id': {'$in': snapshot_ids}}, {'repo_id': 1}))
+        pending = [x for x in pending if x['_id'] in existing]
+        requests = group_requests((x['repo_id'], x['_id']) for x in pending)
+        if requests:
+            RepoGroup.get_collection().bulk_write(requests, ordered=False)
+        requests = [UpdateOne({'repo_id': x['_id']},
+                              {'$set': {'content_unit_counts': x['counts']}})
+                    for x in pending if 'counts' in x]
+        if requests:
+            repos_coll.bulk_write(requests, ordered=False)
+        pending_coll.delete_many({'_id': {'$in': snapshot_ids}})
+        _LOG.info(_("Updated groups and unit counts of snapshots "
+                    "%(snaps)s") %
+                  {'snaps': ', '.join(x['_id'] for x in pending)})
+        total += len(pending)
+    prune_snapshots()
+    return total
+
+
+def prune_snapshots():
+    """
+    Delete the snapshots expired by publishes, see retention.prune.
+    Pruning pauses between batches, which the publishes do not wait for.
+
+    :return: number of snapshots deleted
+    :rtype:  int
+    """
+    from . import retention
+    prune_coll = get_prune_collection()
+    pending = list(prune_coll.find())
+    if not pending:
+        return 0
+    # Snapshots deleted by an earlier run are left out
+    existing = set(x['repo_id'] for x in connection.get_collection(
+        'repos').find({'repo_id': {'$in': [x['_id'] for x in pending]}},
+                      {'repo_id': 1}))
+    by_settings = {}
+    for doc in pending:
+        snapshot_id = doc.pop('_id')
+        by_settings.setdefault(tuple(sorted(doc.items())),
+                               []).append(snapshot_id)
+    total = 0
+    for settings, snapshot_ids in sorted(by_settings.items()):
+        expired = sorted(x for x in snapshot_ids if x in existing)
+        if expired:
+            retention.prune(expired, **dict(settings))
+        prune_coll.delete_many({'_id': {'$in': snapshot_ids}})
+        total += len(expired)
+    return total
@@ -0,0 +1,172 @@
+import itertools
+import logging
+import time
+
+from gettext import gettext as _
+from pulp.common import dateutils
+from pymongo.errors import AutoReconnect, BulkWriteError
+
+_LOG = logging.getLogger(__name__)
+
+DUPLICATE_KEY_ERROR = 11000
+# Seconds to wait before retrying a batch, multiplied by the attempt number
+RETRY_DELAY = 0.5
+# Fields of the unique index of unit associations, which $merge matches
+# copied associations on
+MERGE_KEY = ['repo_id', 'unit_id', 'unit_type_id']
+# Servers before this version cannot $merge into the collection being
+# aggregated
+MERGE_COPY_VERSION = (4, 4)
+
+
+def batches(iterable, batch_size):
+    """
+    Split an iterable into lists of at most batch_size items.
+
+    :param iterable: items to split
+    :type  iterable: iterable
+    :param batch_size: maximum number of items per list
+    :type  batch_size: int
+    :return: generator of lists
+    :rtype:  generator
+    """
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def insert(collection, documents, batch_size, retries=0, callback=None):
+    """
+    Insert documents in batches, using unordered bulk writes.
+
+    Only one batch of documents is held at a time, and every batch is sent
+    as its own message, so the wire message size limit is never reached.
+    Transient errors are retried per batch; documents written by an
+    earlier attempt are recognized by their duplicate key errors.
+
+    :param collection: collection to insert into, with the write concern
+                       to use
+    :type  collection: pymongo.collection.Collection
+    :param documents: documents to insert
+    :type  documents: iterable of dict
+    :param batch_size: number of documents per bulk write
+    :type  batch_size: int
+    :param retries: number of times a failing batch is retried
+    :type  retries: int
+    :param callback: called with the number of documents in each batch
+                     once it is written
+    :type  callback: callable
+    :return: number of documents inserted
+    :rtype:  int
+    """
+    total = 0
+    for batch in batches(documents, batch_size):
+        _insert_batch(collection, batch, retries)
+        total += len(batch)
+        if callback is not None:
+            callback(len(batch))
+    return total
+
+
+def _insert_batch(collection, batch, retries):
+    attempt = 0
+    while True:
+        try:
+            collection.insert_many(batch, ordered=False)
+            return
+        except BulkWriteError as e:
+            write_errors = e.details.get('writeErrors', [])
+            if any(x['code'] != DUPLICATE_KEY_ERROR for x in write_errors):
+                raise
+            if not e.details.get('writeConcernErrors'):
+                # Everything was written, some of it by an earlier attempt
+                return
+            error = e
+        except AutoReconnect as e:
+            error = e
+        attempt += 1
+        if attempt > retries:
+            raise error
+        _LOG.warning(_("Bulk insert of %(n)d documents failed (attempt "
+                       "%(a)d of %(t)d), retrying: %(e)s") %
+                     {'n': len(batch), 'a': attempt, 't': retries + 1,
+                      'e': error})
+        time.sleep(RETRY_DELAY * attempt)
+
+
+def merge_copy(collection, query, repo_id):
+    """
+    Copy unit associations to a repository on the database server, with
+    one aggregation that rewrites their repository and timestamps and
+    merges them back into the collection. No association is sent to or
+    from the worker.
+
+    Associations the repository already has are kept as they are, so
+    copying again after an interruption is harmless.
+
+    :param collection: the repo content units collection, with the write
+                       concern to use
+    :type  collection: pymongo.collection.Collection
+    :param query: selects the associations to copy
+    :type  query: dict
+    :param repo_id: repository to copy them to
+    :type  repo_id: str
+    :return: number of associations of each unit type the repository has
+             afterwards
+    :rtype:  dict
+    :raises pymongo.errors.OperationFailure: if the server cannot run the
+            aggregation, as servers older than MongoDB 4.4 cannot; see
+            supports_merge_copy
+    """
+    now = dateutils.format_iso8601_datetime(
+        dateutils.now_utc_datetime_with_tzinfo())
+    pipeline = [
+        {'$match': query},
+        {'$project': {
+            '_id': 0,
+            'repo_id': {'$literal': repo_id},
+            'unit_type_id': 1,
+            'unit_id': 1,
+            'created': {'$literal': now},
+            'updated': {'$literal': now},
+        }},
+        {'$merge': {
+            'into': collection.name,
+            'on': MERGE_KEY,
+            'whenMatched': 'keepExisting',
+            'whenNotMatched': 'insert',
+        }},
+    ]
+    # $merge returns no documents; the cursor only has to be exhausted
+    for _doc in collection.aggregate(pipeline, allowDiskUse=True):
+        pass
+    return count_by_type(collection, repo_id)
+
+
+def supports_merge_copy(collection):
+    """
+    :param collection: the repo content units collection
+    :type  collection: pymongo.collection.Collection
+    :return: whether the database server is recent enough for merge_copy
+    :rtype:  bool
+    """
+    info = collection.database.client.server_info()
+    return tuple(info.get('versionArray', [])[:2]) >= MERGE_COPY_VERSION
+
+
+def count_by_type(collection, repo_id):
+    """
+    Count the unit associations of a repository on the database server.
+
+    :return: number of associations of each unit type
+    :rtype:  dict
+    """
+    pipeline = [
+        {'$match': {'repo_id': repo_id}},
+        {'$group': {'_id': '$unit_type_id', 'count': {'$sum': 1}}},
+    ]
+    return dict((x['_id'], x['count'])
+                for x in collection.aggregate(pipeline))
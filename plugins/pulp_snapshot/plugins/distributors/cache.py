@@ -0,0 +1,129 @@
+import threading
+from collections import OrderedDict
+
+
+class UnitSetCache(object):
+    """
+    Least recently used cache of the unit keys of snapshots, keyed by
+    snapshot id and bounded by the memory the sets take.
+
+    Snapshots are never modified once complete, so an entry only goes
+    stale when its snapshot is deleted. Publishers of different
+    repositories may share the cache from several threads.
+    """
+    def __init__(self, max_bytes):
+        """
+        :param max_bytes: memory the cached sets may take, in bytes
+        :type  max_bytes: int
+        """
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = self.misses = self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, snapshot_id):
+        """
+        :return: the unit keys of a snapshot, or None if they are not cached
+        :rtype:  pulp_snapshot.plugins.distributors.unitkeys.UnitKeySet
+        """
+        with self._lock:
+            units = self._entries.pop(snapshot_id, None)
+            if units is None:
+                self.misses += 1
+                return None
+            self._entries[snapshot_id] = units
+            self.hits += 1
+            return units
+
+    def put(self, snapshot_id, units):
+        """
+        Cache the unit keys of a complete snapshot, evicting the least
+        recently used snapshots as needed. Sets larger than the cache are
+        not cached.
+
+        :type units: pulp_snapshot.plugins.distributors.unitkeys.UnitKeySet
+        """
+        with self._lock:
+            self._remove(snapshot_id)
+            if units.nbytes > self.max_bytes:
+                return
+            self._entries[snapshot_id] = units
+            self.bytes += units.nbytes
+            self._evict()
+
+    def invalidate(self, snapshot_ids):
+        """
+        Forget deleted snapshots.
+
+        :type snapshot_ids: iterable of str
+        """
+        with self._lock:
+            for snapshot_id in snapshot_ids:
+                self._remove(snapshot_id)
+
+    def resize(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def stats(self):
+        """
+        :return: the number of hits, misses and evictions since the cache
+                 was created, and its current and maximum size
+        :rtype:  dict
+        """
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses,
+                        evictions=self.evictions,
+                        entries=len(self._entries), bytes=self.bytes,
+                        max_bytes=self.max_bytes)
+
+    def _remove(self, snapshot_id):
+        units = self._entries.pop(snapshot_id, None)
+        if units is not None:
+            self.bytes -= units.nbytes
+
+    def _evict(self):
+        while self.bytes > self.max_bytes:
+            _snapshot_id, units = self._entries.popitem(last=False)
+            self.bytes -= units.nbytes
+            self.evictions += 1
+
+
+# One cache per worker process, living across publishes
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache(max_bytes):
+    """
+    The cache is shared by the publishes of every repository, so it takes
+    the largest size configured by any of them: a repository configured
+    with a smaller cache does not evict the snapshots of the others.
+
+    :param max_bytes: configured size of the cache; 0 disables it
+    :type  max_bytes: int
+    :return: the worker's cache, grown to max_bytes if it was smaller, or
+             None if disabled
+    :rtype:  UnitSetCache
+    """
+    global _cache
+    if not max_bytes:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = UnitSetCache(max_bytes)
+        elif _cache.max_bytes < max_bytes:
+            _cache.resize(max_bytes)
+        return _cache
+
+
+def invalidate(snapshot_ids):
+    """
+    Forget deleted snapshots, if the cache is in use.
+
+    :type snapshot_ids: iterable of str
+    """
+    if _cache is not None:
+        _cache.invalidate(snapshot_ids)
@@ -0,0 +1,198 @@
+import json
+import time
+from contextlib import contextmanager
+from functools import partial
+
+from pulp.server.db.model import Repository as RepoModel
+from . import heartbeat, retention
+
+# Notes of a snapshot whose associations are still being written: its
+# status, the last unit key known to be written, and the unit filter of the
+# publish writing it
+REPO_SNAPSHOT_STATUS = '_repository_snapshot_status'
+REPO_SNAPSHOT_CHECKPOINT = '_repository_snapshot_checkpoint'
+REPO_SNAPSHOT_FILTER = '_repository_snapshot_filter'
+# The publish writing the snapshot, and the last time it showed it was
+# alive; None once it gave the snapshot up
+REPO_SNAPSHOT_OWNER = '_repository_snapshot_owner'
+REPO_SNAPSHOT_HEARTBEAT = '_repository_snapshot_heartbeat'
+
+STATUS_INCOMPLETE = 'incomplete'
+
+# Seconds between two heartbeats of the publish writing a snapshot, and
+# seconds without one after which its publish is known to have died
+HEARTBEAT_INTERVAL = 30
+OWNER_TIMEOUT = 300
+
+# Heartbeats are compared across workers, they need the wall clock
+clock = time.time
+
+
+def start(notes, unit_filter, owner):
+    """
+    Mark the notes of a new snapshot as incomplete, and owned by the
+    publish creating it.
+
+    :param notes: the snapshot's notes
+    :type  notes: dict
+    :param unit_filter: conditions selecting the units of the snapshot
+    :type  unit_filter: dict
+    :param owner: identifies the publish writing the snapshot
+    :type  owner: str
+    """
+    notes[REPO_SNAPSHOT_STATUS] = STATUS_INCOMPLETE
+    notes[REPO_SNAPSHOT_FILTER] = filter_key(unit_filter)
+    notes[REPO_SNAPSHOT_OWNER] = owner
+    notes[REPO_SNAPSHOT_HEARTBEAT] = clock()
+
+
+def finish(notes):
+    """
+    Clear the checkpoint from the notes of a snapshot that is complete.
+    """
+    for key in (REPO_SNAPSHOT_STATUS, REPO_SNAPSHOT_CHECKPOINT,
+                REPO_SNAPSHOT_FILTER, REPO_SNAPSHOT_OWNER,
+                REPO_SNAPSHOT_HEARTBEAT):
+        notes.pop(key, None)
+
+
+def is_incomplete(notes):
+    """
+    :return: whether the associations of a snapshot are still being
+             written, or were when its publish died
+    :rtype:  bool
+    """
+    return notes.get(REPO_SNAPSHOT_STATUS) == STATUS_INCOMPLETE
+
+
+def is_owned(notes, now):
+    """
+    :return: whether the publish writing an incomplete snapshot may still be
+             alive: it has not given the snapshot up, and its last
+             heartbeat is recent
+    :rtype:  bool
+    """
+    last_seen = notes.get(REPO_SNAPSHOT_HEARTBEAT)
+    # Snapshots started before owners were recorded have no heartbeat
+    return last_seen is not None and now - last_seen < OWNER_TIMEOUT
+
+
+def take_over(snapshot_id, notes, owner):
+    """
+    Make a publish the owner of an incomplete snapshot, provided it is
+    still as described by notes: another publish looking at the same
+    snapshot, or its previous owner, changed nothing in the meantime.
+
+    :param notes: the snapshot's notes, as read
+    :type  notes: dict
+    :param owner: identifies the publish taking the snapshot over
+    :type  owner: str
+    :return: whether the snapshot was taken over
+    :rtype:  bool
+    """
+    updated = RepoModel.objects(**{
+        'repo_id': snapshot_id,
+        'notes__%s' % REPO_SNAPSHOT_OWNER: notes.get(REPO_SNAPSHOT_OWNER),
+        'notes__%s' % REPO_SNAPSHOT_HEARTBEAT:
+            notes.get(REPO_SNAPSHOT_HEARTBEAT),
+    }).update_one(**{
+        'set__notes__%s' % REPO_SNAPSHOT_OWNER: owner,
+        'set__notes__%s' % REPO_SNAPSHOT_HEARTBEAT: clock(),
+    })
+    return bool(updated)
+
+
+def beat(snapshot_id, owner):
+    """
+    Record that the publish writing a snapshot is alive.
+
+    :return: whether the publish still owns the snapshot
+    :rtype:  bool
+    """
+    return bool(RepoModel.objects(**{
+        'repo_id': snapshot_id,
+        'notes__%s' % REPO_SNAPSHOT_OWNER: owner,
+    }).update_one(**{'set__notes__%s' % REPO_SNAPSHOT_HEARTBEAT: clock()}))
+
+
+def release(snapshot_id, owner):
+    """
+    Give up an incomplete snapshot, so the next publish can resume or
+    delete it without waiting for its heartbeat to expire.
+    """
+    RepoModel.objects(**{
+        'repo_id': snapshot_id,
+        'notes__%s' % REPO_SNAPSHOT_OWNER: owner,
+    }).update_one(**{'set__notes__%s' % REPO_SNAPSHOT_HEARTBEAT: None})
+
+
+@contextmanager
+def owned(snapshot_id, owner):
+    """
+    Keep the heartbeat of an incomplete snapshot going while the enclosed
+    block writes it. The snapshot is released if the block fails.
+    """
+    with heartbeat.Heartbeat(HEARTBEAT_INTERVAL,
+                             partial(beat, snapshot_id, owner)):
+        try:
+            yield
+        except BaseException:
+            release(snapshot_id, owner)
+            raise
+
+
+def advance(snapshot_id, unit_key, owner):
+    """
+    Record that the associations of a snapshot are written up to and
+    including a unit key.
+
+    :param unit_key: (unit_type_id, unit_id)
+    :type  unit_key: tuple
+    :param owner: identifies the publish writing the snapshot
+    :type  owner: str
+    :return: whether the publish still owns the snapshot; if not, another
+             publish took it over and the checkpoint was not recorded
+    :rtype:  bool
+    """
+    return bool(RepoModel.objects(**{
+        'repo_id': snapshot_id,
+        'notes__%s' % REPO_SNAPSHOT_OWNER: owner,
+    }).update_one(**{
+        'set__notes__%s' % REPO_SNAPSHOT_CHECKPOINT: list(unit_key),
+        'set__notes__%s' % REPO_SNAPSHOT_HEARTBEAT: clock(),
+    }))
+
+
+def last_unit(notes):
+    """
+    :return: the last unit key written to an incomplete snapshot, or None if
+             none is known to be
+    :rtype:  tuple
+    """
+    key = notes.get(REPO_SNAPSHOT_CHECKPOINT)
+    return tuple(key) if key else None
+
+
+def find_incomplete(repo_id):
+    """
+    :return: (snapshot id, notes) of the incomplete snapshots of a
+             repository, newest first
+    :rtype:  list of tuple
+    """
+    query = {'repo_id__startswith': '%s__' % repo_id,
+             'notes__%s' % REPO_SNAPSHOT_STATUS: STATUS_INCOMPLETE}
+    snapshots = RepoModel.objects(**query).only('repo_id', 'notes')
+    # Leave out snapshots of other repositories sharing the prefix
+    return sorted(((x.repo_id, x.notes) for x in snapshots
+                   if retention.SNAPSHOT_SUFFIX.match(
+                       x.repo_id[len(repo_id):])),
+                  reverse=True)
+
+
+def filter_key(unit_filter):
+    """
+    :return: a unit filter, in a form that can be stored in notes and
+             compared
+    :rtype:  str
+    """
+    return json.dumps(unit_filter, sort_keys=True)
@@ -0,0 +1,197 @@
+import calendar
+import logging
+import time
+import uuid
+
+from gettext import gettext as _
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from pulp.server.db import connection
+from . import heartbeat
+
+_LOG = logging.getLogger(__name__)
+
+# One lease document per repository: the publish currently snapshotting it,
+# the time of the latest publish request, and the result of the last run
+LEASE_COLLECTION = 'repo_snapshot_leases'
+
+# Longest pause between two looks at a lease held by another publish
+POLL_INTERVAL = 1.0
+
+# Stand-ins for tests
+clock = time.time
+sleep = time.sleep
+
+
+def get_collection():
+    """
+    :return: the collection holding the publish leases
+    :rtype:  pymongo.collection.Collection
+    """
+    return connection.get_collection(LEASE_COLLECTION, create=True)
+
+
+def request(repo_id, now):
+    """
+    Record a publish request for a repository.
+
+    :param now: time of the request
+    :type  now: float
+    :return: time of the latest request before this one, None if there was
+             none
+    :rtype:  float
+    """
+    doc = get_collection().find_one_and_update(
+        {'_id': repo_id}, {'$max': {'requested': now}}, upsert=True,
+        return_document=ReturnDocument.BEFORE)
+    return (doc or {}).get('requested')
+
+
+def acquire(repo_id, token, now, timeout):
+    """
+    Take the repository's lease, unless another publish holds it and its
+    lease has not expired.
+
+    :param token: identifies the publish taking the lease
+    :type  token: str
+    :param timeout: seconds after which the lease expires
+    :type  timeout: float
+    :return: whether the lease was taken
+    :rtype:  bool
+    """
+    try:
+        doc = get_collection().find_one_and_update(
+            {'_id': repo_id, '$or': [{'holder': None},
+                                     {'expires': {'$lt': now}}]},
+            {'$set': {'holder': token, 'expires': now + timeout}},
+            upsert=True, return_document=ReturnDocument.AFTER)
+    except DuplicateKeyError:
+        # Held by another publish; the upsert found nothing to update
+        return False
+    return doc is not None and doc.get('holder') == token
+
+
+def renew(repo_id, token, now, timeout):
+    """
+    Push back the expiry of a lease held by token.
+    """
+    get_collection().update_one({'_id': repo_id, 'holder': token},
+                                {'$set': {'expires': now + timeout}})
+
+
+def release(repo_id, token, result=None, covers=None):
+    """
+    Give up a lease. If the publish succeeded, record its snapshot as the
+    result of every request made up to the time it started.
+
+    :param result: the repository's snapshot after the publish
+    :type  result: str
+    :param covers: time the publish started reading the repository
+    :type  covers: float
+    """
+    update = {'holder': None, 'expires': None}
+    if covers is not None:
+        update.update(result=result, covers=covers, finished=clock())
+    get_collection().update_one({'_id': repo_id, 'holder': token},
+                                {'$set': update})
+
+
+def get(repo_id):
+    """
+    :return: the lease document of a repository, empty if there is none
+    :rtype:  dict
+    """
+    return get_collection().find_one({'_id': repo_id}) or {}
+
+
+def unchanged_since(repo, when):
+    """
+    :return: whether the repository's units are known not to have changed
+             since a point in time
+    :rtype:  bool
+    """
+    for attr in ('last_unit_added', 'last_unit_removed'):
+        value = getattr(repo, attr, False)
+        if value is False:
+            # Not tracked by this version of Pulp
+            return False
+        if value is not None and _epoch(value) > when:
+            return False
+    return True
+
+
+def _epoch(value):
+    if isinstance(value, (int, float)):
+        return value
+    return calendar.timegm(value.utctimetuple()) + value.microsecond / 1e6
+
+
+def run(repo, window, timeout, publish):
+    """
+    Run a publish of a repository, coalesced with the other publishes of the
+    same repository.
+
+    Only the holder of the repository's lease publishes. If another publish
+    was requested less than window seconds before, a burst of requests is
+    under way: the holder waits until no publish has been requested for
+    window seconds, so the rest of the burst is served by a single run.
+    Otherwise it publishes right away. Requests made before a run started
+    get its snapshot without publishing themselves, as do requests made
+    within window seconds of a run after which the repository did not
+    change.
+
+    :param repo: the repository to publish
+    :type  repo: pulp.plugins.model.Repository
+    :param window: seconds without requests before a publish runs
+    :type  window: float
+    :param timeout: seconds after which a lease expires; a lease is renewed
+                    while its holder waits and while it publishes
+    :type  timeout: float
+    :param publish: runs the publish, returning the repository's snapshot
+    :type  publish: callable
+    :return: the repository's snapshot, and whether another publish took it
+    :rtype:  tuple of (str, bool)
+    """
+    token = uuid.uuid4().hex
+    requested = clock()
+    previous = request(repo.id, requested)
+    burst = previous is not None and requested - previous < window
+    while True:
+        doc = get(repo.id)
+        if doc.get('covers') is not None and (
+                doc['covers'] >= requested or (
+                    requested - doc['finished'] < window and
+                    unchanged_since(repo, doc['covers']))):
+            _LOG.info(_("Publish of %(repo)s coalesced with an earlier "
+                        "one, snapshot %(snap)s") %
+                      {'repo': repo.id, 'snap': doc['result']})
+            return doc['result'], True
+        if acquire(repo.id, token, clock(), timeout):
+            break
+        sleep(min(window, POLL_INTERVAL) or POLL_INTERVAL)
+
+    succeeded = False
+    try:
+        deadline = clock() + timeout
+        while burst:
+            now = clock()
+            quiet = now - get(repo.id).get('requested', 0)
+            if quiet >= window or now >= deadline:
+                break
+            renew(repo.id, token, now, timeout)
+            sleep(window - quiet)
+        started = clock()
+        # A publish may outlast the lease: other publishes must not take
+        # it while this one still writes the snapshot
+        with heartbeat.Heartbeat(
+                timeout / 3.0,
+                lambda: renew(repo.id, token, clock(), timeout)):
+            result = publish()
+        succeeded = True
+    finally:
+        if succeeded:
+            release(repo.id, token, result, started)
+        else:
+            # Whoever waits for the lease publishes instead
+            release(repo.id, token)
+    return result, False
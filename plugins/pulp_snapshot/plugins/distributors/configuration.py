@@ -3,11 +3,40 @@ import os
 from ConfigParser import SafeConfigParser
 from gettext import gettext as _
 
+from pulp_snapshot.common import constants
 
 _LOG = logging.getLogger(__name__)
 
 REQUIRED_CONFIG_KEYS = ()
-OPTIONAL_CONFIG_KEYS = ()
+OPTIONAL_CONFIG_KEYS = (
+    constants.CONFIG_CHECK_QUERY_PLANS,
+    constants.CONFIG_CHECKPOINT_INTERVAL,
+    constants.CONFIG_COALESCE_LEASE_TIMEOUT,
+    constants.CONFIG_COALESCE_WINDOW,
+    constants.CONFIG_COPY_BATCH_SIZE,
+    constants.CONFIG_COPY_ENGINE,
+    constants.CONFIG_COPY_RETRIES,
+    constants.CONFIG_COPY_WRITE_CONCERN,
+    constants.CONFIG_DEFER_BOOKKEEPING,
+    constants.CONFIG_DIFF_ENGINE,
+    constants.CONFIG_EXCLUDE_TYPES,
+    constants.CONFIG_FETCH_BATCH_SIZE,
+    constants.CONFIG_FETCH_THREADS,
+    constants.CONFIG_GROUP_THREADS,
+    constants.CONFIG_INCLUDE_TYPES,
+    constants.CONFIG_MANIFEST_DIR,
+    constants.CONFIG_PRUNE_BATCH_SIZE,
+    constants.CONFIG_PRUNE_DELAY,
+    constants.CONFIG_RESTORE_SNAPSHOT,
+    constants.CONFIG_RETAIN_DAILY,
+    constants.CONFIG_RETAIN_DAYS,
+    constants.CONFIG_RETAIN_LAST,
+    constants.CONFIG_RETAIN_WEEKLY,
+    constants.CONFIG_SNAPSHOT_STORAGE,
+    constants.CONFIG_UNIT_CACHE_SIZE,
+    constants.CONFIG_UNIT_CRITERIA,
+    constants.CONFIG_WRITE_MANIFEST,
+)
 
 
 def load_config(config_file_path):
@@ -71,6 +100,58 @@ def validate_config(repo, config, config_conduit):
     # when adding validation methods, make sure to register them here
     # yes, the individual sections are in alphabetical oder
     configured_key_validation_methods = {
+        constants.CONFIG_CHECK_QUERY_PLANS: _validate_boolean(
+            constants.CONFIG_CHECK_QUERY_PLANS),
+        constants.CONFIG_CHECKPOINT_INTERVAL: _validate_integer(
+            constants.CONFIG_CHECKPOINT_INTERVAL),
+        constants.CONFIG_COALESCE_LEASE_TIMEOUT: _validate_integer(
+            constants.CONFIG_COALESCE_LEASE_TIMEOUT),
+        constants.CONFIG_COALESCE_WINDOW: _validate_float(
+            constants.CONFIG_COALESCE_WINDOW),
+        constants.CONFIG_COPY_BATCH_SIZE: _validate_integer(
+            constants.CONFIG_COPY_BATCH_SIZE),
+        constants.CONFIG_COPY_ENGINE: _validate_choice(
+            constants.CONFIG_COPY_ENGINE, constants.COPY_ENGINES),
+        constants.CONFIG_COPY_RETRIES: _validate_integer(
+            constants.CONFIG_COPY_RETRIES, minimum=0),
+        constants.CONFIG_COPY_WRITE_CONCERN: _validate_write_concern,
+        constants.CONFIG_DEFER_BOOKKEEPING: _validate_boolean(
+            constants.CONFIG_DEFER_BOOKKEEPING),
+        constants.CONFIG_DIFF_ENGINE: _validate_choice(
+            constants.CONFIG_DIFF_ENGINE, constants.DIFF_ENGINES),
+        constants.CONFIG_EXCLUDE_TYPES: _validate_type_ids(
+            constants.CONFIG_EXCLUDE_TYPES),
+        constants.CONFIG_FETCH_BATCH_SIZE: _validate_integer(
+            constants.CONFIG_FETCH_BATCH_SIZE),
+        constants.CONFIG_FETCH_THREADS: _validate_integer(
+            constants.CONFIG_FETCH_THREADS),
+        constants.CONFIG_GROUP_THREADS: _validate_integer(
+            constants.CONFIG_GROUP_THREADS),
+        constants.CONFIG_INCLUDE_TYPES: _validate_type_ids(
+            constants.CONFIG_INCLUDE_TYPES),
+        constants.CONFIG_MANIFEST_DIR: _validate_directory(
+            constants.CONFIG_MANIFEST_DIR),
+        constants.CONFIG_PRUNE_BATCH_SIZE: _validate_integer(
+            constants.CONFIG_PRUNE_BATCH_SIZE),
+        constants.CONFIG_PRUNE_DELAY: _validate_float(
+            constants.CONFIG_PRUNE_DELAY),
+        constants.CONFIG_RESTORE_SNAPSHOT: _validate_snapshot_of(
+            constants.CONFIG_RESTORE_SNAPSHOT, repo.id),
+        constants.CONFIG_RETAIN_DAILY: _validate_integer(
+            constants.CONFIG_RETAIN_DAILY),
+        constants.CONFIG_RETAIN_DAYS: _validate_integer(
+            constants.CONFIG_RETAIN_DAYS),
+        constants.CONFIG_RETAIN_LAST: _validate_integer(
+            constants.CONFIG_RETAIN_LAST),
+        constants.CONFIG_RETAIN_WEEKLY: _validate_integer(
+            constants.CONFIG_RETAIN_WEEKLY),
+        constants.CONFIG_SNAPSHOT_STORAGE: _validate_choice(
+            constants.CONFIG_SNAPSHOT_STORAGE, constants.SNAPSHOT_STORAGES),
+        constants.CONFIG_UNIT_CACHE_SIZE: _validate_integer(
+            constants.CONFIG_UNIT_CACHE_SIZE, minimum=0),
+        constants.CONFIG_UNIT_CRITERIA: _validate_unit_criteria,
+        constants.CONFIG_WRITE_MANIFEST: _validate_boolean(
+            constants.CONFIG_WRITE_MANIFEST),
     }
 
     # iterate through the options that have validation methods and validate them
@@ -81,6 +162,14 @@ def validate_config(repo, config, config_conduit):
 
         validation_method(config[key], error_messages)
 
+    # manifests outlive the publish, so they need a directory of their own
+    if get_boolean(config, constants.CONFIG_WRITE_MANIFEST,
+                   constants.DEFAULT_WRITE_MANIFEST) and \
+            not config.get(constants.CONFIG_MANIFEST_DIR):
+        msg = _('Configuration key [%(k)s] is required when [%(w)s] is set')
+        error_messages.append(msg % {'k': constants.CONFIG_MANIFEST_DIR,
+                                     'w': constants.CONFIG_WRITE_MANIFEST})
+
     # if we have errors, log them, and return False with a concatenated
     # error message
     if error_messages:
@@ -91,3 +180,323 @@ def validate_config(repo, config, config_conduit):
         return False, '\n'.join(error_messages)
 
     return True, None
+
+
+def get_integer(config, key, default=None):
+    """
+    Return a configuration value as an integer.
+
+    :param config: configuration instance
+    :type  config: pulp.plugins.config.PluginCallConfiguration or dict
+    :param key: configuration key to look up
+    :type  key: str
+    :param default: value to return if the key is not set
+    :type  default: int
+    :return: the configured value, or the default
+    :rtype:  int
+    """
+    value = config.get(key)
+    if value is None:
+        return default
+    return int(value)
+
+
+def get_float(config, key, default=None):
+    """
+    Return a configuration value as a float.
+
+    :param config: configuration instance
+    :type  config: pulp.plugins.config.PluginCallConfiguration or dict
+    :param key: configuration key to look up
+    :type  key: str
+    :param default: value to return if the key is not set
+    :type  default: float
+    :return: the configured value, or the default
+    :rtype:  float
+    """
+    value = config.get(key)
+    if value is None:
+        return default
+    return float(value)
+
+
+def get_boolean(config, key, default=None):
+    """
+    Return a configuration value as a boolean.
+
+    :param config: configuration instance
+    :type  config: pulp.plugins.config.PluginCallConfiguration or dict
+    :param key: configuration key to look up
+    :type  key: str
+    :param default: value to return if the key is not set
+    :type  default: bool
+    :return: the configured value, given as a boolean or as "true" or
+             "false" in any case, or the default
+    :rtype:  bool
+    """
+    value = config.get(key)
+    if value is None:
+        return default
+    if isinstance(value, basestring):
+        return value.lower() == 'true'
+    return bool(value)
+
+
+def get_type_ids(config, key):
+    """
+    Return a configuration value as a list of unit type ids.
+
+    :param config: configuration instance
+    :type  config: pulp.plugins.config.PluginCallConfiguration or dict
+    :param key: configuration key to look up
+    :type  key: str
+    :return: the configured type ids, given as a list or a comma separated
+             string, or None if the key is not set
+    :rtype:  list of str
+    """
+    value = config.get(key)
+    if value is None:
+        return None
+    if isinstance(value, basestring):
+        value = value.split(',')
+    return sorted(set(x.strip() for x in value if x.strip()))
+
+
+def get_unit_filter(config):
+    """
+    Return the conditions restricting which of a repository's unit
+    associations are snapshotted.
+
+    :param config: configuration instance
+    :type  config: pulp.plugins.config.PluginCallConfiguration or dict
+    :return: query conditions to add to those selecting the repository's
+             associations; empty if all of them are snapshotted
+    :rtype:  dict
+    """
+    ret = {}
+    type_condition = {}
+    include = get_type_ids(config, constants.CONFIG_INCLUDE_TYPES)
+    if include:
+        type_condition['$in'] = include
+    exclude = get_type_ids(config, constants.CONFIG_EXCLUDE_TYPES)
+    if exclude:
+        type_condition['$nin'] = exclude
+    if type_condition:
+        ret['unit_type_id'] = type_condition
+    ret.update(config.get(constants.CONFIG_UNIT_CRITERIA) or {})
+    return ret
+
+
+def _validate_integer(key, minimum=1):
+    """
+    Build a validation method checking that a key's value is an integer no
+    smaller than minimum.
+
+    :param key: configuration key the method validates
+    :type  key: str
+    :param minimum: smallest accepted value
+    :type  minimum: int
+    :return: validation method
+    :rtype:  callable
+    """
+    def validate(value, error_messages):
+        try:
+            valid = int(value) >= minimum
+        except (TypeError, ValueError):
+            valid = False
+        if not valid:
+            msg = _('Configuration key [%(k)s] must be an integer greater '
+                    'than or equal to %(m)d, but was [%(v)s]')
+            error_messages.append(msg % {'k': key, 'm': minimum, 'v': value})
+    return validate
+
+
+def _validate_boolean(key):
+    """
+    Build a validation method checking that a key's value is a boolean, or
+    "true" or "false" in any case.
+
+    :param key: configuration key the method validates
+    :type  key: str
+    :return: validation method
+    :rtype:  callable
+    """
+    def validate(value, error_messages):
+        if isinstance(value, bool):
+            return
+        if isinstance(value, basestring) and \
+                value.lower() in ('true', 'false'):
+            return
+        msg = _('Configuration key [%(k)s] must be true or false, but was '
+                '[%(v)s]')
+        error_messages.append(msg % {'k': key, 'v': value})
+    return validate
+
+
+def _validate_float(key, minimum=0):
+    """
+    Build a validation method checking that a key's value is a number no
+    smaller than minimum.
+
+    :param key: configuration key the method validates
+    :type  key: str
+    :param minimum: smallest accepted value
+    :type  minimum: float
+    :return: validation method
+    :rtype:  callable
+    """
+    def validate(value, error_messages):
+        try:
+            valid = float(value) >= minimum
+        except (TypeError, ValueError):
+            valid = False
+        if not valid:
+            msg = _('Configuration key [%(k)s] must be a number greater '
+                    'than or equal to %(m)s, but was [%(v)s]')
+            error_messages.append(msg % {'k': key, 'm': minimum, 'v': value})
+    return validate
+
+
+def _validate_directory(key):
+    """
+    Build a validation method checking that a key's value is an absolute
+    path.
+
+    :param key: configuration key the method validates
+    :type  key: str
+    :return: validation method
+    :rtype:  callable
+    """
+    def validate(value, error_messages):
+        if not (isinstance(value, basestring) and os.path.isabs(value)):
+            msg = _('Configuration key [%(k)s] must be an absolute path, '
+                    'but was [%(v)s]')
+            error_messages.append(msg % {'k': key, 'v': value})
+    return validate
+
+
+def _validate_write_concern(write_concern, error_messages):
+    """
+    Validate a write concern, either a number of nodes or a tag name such
+    as "majority".
+
+    :param write_concern: configured write concern
+    :type  write_concern: int or str
+    :param error_messages: list to append error messages to
+    :type  error_messages: list
+    """
+    if isinstance(write_concern, basestring) and write_concern:
+        return
+    if isinstance(write_concern, int) and write_concern >= 0:
+        return
+    msg = _('Configuration key [%(k)s] must be a non-negative integer or a '
+            'tag name, but was [%(v)s]')
+    error_messages.append(msg % {'k': constants.CONFIG_COPY_WRITE_CONCERN,
+                                 'v': write_concern})
+
+
+def _validate_snapshot_of(key, repo_id):
+    """
+    Build a validation method checking that a key's value names a snapshot
+    of a repository.
+
+    :param key: configuration key the method validates
+    :type  key: str
+    :param repo_id: repository the snapshot must be of
+    :type  repo_id: str
+    :return: validation method
+    :rtype:  callable
+    """
+    def validate(value, error_messages):
+        if not (isinstance(value, basestring) and
+                value.startswith('%s__' % repo_id)):
+            msg = _('Configuration key [%(k)s] must name a snapshot of '
+                    'repository %(r)s, but was [%(v)s]')
+            error_messages.append(msg % {'k': key, 'r': repo_id, 'v': value})
+    return validate
+
+
+def _validate_type_ids(key):
+    """
+    Build a validation method checking that a key's value is a list of unit
+    type ids, or a comma separated string of them.
+
+    :param key: configuration key the method validates
+    :type  key: str
+    :return: validation method
+    :rtype:  callable
+    """
+    def validate(value, error_messages):
+        if isinstance(value, basestring):
+            valid = bool(value.strip())
+        else:
+            valid = (isinstance(value, (list, tuple)) and bool(value) and
+                     all(isinstance(x, basestring) and x.strip()
+                         for x in value))
+        if not valid:
+            msg = _('Configuration key [%(k)s] must be a list of unit type '
+                    'ids, but was [%(v)s]')
+            error_messages.append(msg % {'k': key, 'v': value})
+    return validate
+
+
+def _validate_unit_criteria(criteria, error_messages):
+    """
+    Validate unit criteria: a dictionary of association fields to either a
+    value, or a dictionary of comparison operators to values.
+
+    :param criteria: configured criteria
+    :type  criteria: dict
+    :param error_messages: list to append error messages to
+    :type  error_messages: list
+    """
+    key = constants.CONFIG_UNIT_CRITERIA
+    if not isinstance(criteria, dict):
+        msg = _('Configuration key [%(k)s] must be a dictionary, but was '
+                '[%(v)s]')
+        error_messages.append(msg % {'k': key, 'v': criteria})
+        return
+    for field, condition in sorted(criteria.items()):
+        if field not in constants.UNIT_CRITERIA_FIELDS:
+            msg = _('Configuration key [%(k)s] may only restrict the fields '
+                    '%(f)s, but restricts [%(v)s]')
+            error_messages.append(msg % {
+                'k': key, 'v': field,
+                'f': ', '.join(constants.UNIT_CRITERIA_FIELDS)})
+            continue
+        if not isinstance(condition, dict):
+            continue
+        for operator, value in sorted(condition.items()):
+            if operator not in constants.UNIT_CRITERIA_OPERATORS:
+                msg = _('Configuration key [%(k)s] may only use the '
+                        'operators %(o)s, but uses [%(v)s]')
+                error_messages.append(msg % {
+                    'k': key, 'v': operator,
+                    'o': ', '.join(constants.UNIT_CRITERIA_OPERATORS)})
+            elif (operator in ('$in', '$nin') and
+                    not isinstance(value, (list, tuple))):
+                msg = _('Configuration key [%(k)s] must give a list of '
+                        'values for [%(o)s], but was [%(v)s]')
+                error_messages.append(msg % {'k': key, 'o': operator,
+                                             'v': value})
+
+
+def _validate_choice(key, choices):
+    """
+    Build a validation method checking that a key's value is one of a set
+    of choices.
+
+    :param key: configuration key the method validates
+    :type  key: str
+    :param choices: accepted values
+    :type  choices: iterable of str
+    :return: validation method
+    :rtype:  callable
+    """
+    def validate(value, error_messages):
+        if value not in choices:
+            msg = _('Configuration key [%(k)s] must be one of %(c)s, '
+                    'but was [%(v)s]')
+            error_messages.append(msg % {'k': key, 'v': value,
+                                         'c': ', '.join(choices)})
+    return validate
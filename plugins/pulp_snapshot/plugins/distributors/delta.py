@@ -0,0 +1,206 @@
+import logging
+
+from gettext import gettext as _
+from pulp.server.db import connection
+from pulp.server.db.model import Repository as RepoModel
+from pulp.server.db.model.repository import RepoContentUnit
+from . import bulk, diff
+
+_LOG = logging.getLogger(__name__)
+
+# Added and removed unit keys of delta snapshots, one document per key; the
+# index is created by the plugin's migrations
+DELTA_COLLECTION = 'repo_snapshot_deltas'
+DELTA_INDEX = [('snapshot_id', 1)] + diff.SORT_ORDER
+
+# Notes of a delta snapshot: the snapshot it is based on, and the number of
+# deltas between it and the last full snapshot
+REPO_SNAPSHOT_BASE = '_repository_base'
+REPO_SNAPSHOT_DEPTH = '_repository_delta_depth'
+
+
+def get_collection():
+    """
+    :return: the collection holding the changes of delta snapshots
+    :rtype:  pymongo.collection.Collection
+    """
+    return connection.get_collection(DELTA_COLLECTION, create=True)
+
+
+def is_delta(notes):
+    """
+    :return: whether a snapshot only stores its changes relative to a base
+             snapshot, and has no unit associations of its own yet
+    :rtype:  bool
+    """
+    return bool(notes.get(REPO_SNAPSHOT_BASE))
+
+
+def depth(notes):
+    """
+    :return: number of deltas between a snapshot and the last full one
+    :rtype:  int
+    """
+    return notes.get(REPO_SNAPSHOT_DEPTH, 0) if is_delta(notes) else 0
+
+
+def apply_changes(units, changes):
+    """
+    Apply the changes of a delta to the units of its base.
+
+    :param units: unit keys of the base, in ascending order
+    :type  units: iterable of tuple
+    :param changes: (diff.ADDED or diff.REMOVED, unit key), in ascending
+                    order of unit key
+    :type  changes: iterable of tuple
+    :return: generator of the resulting unit keys, in ascending order
+    :rtype:  generator
+    """
+    units = iter(units)
+    changes = iter(changes)
+    unit = next(units, None)
+    change = next(changes, None)
+    while unit is not None or change is not None:
+        if change is None or (unit is not None and unit < change[1]):
+            yield unit
+            unit = next(units, None)
+            continue
+        kind, key = change
+        change = next(changes, None)
+        if unit is not None and key == unit:
+            unit = next(units, None)
+            if kind == diff.REMOVED:
+                continue
+        elif kind == diff.REMOVED:
+            # Removing a unit the base does not have
+            continue
+        yield key
+
+
+def read_changes(collection, snapshot_id, batch_size=None):
+    """
+    :return: generator of the changes of a delta snapshot, in ascending
+             order of unit key
+    :rtype:  generator
+    """
+    kwargs = dict(sort=diff.SORT_ORDER)
+    if batch_size:
+        kwargs.update(batch_size=batch_size)
+    cursor = collection.find(dict(snapshot_id=snapshot_id),
+                             dict(_id=0, unit_type_id=1, unit_id=1, change=1),
+                             **kwargs)
+    for doc in cursor:
+        yield doc['change'], (doc['unit_type_id'], doc['unit_id'])
+
+
+def write_changes(collection, snapshot_id, changes, batch_size, retries=0,
+                  callback=None):
+    """
+    Store the changes of a delta snapshot, with batched bulk inserts.
+
+    :param changes: (diff.ADDED or diff.REMOVED, unit key)
+    :type  changes: iterable of tuple
+    :return: number of changes stored
+    :rtype:  int
+    """
+    documents = (dict(snapshot_id=snapshot_id, unit_type_id=key[0],
+                      unit_id=key[1], change=kind)
+                 for kind, key in changes)
+    return bulk.insert(collection, documents, batch_size, retries=retries,
+                       callback=callback)
+
+
+def chain(snapshot_id, notes=None):
+    """
+    Follow a snapshot's bases back to a full snapshot.
+
+    :param notes: the snapshot's notes, if already known
+    :type  notes: dict
+    :return: the full snapshot, and the delta snapshots from the oldest to
+             snapshot_id
+    :rtype:  tuple of (str, list of str)
+    """
+    deltas = []
+    if notes is None:
+        notes = get_notes(snapshot_id)
+    while is_delta(notes):
+        deltas.append(snapshot_id)
+        snapshot_id = notes[REPO_SNAPSHOT_BASE]
+        notes = get_notes(snapshot_id)
+    deltas.reverse()
+    return snapshot_id, deltas
+
+
+def logical_units(units_coll, snapshot_id, notes=None, batch_size=None):
+    """
+    Stream the unit keys of a snapshot, whether or not it is a delta. The
+    units of the full snapshot at the end of the chain are merged with each
+    delta in turn, without holding either in memory.
+
+    :param units_coll: the repo content units collection
+    :type  units_coll: pymongo.collection.Collection
+    :return: generator of (unit_type_id, unit_id), in ascending order
+    :rtype:  generator
+    """
+    full_id, deltas = chain(snapshot_id, notes)
+    units = diff.sorted_units(units_coll, full_id, batch_size)
+    if deltas:
+        delta_coll = get_collection()
+        for delta_id in deltas:
+            units = apply_changes(
+                units, read_changes(delta_coll, delta_id, batch_size))
+    return units
+
+
+def materialize(snapshot_id, batch_size, retries=0, notes=None):
+    """
+    Write the unit associations of a delta snapshot, and its unit counts,
+    turning it into a full snapshot. Its changes are no longer needed
+    afterwards; snapshots based on it now find a full snapshot there.
+    Adding it to groups is left to the caller.
+
+    :return: whether the snapshot was a delta snapshot
+    :rtype:  bool
+    """
+    if notes is None:
+        notes = get_notes(snapshot_id)
+    if not is_delta(notes):
+        return False
+    _LOG.info(_("Materializing delta snapshot %(repo)s") %
+              {'repo': snapshot_id})
+    units_coll = RepoContentUnit.get_collection()
+    counts = {}
+
+    def documents():
+        for unit_type_id, unit_id in logical_units(units_coll, snapshot_id,
+                                                   notes, batch_size):
+            counts[unit_type_id] = counts.get(unit_type_id, 0) + 1
+            yield RepoContentUnit(repo_id=snapshot_id,
+                                  unit_type_id=unit_type_id, unit_id=unit_id)
+    bulk.insert(units_coll, documents(), batch_size, retries=retries)
+    RepoModel.objects(repo_id=snapshot_id).update_one(**{
+        'set__content_unit_counts': counts,
+        'unset__notes__%s' % REPO_SNAPSHOT_BASE: True,
+        'unset__notes__%s' % REPO_SNAPSHOT_DEPTH: True,
+    })
+    get_collection().delete_many(dict(snapshot_id=snapshot_id))
+    return True
+
+
+def dependents(snapshot_ids):
+    """
+    :return: ids of the delta snapshots based on any of snapshot_ids
+    :rtype:  list of str
+    """
+    query = {'notes__%s__in' % REPO_SNAPSHOT_BASE: list(snapshot_ids)}
+    return sorted(x.repo_id for x in RepoModel.objects(**query).only(
+        'repo_id'))
+
+
+def get_notes(snapshot_id):
+    """
+    :return: the notes of a snapshot, empty if it does not exist
+    :rtype:  dict
+    """
+    snapshot = RepoModel.objects(repo_id=snapshot_id).first()
+    return snapshot.notes if snapshot is not None else {}
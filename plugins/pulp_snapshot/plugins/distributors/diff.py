@@ -0,0 +1,153 @@
+from collections import namedtuple
+
+# Number of unit keys present only in the new and only in the old set
+UnitDiff = namedtuple("UnitDiff", "added removed")
+
+# Changes yielded by merge_diff
+ADDED = 1
+REMOVED = -1
+
+# Sort order of the unit keys read by the merge diff. A repository's
+# associations are read one unit type at a time, sorted by unit id only:
+# the unique index Pulp keeps on (repo_id, unit_id, unit_type_id) returns
+# them in that order, and no index of the plugin's own is needed.
+SORT_ORDER = [('unit_type_id', 1), ('unit_id', 1)]
+UNIT_ID_ORDER = [('unit_id', 1)]
+
+
+def aggregate_diff(collection, repo_id, other_repo_id, unit_filter=None):
+    """
+    Compare the unit associations of two repositories on the database
+    server.
+
+    The associations of both repositories are grouped by unit key, and
+    only the number of keys found in just one of them is returned, so the
+    amount of data sent to the worker does not depend on the repository
+    size.
+
+    :param collection: the repo content units collection
+    :type  collection: pymongo.collection.Collection
+    :param repo_id: repository whose units are considered new
+    :type  repo_id: str
+    :param other_repo_id: repository whose units are considered old
+    :type  other_repo_id: str
+    :param unit_filter: conditions restricting which associations of
+                        repo_id are compared
+    :type  unit_filter: dict
+    :return: counts of units added and removed going from other_repo_id to
+             repo_id
+    :rtype:  UnitDiff
+    :raises pymongo.errors.OperationFailure: if the server cannot run the
+            aggregation
+    """
+    def member_of(rid):
+        return {'$max': {'$cond': [{'$eq': ['$repo_id', rid]}, 1, 0]}}
+
+    if unit_filter:
+        match = {'$or': [dict(unit_filter, repo_id=repo_id),
+                         {'repo_id': other_repo_id}]}
+    else:
+        match = {'repo_id': {'$in': [repo_id, other_repo_id]}}
+    pipeline = [
+        {'$match': match},
+        {'$group': {
+            '_id': {'unit_type_id': '$unit_type_id', 'unit_id': '$unit_id'},
+            'new': member_of(repo_id),
+            'old': member_of(other_repo_id),
+        }},
+        # 1 for added, -1 for removed, 0 for unchanged units
+        {'$project': {'change': {'$subtract': ['$new', '$old']}}},
+        {'$match': {'change': {'$ne': 0}}},
+        {'$group': {'_id': '$change', 'count': {'$sum': 1}}},
+    ]
+    counts = dict((x['_id'], x['count'])
+                  for x in collection.aggregate(pipeline, allowDiskUse=True))
+    return UnitDiff(added=counts.get(1, 0), removed=counts.get(-1, 0))
+
+
+def merge_diff(new_units, old_units):
+    """
+    Walk two sorted streams of unit keys as a merge join, yielding the keys
+    found in only one of them.
+
+    Only the current key of each stream is held in memory.
+
+    :param new_units: unit keys, in ascending order
+    :type  new_units: iterable
+    :param old_units: unit keys, in ascending order
+    :type  old_units: iterable
+    :return: generator of (ADDED, key) for keys only in new_units and
+             (REMOVED, key) for keys only in old_units, in ascending order
+    :rtype:  generator
+    """
+    new_units = iter(new_units)
+    old_units = iter(old_units)
+    new = next(new_units, None)
+    old = next(old_units, None)
+    while new is not None or old is not None:
+        if old is None or (new is not None and new < old):
+            yield ADDED, new
+            new = next(new_units, None)
+        elif new is None or old < new:
+            yield REMOVED, old
+            old = next(old_units, None)
+        else:
+            new = next(new_units, None)
+            old = next(old_units, None)
+
+
+def differ(new_units, old_units):
+    """
+    :return: whether two sorted streams of unit keys differ, reading them
+             only up to the first difference
+    :rtype:  bool
+    """
+    for _change in merge_diff(new_units, old_units):
+        return True
+    return False
+
+
+def sorted_units(collection, repo_id, batch_size=None):
+    """
+    Read the unit keys of a repository in sorted order, with one query per
+    unit type.
+
+    :param collection: the repo content units collection
+    :type  collection: pymongo.collection.Collection
+    :param repo_id: repository to read
+    :type  repo_id: str
+    :param batch_size: number of documents per cursor batch
+    :type  batch_size: int
+    :return: generator of (unit_type_id, unit_id)
+    :rtype:  generator
+    """
+    kwargs = dict(sort=UNIT_ID_ORDER)
+    if batch_size:
+        kwargs.update(batch_size=batch_size)
+    query = dict(repo_id=repo_id)
+    for unit_type_id in sorted(collection.distinct('unit_type_id', query)):
+        cursor = collection.find(dict(query, unit_type_id=unit_type_id),
+                                 dict(_id=0, unit_type_id=1, unit_id=1),
+                                 **kwargs)
+        for unit in cursor:
+            yield unit['unit_type_id'], unit['unit_id']
+
+
+def diff_repos(collection, repo_id, other_repo_id, batch_size=None):
+    """
+    Stream the differences between the units of two repositories.
+
+    :param collection: the repo content units collection
+    :type  collection: pymongo.collection.Collection
+    :param repo_id: repository whose units are considered new
+    :type  repo_id: str
+    :param other_repo_id: repository whose units are considered old
+    :type  other_repo_id: str
+    :param batch_size: number of documents per cursor batch
+    :type  batch_size: int
+    :return: generator of (ADDED or REMOVED, (unit_type_id, unit_id))
+    :rtype:  generator
+    """
+    return merge_diff(
+        sorted_units(collection, repo_id, batch_size),
+        sorted_units(collection, other_repo_id, batch_size))
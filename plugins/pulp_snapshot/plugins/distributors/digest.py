@@ -0,0 +1,83 @@
+import hashlib
+
+
+class UnitSetDigest(object):
+    """
+    Order-independent digest of a set of (unit_type_id, unit_id) keys,
+    along with the number of units of each type.
+
+    Every key is hashed on its own and the hashes are added modulo 2**160,
+    so the result does not depend on the order in which the keys are seen
+    and can be computed while streaming.
+    """
+    MODULUS = 1 << 160
+
+    def __init__(self, digest=None, counts=None):
+        if digest is None:
+            self._sum = 0
+        else:
+            self._sum = int(digest, 16)
+        self.counts = dict(counts or {})
+
+    @classmethod
+    def from_units(cls, units):
+        """
+        :param units: iterable of REPO_UNIT
+        :type  units: iterable
+        :rtype: UnitSetDigest
+        """
+        ret = cls()
+        for unit in units:
+            ret.add(unit.unit_type_id, unit.unit_id)
+        return ret
+
+    @classmethod
+    def _hash(cls, unit_type_id, unit_id):
+        key = u'%s\0%s' % (unit_type_id, unit_id)
+        return int(hashlib.sha1(key.encode('utf-8')).hexdigest(), 16)
+
+    def add(self, unit_type_id, unit_id):
+        self._sum = (self._sum + self._hash(unit_type_id, unit_id)) % \
+            self.MODULUS
+        self.counts[unit_type_id] = self.counts.get(unit_type_id, 0) + 1
+
+    def remove(self, unit_type_id, unit_id):
+        """
+        Take a unit that was added to the digest out of it.
+        """
+        self._sum = (self._sum - self._hash(unit_type_id, unit_id)) % \
+            self.MODULUS
+        self.counts[unit_type_id] -= 1
+        if not self.counts[unit_type_id]:
+            del self.counts[unit_type_id]
+
+    def passthrough(self, units):
+        """
+        Add units to the digest as they are iterated over.
+
+        :param units: iterable of REPO_UNIT
+        :type  units: iterable
+        :return: generator of the same units
+        :rtype:  generator
+        """
+        for unit in units:
+            self.add(unit.unit_type_id, unit.unit_id)
+            yield unit
+
+    def hexdigest(self):
+        return '%040x' % self._sum
+
+    def __eq__(self, other):
+        if not isinstance(other, UnitSetDigest):
+            return NotImplemented
+        return self._sum == other._sum and self.counts == other.counts
+
+    def __ne__(self, other):
+        ret = self.__eq__(other)
+        if ret is NotImplemented:
+            return ret
+        return not ret
+
+    def __repr__(self):
+        return "<%s %s %r>" % (self.__class__.__name__, self.hexdigest(),
+                               self.counts)
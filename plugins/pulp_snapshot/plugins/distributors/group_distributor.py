@@ -0,0 +1,36 @@
+from gettext import gettext as _
+from pulp.plugins.distributor import GroupDistributor
+from pulp_snapshot.common import ids
+from . import configuration
+# Registers the bookkeeping task, as the distributor module does
+from . import bookkeeping  # noqa
+
+# Like the distributor, the group distributor leaves importing its
+# publisher until a group is published.
+
+
+def entry_point():
+    return Snapshot_GroupDistributor, {}
+
+
+class Snapshot_GroupDistributor(GroupDistributor):
+    @classmethod
+    def metadata(cls):
+        return {
+            'id': ids.TYPE_ID_GROUP_DISTRIBUTOR_SNAPSHOT,
+            'display_name': _('Snapshot Group Distributor'),
+            'types': sorted(ids.SUPPORTED_TYPES),
+        }
+
+    def validate_config(self, repo_group, config, config_conduit):
+        return configuration.validate_config(repo_group, config,
+                                             config_conduit)
+
+    def publish_group(self, repo_group, publish_conduit, config):
+        from .group_publisher import GroupPublisher
+        publisher = GroupPublisher(repo_group=repo_group,
+                                   conduit=publish_conduit, config=config)
+        return publisher.process_lifecycle()
+
+    def distributor_removed(self, repo_group, config):
+        pass
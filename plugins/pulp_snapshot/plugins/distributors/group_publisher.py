@@ -0,0 +1,157 @@
+import logging
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from gettext import gettext as _
+from pulp.plugins.config import PluginCallConfiguration
+from pulp.plugins.loader import api as plugin_api
+from pulp.plugins.util import publish_step as platform_steps
+from pulp.server.db.model import Distributor as RepoDistributor
+from pulp.server.db.model import Repository as RepoModel
+from pulp.server.exceptions import PulpCodedException
+from pulp_snapshot.common import ids, constants
+from pulp_snapshot.plugins import error_codes
+from . import bookkeeping, configuration
+from .publisher import Publisher, add_to_groups, is_snapshot
+
+_LOG = logging.getLogger(__name__)
+
+
+class GroupPublisher(platform_steps.PluginStep):
+    """
+    Snapshot every repository of a group, concurrently. All new snapshots
+    share the same timestamp, and are added to groups with a single bulk
+    write once they are all created.
+
+    Each repository is snapshotted with the configuration of its own
+    snapshot distributor, and holds the same lease as a publish of the
+    repository would.
+    """
+    description = _("Snapshotting repository group")
+
+    def __init__(self, repo_group, conduit, config, **kwargs):
+        super(GroupPublisher, self).__init__(
+            step_type=constants.PUBLISH_GROUP_SNAPSHOT,
+            repo=repo_group,
+            conduit=conduit,
+            config=config,
+            plugin_type=ids.TYPE_ID_GROUP_DISTRIBUTOR_SNAPSHOT,
+            **kwargs)
+        self.description = self.__class__.description
+        self.repo_snapshots = {}
+        # Repository publishers report their progress through this step,
+        # from the pool's threads
+        self._lock = threading.RLock()
+
+    def process_main(self, item=None):
+        repo_group = self.get_repo()
+        repos = [x.to_transfer_repo()
+                 for x in RepoModel.objects(repo_id__in=repo_group.repo_ids)
+                 if not is_snapshot(x.repo_id, x.notes)]
+        if not repos:
+            return
+        self.total_units += len(repos)
+
+        configs = self._repo_configs([x.id for x in repos])
+        now = time.time()
+        threads = configuration.get_integer(
+            self.get_config(), constants.CONFIG_GROUP_THREADS,
+            constants.DEFAULT_GROUP_THREADS)
+        pool = ThreadPool(min(threads, len(repos)))
+        try:
+            results = pool.map(
+                lambda repo: self._snapshot(
+                    repo, configs.get(repo.id, self.get_config()), now),
+                repos)
+        finally:
+            pool.close()
+            pool.join()
+
+        created = {}
+        deferred = False
+        failed = []
+        for repo, result in zip(repos, results):
+            snapshot_name, changed, left_to_task, ok = result
+            if not ok:
+                failed.append(repo.id)
+                continue
+            self.repo_snapshots[repo.id] = snapshot_name
+            if left_to_task:
+                deferred = True
+            elif changed:
+                created[repo.id] = snapshot_name
+        if deferred:
+            # Those repositories' publishers recorded their snapshots
+            bookkeeping.schedule()
+        add_to_groups(created)
+        if failed:
+            raise PulpCodedException(error_code=error_codes.SNAP0100,
+                                     repo=', '.join(sorted(failed)))
+
+    def _repo_configs(self, repo_ids):
+        """
+        :return: the configuration of the snapshot distributor of each
+                 repository that has one, keyed by repository id. The
+                 others are snapshotted with the group distributor's
+                 configuration.
+        :rtype:  dict
+        """
+        _distributor, plugin_config = plugin_api.get_distributor_by_id(
+            ids.TYPE_ID_DISTRIBUTOR_SNAPSHOT)
+        return dict(
+            (x.repo_id, PluginCallConfiguration(plugin_config, x.config))
+            for x in RepoDistributor.objects(
+                repo_id__in=repo_ids,
+                distributor_type_id=ids.TYPE_ID_DISTRIBUTOR_SNAPSHOT))
+
+    def _snapshot(self, repo, config, now):
+        """
+        Snapshot one repository of the group.
+
+        :return: the repository's current snapshot, whether it was created
+                 or an earlier snapshot was reused, whether adding it to
+                 groups was left to the bookkeeping task, and whether the
+                 repository was processed successfully
+        :rtype:  tuple of (str, bool, bool, bool)
+        """
+        publisher = Publisher(repo=repo, conduit=self.get_conduit(),
+                              config=config)
+        publisher.parent = self
+        result = []
+
+        def snapshot():
+            result.extend(publisher.snapshot(now))
+            return result[0]
+        try:
+            snapshot_name = publisher.run_coalesced(snapshot)
+            # Not created if another publish snapshotted the repository
+            created = bool(result) and result[1]
+        except Exception:
+            _LOG.exception(_("Error snapshotting repository %(repo)s") %
+                           {'repo': repo.id})
+            return None, False, False, False
+        try:
+            publisher.prune(now, snapshot_name)
+        except Exception:
+            # The new snapshot is fine; pruning is retried next time
+            _LOG.exception(_("Error pruning snapshots of %(repo)s") %
+                           {'repo': repo.id})
+        publisher.log_phases(snapshot_name, created)
+        with self._lock:
+            self.progress_successes += 1
+            self.report_progress()
+        changed = publisher.joins_groups(created)
+        deferred = changed and publisher.defers_bookkeeping
+        if deferred:
+            publisher.defer_bookkeeping(snapshot_name)
+        return snapshot_name, changed, deferred, True
+
+    def report_progress(self, force=False):
+        with self._lock:
+            super(GroupPublisher, self).report_progress(force)
+
+    def get_progress_report_summary(self):
+        ret = super(GroupPublisher, self).get_progress_report_summary()
+        ret.update(repository_snapshots=dict(self.repo_snapshots))
+        return ret
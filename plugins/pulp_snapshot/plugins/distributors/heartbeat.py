@@ -0,0 +1,47 @@
+import logging
+import threading
+
+from gettext import gettext as _
+
+_LOG = logging.getLogger(__name__)
+
+
+class Heartbeat(object):
+    """
+    Call a function every interval seconds from a background thread, for as
+    long as the enclosed block runs. Used to show other workers that a
+    long running publish is still alive.
+
+    Errors raised by the function are logged, and the next beat is still
+    attempted.
+    """
+    def __init__(self, interval, beat):
+        """
+        :param interval: seconds between two calls
+        :type  interval: float
+        :param beat: function to call, without arguments
+        :type  beat: callable
+        """
+        self.interval = interval
+        self.beat = beat
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.beat()
+            except Exception:
+                _LOG.exception(_("Heartbeat failed"))
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name="snapshot-heartbeat")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stopped.set()
+        self._thread.join()
+        return False
@@ -0,0 +1,89 @@
+import bisect
+from collections import namedtuple
+
+from pulp.server.db import connection
+
+# One document per repository, listing its snapshots by the time they
+# became current. A snapshot reused when the repository went back to its
+# units is listed again, at the time it was reused.
+INDEX_COLLECTION = 'repo_snapshot_index'
+
+SnapshotEntry = namedtuple("SnapshotEntry",
+                           "snapshot_id timestamp digest units")
+
+
+def get_collection():
+    """
+    :return: the collection holding the snapshot index
+    :rtype:  pymongo.collection.Collection
+    """
+    return connection.get_collection(INDEX_COLLECTION, create=True)
+
+
+def add(repo_id, entry):
+    """
+    Add a snapshot to the index of its repository, keeping the index
+    sorted by timestamp.
+
+    :param repo_id: repository the snapshot was taken of
+    :type  repo_id: str
+    :param entry: the snapshot
+    :type  entry: SnapshotEntry
+    """
+    get_collection().update_one(
+        {'_id': repo_id},
+        {'$push': {'snapshots': {'$each': [entry._asdict()],
+                                 '$sort': {'timestamp': 1}}}},
+        upsert=True)
+
+
+def remove(snapshot_ids):
+    """
+    Remove snapshots from the index of whichever repository they are in.
+
+    :param snapshot_ids: ids of the snapshots to remove
+    :type  snapshot_ids: list of str
+    """
+    get_collection().update_many(
+        {'snapshots.snapshot_id': {'$in': snapshot_ids}},
+        {'$pull': {'snapshots': {'snapshot_id': {'$in': snapshot_ids}}}})
+
+
+def rebuild(repo_id, entries):
+    """
+    Replace the index of a repository.
+
+    :param entries: the repository's snapshots, in any order
+    :type  entries: iterable of SnapshotEntry
+    """
+    snapshots = [x._asdict() for x in sorted(entries,
+                                             key=lambda x: x.timestamp)]
+    get_collection().replace_one({'_id': repo_id},
+                                 {'snapshots': snapshots}, upsert=True)
+
+
+def get_snapshots(repo_id):
+    """
+    :return: the snapshots of a repository, oldest first; reused snapshots
+             appear once for each time they became current
+    :rtype:  list of SnapshotEntry
+    """
+    doc = get_collection().find_one({'_id': repo_id}) or {}
+    return [SnapshotEntry(**x) for x in doc.get('snapshots', [])]
+
+
+def as_of(repo_id, timestamp):
+    """
+    Find the snapshot of a repository that was current at a point in time.
+
+    :param repo_id: repository to look up
+    :type  repo_id: str
+    :param timestamp: point in time, in seconds since the epoch
+    :type  timestamp: float
+    :return: the newest snapshot taken at or before timestamp, or None if
+             there is none
+    :rtype:  SnapshotEntry
+    """
+    snapshots = get_snapshots(repo_id)
+    i = bisect.bisect_right([x.timestamp for x in snapshots], timestamp)
+    return snapshots[i - 1] if i else None
@@ -0,0 +1,185 @@
+"""
+Indexes the snapshot queries rely on, and a check of the plans the
+database picks for those queries.
+"""
+import logging
+from collections import namedtuple
+
+from gettext import gettext as _
+from pulp.server.db import connection
+from . import bulk, delta, diff, index
+
+_LOG = logging.getLogger(__name__)
+
+UNITS_COLLECTION = 'repo_content_units'
+GROUPS_COLLECTION = 'repo_groups'
+
+# Indexes Pulp creates on its own collections, which the snapshot queries
+# rely on: the unique index of unit associations, and the multikey index
+# of group members. They are not created again by the plugin: the same
+# keys with other options fail with IndexOptionsConflict, and the same
+# fields in another order make a redundant index every write maintains.
+UNITS_INDEX = [(x, 1) for x in bulk.MERGE_KEY]
+GROUPS_INDEX = [('repo_ids', 1)]
+
+# (collection name, index keys) of every index of the plugin's own
+# collections a publish needs. Creating an index that already exists does
+# nothing, so they can be created on every migration run.
+REQUIRED_INDEXES = (
+    # Reading the changes of a delta snapshot in sorted order
+    (delta.DELTA_COLLECTION, delta.DELTA_INDEX),
+    # Removing pruned snapshots from the snapshot index
+    (index.INDEX_COLLECTION, [('snapshots.snapshot_id', 1)]),
+)
+
+# A query the publisher runs, to be explained: its name, the collection it
+# runs on, its filter, its sort order if any, and the keys of the index it
+# relies on
+HotQuery = namedtuple("HotQuery", "name collection spec sort index")
+
+# Plan stages that mean the query reads the whole collection, or sorts
+# its results in memory
+STAGE_COLLSCAN = 'COLLSCAN'
+STAGE_SORT = 'SORT'
+# Reported when the plan does not scan the index the query relies on
+INDEX_NOT_USED = 'INDEX_NOT_USED'
+
+
+def ensure_indexes():
+    """
+    Create the indexes in REQUIRED_INDEXES that do not exist yet.
+
+    :return: names of the indexes, keyed by collection name
+    :rtype:  dict
+    """
+    ret = {}
+    for name, keys in REQUIRED_INDEXES:
+        collection = connection.get_collection(name, create=True)
+        ret.setdefault(name, []).append(
+            collection.create_index(keys, background=True))
+    return ret
+
+
+def hot_queries(unit_query, repo_id, snapshot_id):
+    """
+    :param unit_query: filter selecting the units of the repository being
+                       published
+    :type  unit_query: dict
+    :param repo_id: repository being published
+    :type  repo_id: str
+    :param snapshot_id: the repository's current snapshot
+    :type  snapshot_id: str
+    :return: the queries a publish of the repository relies on
+    :rtype:  list of HotQuery
+    """
+    def get(name):
+        return connection.get_collection(name, create=True)
+    units_coll = get(UNITS_COLLECTION)
+
+    def by_type(query):
+        # Sorted units are read one unit type at a time; any type will do
+        unit_types = sorted(units_coll.distinct('unit_type_id', query))
+        return dict(query, unit_type_id=unit_types[0]) if unit_types \
+            else query
+    return [
+        HotQuery('repository_units', units_coll, by_type(unit_query),
+                 diff.UNIT_ID_ORDER, UNITS_INDEX),
+        HotQuery('snapshot_units', units_coll,
+                 by_type({'repo_id': snapshot_id}), diff.UNIT_ID_ORDER,
+                 UNITS_INDEX),
+        HotQuery('delta_changes', get(delta.DELTA_COLLECTION),
+                 {'snapshot_id': snapshot_id}, diff.SORT_ORDER,
+                 delta.DELTA_INDEX),
+        HotQuery('repository_groups', get(GROUPS_COLLECTION),
+                 {'repo_ids': repo_id}, None, GROUPS_INDEX),
+        HotQuery('snapshot_index', get(index.INDEX_COLLECTION),
+                 {'snapshots.snapshot_id': snapshot_id}, None,
+                 [('snapshots.snapshot_id', 1)]),
+    ]
+
+
+def index_name(keys):
+    """
+    :param keys: index keys, as (field, direction) pairs
+    :type  keys: list of tuple
+    :return: the name the server gives an index created without one
+    :rtype:  str
+    """
+    return '_'.join('%s_%s' % (field, direction) for field, direction in keys)
+
+
+def _plan_nodes(planner):
+    plans = [planner.get('winningPlan', {})]
+    while plans:
+        plan = plans.pop(0)
+        yield plan
+        if 'inputStage' in plan:
+            plans.append(plan['inputStage'])
+        plans.extend(plan.get('inputStages', []))
+
+
+def plan_stages(explanation):
+    """
+    :param explanation: output of explain() for a query
+    :type  explanation: dict
+    :return: the stages of the winning plan, from the last one to the first
+    :rtype:  list of str
+    """
+    planner = explanation.get('queryPlanner')
+    if planner is None:
+        # Servers before 3.0 describe the plan with the cursor used
+        stages = []
+        if explanation.get('scanAndOrder'):
+            stages.append(STAGE_SORT)
+        if explanation.get('cursor', '').startswith('BasicCursor'):
+            stages.append(STAGE_COLLSCAN)
+        return stages
+    return [x['stage'] for x in _plan_nodes(planner) if x.get('stage')]
+
+
+def plan_indexes(explanation):
+    """
+    :param explanation: output of explain() for a query
+    :type  explanation: dict
+    :return: names of the indexes the winning plan scans
+    :rtype:  list of str
+    """
+    planner = explanation.get('queryPlanner')
+    if planner is None:
+        cursor = explanation.get('cursor', '')
+        if cursor.startswith('BtreeCursor '):
+            return [cursor.split()[1]]
+        return []
+    return [x['indexName'] for x in _plan_nodes(planner)
+            if x.get('indexName')]
+
+
+def check_plans(queries):
+    """
+    Explain queries and warn about those that read a whole collection, sort
+    in memory, or do not use the index they rely on.
+
+    :param queries: queries to check
+    :type  queries: iterable of HotQuery
+    :return: for each query with a problem, its name and the stages at fault
+    :rtype:  dict
+    """
+    ret = {}
+    for query in queries:
+        cursor = query.collection.find(query.spec)
+        if query.sort:
+            cursor = cursor.sort(query.sort)
+        explanation = cursor.explain()
+        stages = plan_stages(explanation)
+        problems = [x for x in (STAGE_COLLSCAN, STAGE_SORT) if x in stages]
+        if query.index and \
+                index_name(query.index) not in plan_indexes(explanation):
+            problems.append(INDEX_NOT_USED)
+        if not problems:
+            continue
+        ret[query.name] = problems
+        _LOG.warning(_("Query %(name)s on %(coll)s runs with %(stages)s; "
+                       "run pulp-manage-db to create the indexes it needs") %
+                     {'name': query.name, 'coll': query.collection.name,
+                      'stages': ', '.join(problems)})
+    return ret
@@ -0,0 +1,157 @@
+"""
+Snapshot manifests: the unit keys of a snapshot in a file, for comparing
+snapshots across servers and recreating them elsewhere.
+
+A manifest starts with MAGIC, the length of its header as a big-endian
+32 bit integer, and the header as JSON. The header describes the
+snapshot and gives the offset, codec and width of one section per unit
+type. Each section holds the unit ids of its type packed as UnitKeySet
+packs them: sorted fixed width entries, 16 bytes per UUID. Manifests are
+memory mapped when read, so they can be diffed without loading them.
+
+Manifests are diffed offline, with no Pulp server needed:
+
+    python -m pulp_snapshot.plugins.distributors.manifest diff OLD NEW
+
+and imported as a snapshot repository on a server:
+
+    python -m pulp_snapshot.plugins.distributors.manifest import PATH [ID]
+"""
+import json
+import mmap
+import os
+import struct
+import sys
+
+from . import diff as unit_diff
+from .unitkeys import UnitKeySet
+
+MAGIC = b'PSNAPMF1'
+_LENGTH = struct.Struct('>I')
+SUFFIX = '.manifest'
+
+
+def file_name(snapshot_id):
+    return snapshot_id + SUFFIX
+
+
+def write(path, units, **info):
+    """
+    Write a manifest atomically: readers see either no file or the whole
+    manifest.
+
+    :param path: file to write
+    :type  path: str
+    :param units: the snapshot's unit keys
+    :type  units: UnitKeySet
+    :param info: fields describing the snapshot, such as snapshot_id,
+                 repo_id and timestamp, stored in the header
+    """
+    # Section offsets are relative to the end of the header
+    sections = []
+    offset = 0
+    for unit_type_id, codec, width, buf in units.buffers():
+        sections.append(dict(unit_type_id=unit_type_id, codec=codec,
+                             width=width, count=len(buf) // width,
+                             offset=offset))
+        offset += len(buf)
+    header = dict(info, types=sections)
+    header = json.dumps(header, sort_keys=True).encode('utf-8')
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(_LENGTH.pack(len(header)))
+        f.write(header)
+        for _unit_type_id, _codec, _width, buf in units.buffers():
+            f.write(buf)
+    os.rename(tmp_path, path)
+
+
+class Manifest(object):
+    """
+    A manifest mapped into memory. Its units are read from the mapping as
+    they are needed; close the manifest once done with them.
+    """
+    def __init__(self, path):
+        """
+        :param path: manifest file
+        :type  path: str
+        :raise ValueError: if the file is not a manifest
+        """
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self.info, self.units = self._parse()
+        except Exception:
+            self.close()
+            raise
+
+    def _parse(self):
+        data = self._map
+        start = len(MAGIC) + _LENGTH.size
+        if len(data) < start or data[:len(MAGIC)] != MAGIC:
+            raise ValueError("%s is not a snapshot manifest" % self.path)
+        length, = _LENGTH.unpack(data[len(MAGIC):start])
+        info = json.loads(data[start:start + length].decode('utf-8'))
+        base = start + length
+        buffers = []
+        for section in info.pop('types'):
+            size = section['count'] * section['width']
+            offset = base + section['offset']
+            if offset + size > len(data):
+                raise ValueError("%s is truncated" % self.path)
+            buffers.append((section['unit_type_id'], section['codec'],
+                            section['width'], buffer(data, offset, size)))
+        return info, UnitKeySet.from_buffers(buffers)
+
+    def close(self):
+        self.units = None
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def diff(old_path, new_path):
+    """
+    Compare the units of two manifests.
+
+    :return: generator of (diff.ADDED, key) for units only in the new
+             manifest and (diff.REMOVED, key) for units only in the old
+             one, in ascending order
+    :rtype:  generator
+    """
+    with Manifest(old_path) as old:
+        with Manifest(new_path) as new:
+            for change in new.units.diff(old.units):
+                yield change
+
+
+def main(argv):
+    usage = ("usage: %s diff OLD NEW | import PATH [SNAPSHOT_ID]" %
+             os.path.basename(argv[0]))
+    if argv[1:2] == ['diff'] and len(argv) == 4:
+        changes = 0
+        for change, unit in diff(argv[2], argv[3]):
+            sign = '+' if change == unit_diff.ADDED else '-'
+            line = u'%s %s %s\n' % (sign, unit.unit_type_id, unit.unit_id)
+            sys.stdout.write(line.encode('utf-8'))
+            changes += 1
+        return 1 if changes else 0
+    if argv[1:2] == ['import'] and len(argv) in (3, 4):
+        from pulp.server.db import connection
+        from .publisher import import_manifest
+        connection.initialize()
+        sys.stdout.write('%s\n' % import_manifest(
+            argv[2], argv[3] if len(argv) == 4 else None))
+        return 0
+    sys.stderr.write(usage + '\n')
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,1295 @@
+import logging
+import os
+import threading
+import time
+import uuid
+from functools import partial
+from multiprocessing.pool import ThreadPool
+
+from gettext import gettext as _
+from pulp.plugins.util import publish_step as platform_steps
+from pymongo.errors import OperationFailure
+from pymongo.write_concern import WriteConcern
+from pulp.server.db.model import Importer as RepoImporter
+from pulp.server.db.model import Repository as RepoModel
+from pulp.server.db.model.repository import RepoContentUnit
+from pulp.server.db.model.repo_group import RepoGroup
+from pulp.server.controllers import repository as repo_controller
+from pulp.server.exceptions import PulpCodedException
+from pulp_snapshot.common import ids, constants
+from pulp_snapshot.plugins import error_codes
+from . import (bookkeeping, bulk, cache, checkpoint, coalesce, configuration,
+               delta, diff, index, indexes, manifest, restore, retention,
+               timing)
+from .digest import UnitSetDigest
+from .unitkeys import UnitKey, UnitKeySet, UnitKeySetBuilder, split_changes
+
+_LOG = logging.getLogger(__name__)
+REPO_SNAPSHOT_NAME = '_repository_snapshot'
+REPO_SNAPSHOT_TIMESTAMP = '_repository_timestamp'
+REPO_SNAPSHOT_DIGEST = '_repository_digest'
+REPO_SNAPSHOT_UNIT_COUNTS = '_repository_unit_counts'
+
+REPO_UNIT = UnitKey
+# Only the unit key is needed to compare and copy associations; leaving
+# out the timestamps, _id and owner fields keeps the documents small
+UNIT_KEY_PROJECTION = dict(_id=0, unit_type_id=1, unit_id=1)
+
+
+def snapshot_name_for(repo_id, now):
+    """
+    :return: name of the snapshot of a repository taken at a point in time
+    :rtype:  str
+    """
+    suffix = time.strftime("%Y%m%d%H%M%S", time.gmtime(now))
+    suffix = "__%s.%04dZ" % (suffix, 10000 * (now - int(now)))
+    return "%s%s" % (repo_id, suffix)
+
+
+def is_snapshot(repo_id, notes):
+    """
+    :return: whether a repository is a snapshot of another one; snapshots
+             name themselves in their notes
+    :rtype:  bool
+    """
+    return notes.get(REPO_SNAPSHOT_NAME) == repo_id
+
+
+def add_to_groups(snapshots):
+    """
+    Add snapshots to the groups their repositories belong to, with a single
+    bulk write.
+
+    :param snapshots: snapshot names, keyed by the id of the repository
+                      they were taken from
+    :type  snapshots: dict
+    """
+    requests = bookkeeping.group_requests(sorted(snapshots.items()))
+    if requests:
+        RepoGroup.get_collection().bulk_write(requests, ordered=False)
+
+
+def import_manifest(path, snapshot_id=None):
+    """
+    Create a snapshot repository holding the units of a manifest, such as
+    one written by another server. Only the associations are created: the
+    units themselves must already exist on this server.
+
+    :param path: manifest file
+    :type  path: str
+    :param snapshot_id: id of the snapshot repository; defaults to the id
+                        of the snapshot the manifest was written from
+    :type  snapshot_id: str
+    :return: id of the snapshot repository
+    :rtype:  str
+    :raise ValueError: if the file is not a manifest, or its units do not
+                       match the digest it records
+    """
+    with manifest.Manifest(path) as snapshot:
+        info = snapshot.info
+        snapshot_id = snapshot_id or info['snapshot_id']
+        units_digest = UnitSetDigest.from_units(snapshot.units)
+        if info.get('digest') not in (None, units_digest.hexdigest()):
+            raise ValueError("%s does not match its digest" % path)
+        timestamp = info.get('timestamp') or time.time()
+        notes = {
+            REPO_SNAPSHOT_NAME: snapshot_id,
+            REPO_SNAPSHOT_TIMESTAMP: timestamp,
+            REPO_SNAPSHOT_DIGEST: units_digest.hexdigest(),
+            REPO_SNAPSHOT_UNIT_COUNTS: units_digest.counts,
+        }
+        if info.get('repo_type'):
+            notes['_repo-type'] = info['repo_type']
+        owner = uuid.uuid4().hex
+        checkpoint.start(notes, {}, owner)
+        repo_obj = repo_controller.create_repo(snapshot_id, notes=notes)
+        with checkpoint.owned(snapshot_id, owner):
+            bulk.insert(RepoContentUnit.get_collection(),
+                        (RepoContentUnit(repo_id=snapshot_id,
+                                         unit_id=x.unit_id,
+                                         unit_type_id=x.unit_type_id)
+                         for x in snapshot.units),
+                        constants.DEFAULT_COPY_BATCH_SIZE)
+    repo_obj.content_unit_counts = dict(units_digest.counts)
+    checkpoint.finish(repo_obj.notes)
+    repo_obj.save()
+    if info.get('repo_id'):
+        index.add(info['repo_id'], index.SnapshotEntry(
+            snapshot_id=snapshot_id, timestamp=timestamp,
+            digest=units_digest.hexdigest(),
+            units=sum(units_digest.counts.values())))
+    return snapshot_id
+
+
+class Publisher(platform_steps.PluginStep):
+    description = _("Snapshotting repository")
+
+    def __init__(self, repo, conduit, config, **kwargs):
+        super(Publisher, self).__init__(
+            step_type=constants.PUBLISH_SNAPSHOT,
+            repo=repo,
+            conduit=conduit,
+            config=config,
+            plugin_type=ids.TYPE_ID_DISTRIBUTOR_SNAPSHOT,
+            **kwargs)
+        self.description = self.__class__.description
+        self.repo_snapshot = None
+        self.units_read = dict(documents=0, bytes=0)
+        # Units may be read from several threads, see _fetch_unit_sets
+        self._read_lock = threading.Lock()
+        self.units_diff = None
+        self.pruned_snapshots = []
+        self.phases = timing.Phases()
+        self.reused_snapshot = None
+        # Whether the snapshot created or reused is a delta snapshot, which
+        # has no unit associations of its own until it is materialized
+        self.delta_snapshot = False
+        self.coalesced = False
+        self.deferred_counts = None
+        self.manifest = None
+        self.query_plan_warnings = None
+        # Owner of the snapshots this publish writes, see checkpoint
+        self._owner = uuid.uuid4().hex
+
+    def process_main(self, item=None):
+        repo = self.get_repo()
+        if is_snapshot(repo.id, repo.notes):
+            # Only delta snapshots have a distributor, see
+            # _create_snapshot. Publishing one writes its associations,
+            # after which it can join the groups of its repository.
+            if delta.is_delta(repo.notes):
+                with self.phases.phase('materialize'):
+                    if self._materialize(repo.id, repo.notes):
+                        add_to_groups({retention.source_repo_id(repo.id):
+                                       repo.id})
+            return self._build_report(repo.id)
+        snapshot_id = self.get_config().get(
+            constants.CONFIG_RESTORE_SNAPSHOT)
+        if snapshot_id:
+            self.restore(snapshot_id)
+            return self._build_report(snapshot_id)
+        snapshot_name = self.run_coalesced(self.publish_snapshot)
+        return self._build_report(snapshot_name)
+
+    def run_coalesced(self, publish):
+        """
+        Run a publish of the repository, coalesced with its other publishes
+        if a coalesce window is configured, see coalesce.run. Publishes of
+        the repository and of the groups it belongs to all snapshot it
+        through here.
+
+        :param publish: runs the publish, returning the repository's snapshot
+        :type  publish: callable
+        :return: the repository's snapshot
+        :rtype:  str
+        """
+        window = configuration.get_float(
+            self.get_config(), constants.CONFIG_COALESCE_WINDOW,
+            constants.DEFAULT_COALESCE_WINDOW)
+        if not window:
+            return publish()
+        timeout = configuration.get_integer(
+            self.get_config(), constants.CONFIG_COALESCE_LEASE_TIMEOUT,
+            constants.DEFAULT_COALESCE_LEASE_TIMEOUT)
+        snapshot_name, self.coalesced = coalesce.run(
+            self.get_repo(), window, timeout, publish)
+        return snapshot_name
+
+    def publish_snapshot(self):
+        """
+        Snapshot the repository, add the snapshot to the repository's groups
+        if it changed, and prune the repository's expired snapshots.
+
+        :return: the repository's current snapshot
+        :rtype:  str
+        """
+        repo = self.get_repo()
+        now = time.time()
+        snapshot_name, created = self.snapshot(now)
+        joins_groups = self.joins_groups(created)
+        if joins_groups and self.defers_bookkeeping:
+            with self.phases.phase('groups'):
+                self.defer_bookkeeping(snapshot_name)
+                bookkeeping.schedule()
+        elif joins_groups:
+            with self.phases.phase('groups'):
+                group_coll = RepoGroup.get_collection()
+                result = group_coll.update(
+                    dict(repo_ids=repo.id),
+                    {'$addToSet': dict(repo_ids=snapshot_name)})
+                if isinstance(result, dict):
+                    self.phases.add_documents(result.get('n', 0))
+        if snapshot_name and configuration.get_boolean(
+                self.get_config(), constants.CONFIG_WRITE_MANIFEST,
+                constants.DEFAULT_WRITE_MANIFEST):
+            with self.phases.phase('manifest'):
+                self.manifest = self.write_manifest(snapshot_name)
+        if snapshot_name and configuration.get_boolean(
+                self.get_config(), constants.CONFIG_CHECK_QUERY_PLANS,
+                constants.DEFAULT_CHECK_QUERY_PLANS):
+            with self.phases.phase('query_plans'):
+                self.query_plan_warnings = indexes.check_plans(
+                    indexes.hot_queries(self._unit_query(repo.id), repo.id,
+                                        snapshot_name))
+        self.prune(now, snapshot_name)
+        self.log_phases(snapshot_name, created)
+        return snapshot_name
+
+    def joins_groups(self, created):
+        """
+        :param created: whether the repository's snapshot was created by
+                        this publish
+        :type  created: bool
+        :return: whether the repository's snapshot is to be added to the
+                 repository's groups: it was created or reused by this
+                 publish, and has associations group consumers can read.
+                 Delta snapshots join the groups once materialized.
+        :rtype:  bool
+        """
+        return bool(created or self.reused_snapshot) and \
+            not self.delta_snapshot
+
+    def snapshot(self, now):
+        """
+        Snapshot the repository, unless its units are the same as in its
+        last snapshot. The new snapshot is not added to any group.
+
+        :param now: timestamp of the new snapshot
+        :type  now: float
+        :return: the repository's current snapshot (None if it has none)
+                 and whether it was created by this call; an earlier
+                 snapshot with the same units is reused rather than
+                 duplicated, see reused_snapshot
+        :rtype:  tuple of (str, bool)
+        """
+        repo = self.get_repo()
+
+        units_coll = RepoContentUnit.get_collection()
+        snapshot_name = repo.notes.get(REPO_SNAPSHOT_NAME)
+
+        if snapshot_name and self._storage == constants.SNAPSHOT_STORAGE_DELTA:
+            snapshot_notes = delta.get_notes(snapshot_name)
+            interval = configuration.get_integer(
+                self.get_config(), constants.CONFIG_CHECKPOINT_INTERVAL,
+                constants.DEFAULT_CHECKPOINT_INTERVAL)
+            # Otherwise, a full checkpoint is due
+            if snapshot_notes and delta.depth(snapshot_notes) + 1 < interval:
+                return self._delta_snapshot(now, units_coll, snapshot_name,
+                                            snapshot_notes)
+
+        changed = self._diff_snapshot(units_coll, snapshot_name)
+        if changed is None:
+            return snapshot_name, False
+        units, unit_count, units_digest = changed
+        reused, units_digest = self._reuse(now, units_coll, snapshot_name,
+                                           units_digest)
+        if reused:
+            return reused, False
+        new_name, repo_obj, last_unit = self._resume_or_create(now,
+                                                               units_digest)
+        units_digest, merged, new_units = self._copy_snapshot(
+            units_coll, new_name, units, unit_count, units_digest, last_unit)
+        self._finish_snapshot(now, new_name, repo_obj, units_digest, merged,
+                              new_units)
+        return new_name, True
+
+    def _diff_snapshot(self, units_coll, snapshot_name):
+        """
+        Compare the repository's units with its current snapshot's.
+
+        :param snapshot_name: the repository's current snapshot, if any
+        :type  snapshot_name: str
+        :return: None if the units are the same, or if the repository is
+                 empty and has no snapshot; otherwise the units to copy in
+                 ascending order, their number, and their digest if it was
+                 computed
+        :rtype:  tuple
+        """
+        repo = self.get_repo()
+        if self._diff_engine == constants.DIFF_ENGINE_MERGE:
+            # Units are streamed from sorted cursors and never held in
+            # memory; the digest is computed while they are copied
+            with self.phases.phase('diff'):
+                unit_count = units_coll.count(self._unit_query(repo.id))
+                if snapshot_name:
+                    unchanged = not diff.differ(
+                        self._get_sorted_units(units_coll, repo.id),
+                        self._get_snapshot_units(units_coll, snapshot_name))
+                else:
+                    unchanged = not unit_count
+            if unchanged:
+                return None
+            return (self._get_sorted_units(units_coll, repo.id), unit_count,
+                    None)
+
+        unit_diff = None
+        if (snapshot_name and
+                self._diff_engine == constants.DIFF_ENGINE_AGGREGATE and
+                not delta.is_delta(self._get_delta_notes(snapshot_name))):
+            with self.phases.phase('diff'):
+                unit_diff = self._aggregate_diff(units_coll, repo.id,
+                                                 snapshot_name)
+            if unit_diff == diff.UnitDiff(added=0, removed=0):
+                return None
+
+        with self.phases.phase('fetch'):
+            if self._fetch_threads > 1:
+                units, = self._fetch_unit_sets(units_coll, [repo.id])
+            else:
+                units = self._units_to_set(
+                    self._get_units(units_coll, repo.id))
+            units_digest = UnitSetDigest.from_units(units)
+
+        # Create a snapshot if one did not exist before (snapshot_name
+        # is None) and the repo is not empty, or if the unit contents
+        # are different
+        if unit_diff is not None:
+            unchanged = False
+        elif snapshot_name:
+            with self.phases.phase('diff'):
+                unchanged = (units_digest == self._get_snapshot_digest(
+                    units_coll, snapshot_name))
+        else:
+            unchanged = not units
+        if unchanged:
+            return None
+        # The set iterates in ascending order, as checkpoints need
+        return units, len(units), units_digest
+
+    def _reuse(self, now, units_coll, snapshot_name, units_digest):
+        """
+        Look for a retained snapshot with the repository's units, see
+        _reuse_snapshot.
+
+        :param units_digest: digest of the repository's units, if computed
+        :type  units_digest: UnitSetDigest
+        :return: the snapshot reused (None if there is none) and the digest
+                 of the repository's units, if computed
+        :rtype:  tuple of (str, UnitSetDigest)
+        """
+        if units_digest is not None:
+            reused, _digest = self._reuse_snapshot(now, snapshot_name,
+                                                   lambda: units_digest)
+            return reused, units_digest
+
+        # The digest is only computed beforehand if there are retained
+        # snapshots it could match
+        def get_digest():
+            with self.phases.phase('fetch'):
+                return UnitSetDigest.from_units(self._get_sorted_units(
+                    units_coll, self.get_repo().id))
+        return self._reuse_snapshot(now, snapshot_name, get_digest)
+
+    def _resume_or_create(self, now, units_digest):
+        """
+        Resume an incomplete snapshot of the same units, see
+        _resume_snapshot, or create a new snapshot.
+
+        :return: the snapshot, its model, and the last unit key already
+                 written to it, None for a new snapshot
+        :rtype:  tuple
+        """
+        resumed = self._resume_snapshot(units_digest)
+        if resumed:
+            return resumed
+        new_name = snapshot_name_for(self.get_repo().id, now)
+        repo_obj = self._create_snapshot(
+            new_name, self._snapshot_notes(new_name, now, units_digest))
+        return new_name, repo_obj, None
+
+    def _copy_snapshot(self, units_coll, new_name, units, unit_count,
+                       units_digest, last_unit):
+        """
+        Write the associations of a new snapshot, on the server if the copy
+        engine says so and the server can, otherwise from the units read.
+
+        :param units: the repository's units, in ascending order
+        :type  units: iterable of UnitKey
+        :param unit_count: number of units
+        :type  unit_count: int
+        :param units_digest: digest of the units, if computed
+        :type  units_digest: UnitSetDigest
+        :param last_unit: last unit key already written, if resumed
+        :type  last_unit: UnitKey
+        :return: the digest of the units copied (None if not known), the
+                 counts of the units copied on the server (None if copied
+                 from the worker), and the unit keys copied if collected
+        :rtype:  tuple
+        """
+        with checkpoint.owned(new_name, self._owner), \
+                self.phases.phase('copy'):
+            merged = None
+            if self._copy_engine == constants.COPY_ENGINE_SERVER:
+                merged = self._merge_units(units_coll, new_name)
+            new_units = units if isinstance(units, UnitKeySet) else None
+            if merged is None:
+                if units_digest is None:
+                    units_digest = UnitSetDigest()
+                    units = units_digest.passthrough(units)
+                if new_units is None and self._unit_cache is not None:
+                    # Streamed units are collected for the cache as they
+                    # are copied
+                    builder = UnitKeySetBuilder()
+                    units = builder.passthrough(units)
+                    new_units = builder
+                if last_unit is not None:
+                    # Units up to the checkpoint are still counted in the
+                    # digest
+                    units = (x for x in units if x > last_unit)
+                self._copy_units(units_coll, new_name, units, unit_count,
+                                 checkpoints=True)
+            elif units_digest is None or units_digest.counts != merged:
+                # The units were not read, or changed since they were. The
+                # server cannot compute the digest, and reading what was
+                # copied back into the worker would undo the point of
+                # copying on the server: the snapshot is left without a
+                # digest, computed by the first publish that needs it
+                units_digest = None
+        if isinstance(new_units, UnitKeySetBuilder):
+            new_units = new_units.build_set()
+        return units_digest, merged, new_units
+
+    def _finish_snapshot(self, now, new_name, repo_obj, units_digest, merged,
+                         new_units):
+        """
+        Record the digest and counts of a new snapshot whose associations
+        are written, mark it complete, index it and cache its units.
+        """
+        if units_digest is not None:
+            counts = units_digest.counts
+            repo_obj.notes[REPO_SNAPSHOT_DIGEST] = units_digest.hexdigest()
+        else:
+            counts = merged
+            repo_obj.notes.pop(REPO_SNAPSHOT_DIGEST, None)
+        repo_obj.notes[REPO_SNAPSHOT_UNIT_COUNTS] = counts
+        self._save_counts(repo_obj, counts)
+        self._index_snapshot(new_name, now, units_digest, counts)
+        if merged is None or new_units is not None and \
+                new_units.counts() == merged:
+            # Only the units the snapshot was copied from describe it
+            self._cache_units(new_name, new_units)
+
+    def restore(self, snapshot_id):
+        """
+        Restore the repository to one of its snapshots. Only the units that
+        differ are removed from or added to the repository, in batches, and
+        its unit counts are adjusted rather than recomputed.
+
+        :param snapshot_id: snapshot to restore
+        :type  snapshot_id: str
+        :raises PulpCodedException: if snapshot_id is not a snapshot of the
+                                    repository
+        """
+        repo = self.get_repo()
+        snapshot_notes = delta.get_notes(snapshot_id)
+        if not (snapshot_id.startswith('%s__' % repo.id) and
+                is_snapshot(snapshot_id, snapshot_notes)):
+            raise PulpCodedException(error_code=error_codes.SNAP0101,
+                                     repo=repo.id, snapshot=snapshot_id)
+        units_coll = RepoContentUnit.get_collection()
+        with self.phases.phase('diff'):
+            added, removed = split_changes(self._diff_units(
+                units_coll, (snapshot_id, snapshot_notes), (repo.id, {})))
+        self.units_diff = dict(added=len(added), removed=len(removed))
+        _LOG.info(_("Restoring %(repo)s to %(snap)s: adding %(added)d "
+                    "units, removing %(removed)d") %
+                  {'repo': repo.id, 'snap': snapshot_id,
+                   'added': len(added), 'removed': len(removed)})
+        count_changes = added.counts()
+        for unit_type_id, count in removed.counts().items():
+            count_changes[unit_type_id] = \
+                count_changes.get(unit_type_id, 0) - count
+
+        collection, batch_size, retries = self._write_options(units_coll)
+        self.total_units += len(added) + len(removed)
+        with self.phases.phase('remove'):
+            restore.remove_units(collection, repo.id, removed, batch_size,
+                                 callback=self._units_copied)
+        with self.phases.phase('copy'):
+            documents = (RepoContentUnit(repo_id=repo.id,
+                                         unit_id=unit.unit_id,
+                                         unit_type_id=unit.unit_type_id)
+                         for unit in added)
+            bulk.insert(collection, documents, batch_size, retries=retries,
+                        callback=self._units_copied)
+        with self.phases.phase('counts'):
+            restore.update_repo(repo.id, {REPO_SNAPSHOT_NAME: snapshot_id},
+                                count_changes, bool(added), bool(removed))
+            self.phases.add_documents(1)
+        repo.notes[REPO_SNAPSHOT_NAME] = snapshot_id
+
+    def _delta_snapshot(self, now, units_coll, snapshot_name,
+                        snapshot_notes):
+        """
+        Snapshot the repository as the units added and removed since its
+        last snapshot, which becomes the new snapshot's base. Only the
+        changes are held in memory and written.
+        """
+        repo = self.get_repo()
+        with self.phases.phase('diff'):
+            added, removed = split_changes(self._diff_units(
+                units_coll, (repo.id, {}), (snapshot_name, snapshot_notes)))
+        if not (added or removed):
+            return snapshot_name, False
+        # The digest and counts are updated from the base's rather than
+        # computed over the whole repository
+        units_digest = self._get_snapshot_digest(units_coll, snapshot_name)
+        for unit in added:
+            units_digest.add(unit.unit_type_id, unit.unit_id)
+        for unit in removed:
+            units_digest.remove(unit.unit_type_id, unit.unit_id)
+        self.units_diff = dict(added=len(added), removed=len(removed))
+        reused, _digest = self._reuse_snapshot(now, snapshot_name,
+                                               lambda: units_digest)
+        if reused:
+            return reused, False
+        # Changes are only written in full; a delta snapshot left incomplete
+        # is deleted rather than resumed
+        self._resume_snapshot(units_digest, resumable=False)
+
+        new_name = snapshot_name_for(repo.id, now)
+        notes = self._snapshot_notes(new_name, now, units_digest)
+        notes[delta.REPO_SNAPSHOT_BASE] = snapshot_name
+        notes[delta.REPO_SNAPSHOT_DEPTH] = delta.depth(snapshot_notes) + 1
+        repo_obj = self._create_snapshot(new_name, notes)
+        with checkpoint.owned(new_name, self._owner), \
+                self.phases.phase('copy'):
+            collection, batch_size, retries = self._write_options(
+                delta.get_collection())
+            self.total_units += len(added) + len(removed)
+            # The two sets do not overlap, so diffing them yields every
+            # change in order
+            delta.write_changes(collection, new_name,
+                                added.diff(removed), batch_size,
+                                retries=retries, callback=self._units_copied)
+        # Its unit counts are set when its associations are written
+        self._save_counts(repo_obj)
+        self.delta_snapshot = True
+        self._index_snapshot(new_name, now, units_digest)
+        base_units = self._cached_units(snapshot_name)
+        if base_units is not None:
+            self._cache_units(new_name, UnitKeySet(delta.apply_changes(
+                base_units, added.diff(removed))))
+        return new_name, True
+
+    def _reuse_snapshot(self, now, snapshot_name, get_digest):
+        """
+        Look for a retained snapshot of the repository, other than its
+        current one, with the same units, so a repository going back to an
+        earlier state goes back to that state's snapshot. The snapshot
+        found is indexed again as current from now on.
+
+        :param now: timestamp of the publish
+        :type  now: float
+        :param snapshot_name: the repository's current snapshot
+        :type  snapshot_name: str
+        :param get_digest: returns the digest of the repository's units;
+                           only called if there are snapshots to compare with
+        :type  get_digest: callable
+        :return: the snapshot (None if there is none) and the digest, if
+                 it was computed
+        :rtype:  tuple of (str, UnitSetDigest)
+        """
+        repo = self.get_repo()
+        others = [x for x in index.get_snapshots(repo.id)
+                  if x.digest and x.snapshot_id != snapshot_name]
+        if not others:
+            return None, None
+        units_digest = get_digest()
+        hexdigest = units_digest.hexdigest()
+        units = sum(units_digest.counts.values())
+        # Newest first
+        for entry in reversed(others):
+            if entry.digest != hexdigest or entry.units != units:
+                continue
+            # The index may be stale, the snapshot's own notes decide
+            notes = delta.get_notes(entry.snapshot_id)
+            if not (is_snapshot(entry.snapshot_id, notes) and
+                    units_digest == UnitSetDigest(
+                        notes.get(REPO_SNAPSHOT_DIGEST),
+                        notes.get(REPO_SNAPSHOT_UNIT_COUNTS))):
+                continue
+            _LOG.info(_("%(repo)s has the same units as its snapshot "
+                        "%(snap)s, reusing it") %
+                      {'repo': repo.id, 'snap': entry.snapshot_id})
+            self.reused_snapshot = entry.snapshot_id
+            self.delta_snapshot = delta.is_delta(notes)
+            self._index_snapshot(entry.snapshot_id, now, units_digest)
+            return entry.snapshot_id, units_digest
+        return None, units_digest
+
+    def _resume_snapshot(self, units_digest, resumable=True):
+        """
+        Look for a snapshot of the repository whose publish died while
+        writing its associations. The newest one is resumed if it was
+        taken of the same units; the others are deleted.
+
+        Snapshots still owned by a live publish, such as that of a group
+        snapshotting the repository, are left alone. The others are taken
+        over first, so no two publishes resume or delete the same one.
+
+        :param units_digest: digest of the repository's units, if known
+        :type  units_digest: UnitSetDigest
+        :param resumable: whether a snapshot may be resumed at all
+        :type  resumable: bool
+        :return: the snapshot, its model, and the last unit key written to
+                 it; None if no snapshot is resumed
+        :rtype:  tuple
+        """
+        repo = self.get_repo()
+        unit_filter = checkpoint.filter_key(
+            configuration.get_unit_filter(self.get_config()))
+        resumed = None
+        abandoned = []
+        now = checkpoint.clock()
+        for snapshot_id, notes in checkpoint.find_incomplete(repo.id):
+            if not is_snapshot(snapshot_id, notes):
+                continue
+            if checkpoint.is_owned(notes, now):
+                _LOG.info(_("Snapshot %(snap)s of %(repo)s is being written "
+                            "by another publish") %
+                          {'repo': repo.id, 'snap': snapshot_id})
+                continue
+            if not checkpoint.take_over(snapshot_id, notes, self._owner):
+                continue
+            if (resumable and resumed is None and
+                    not delta.is_delta(notes) and
+                    notes.get(checkpoint.REPO_SNAPSHOT_FILTER) == unit_filter
+                    and self._same_units(notes, units_digest)):
+                resumed = snapshot_id, notes
+            else:
+                abandoned.append(snapshot_id)
+        if abandoned:
+            _LOG.info(_("Deleting incomplete snapshots %(snaps)s of "
+                        "%(repo)s") %
+                      {'repo': repo.id, 'snaps': ', '.join(abandoned)})
+            batch_size, retries = self._copy_options()
+            retention.prune(abandoned, constants.DEFAULT_PRUNE_BATCH_SIZE, 0,
+                            batch_size, retries)
+        if resumed is None:
+            return None
+        snapshot_id, notes = resumed
+        last_unit = checkpoint.last_unit(notes)
+        _LOG.info(_("Resuming incomplete snapshot %(snap)s of %(repo)s "
+                    "after %(unit)s") %
+                  {'repo': repo.id, 'snap': snapshot_id, 'unit': last_unit})
+        repo_obj = RepoModel.objects(repo_id=snapshot_id).first()
+        return snapshot_id, repo_obj, last_unit
+
+    def _same_units(self, notes, units_digest):
+        """
+        :return: whether an incomplete snapshot was taken of the units the
+                 repository has now: its digest matches, or if either
+                 digest is not known, no units were added to or removed
+                 from the repository since
+        :rtype:  bool
+        """
+        if units_digest is not None and REPO_SNAPSHOT_DIGEST in notes:
+            return notes[REPO_SNAPSHOT_DIGEST] == units_digest.hexdigest()
+        return coalesce.unchanged_since(self.get_repo(),
+                                        notes.get(REPO_SNAPSHOT_TIMESTAMP, 0))
+
+    def _snapshot_notes(self, new_name, now, units_digest=None):
+        repo = self.get_repo()
+        notes = {}
+        notes[REPO_SNAPSHOT_TIMESTAMP] = now
+        if '_repo-type' in repo.notes:
+            notes['_repo-type'] = repo.notes['_repo-type']
+        notes[REPO_SNAPSHOT_NAME] = new_name
+        notes[REPO_SNAPSHOT_TIMESTAMP] = now
+        if units_digest is not None:
+            notes[REPO_SNAPSHOT_DIGEST] = units_digest.hexdigest()
+            notes[REPO_SNAPSHOT_UNIT_COUNTS] = units_digest.counts
+        checkpoint.start(notes,
+                         configuration.get_unit_filter(self.get_config()),
+                         self._owner)
+        return notes
+
+    def _create_snapshot(self, new_name, notes):
+        """
+        Create the snapshot repository, with the same importer type as the
+        repository. Delta snapshots get a snapshot distributor, so that
+        publishing them writes their associations; full snapshots have no
+        distributors.
+        """
+        repo = self.get_repo()
+        distributors = []
+        if delta.is_delta(notes):
+            distributors.append(dict(
+                distributor_type_id=ids.TYPE_ID_DISTRIBUTOR_SNAPSHOT,
+                distributor_id=ids.TYPE_ID_DISTRIBUTOR_SNAPSHOT,
+                distributor_config={}, auto_publish=False))
+        # Fetch the repo's existing importers
+
+        with self.phases.phase('create_repo'):
+            repo_importer = RepoImporter.objects.filter(
+                repo_id=repo.id).first()
+            if repo_importer is not None:
+                importer_type_id = repo_importer['importer_type_id']
+            else:
+                importer_type_id = None
+
+            repo_obj = repo_controller.create_repo(
+                new_name, notes=notes,
+                importer_type_id=importer_type_id,
+                importer_repo_plugin_config={},
+                distributor_list=distributors)
+            self.phases.add_documents(1)
+        return repo_obj
+
+    @property
+    def defers_bookkeeping(self):
+        """
+        Whether new snapshots are added to groups, and given their unit
+        counts, by a background task rather than by the publish.
+        """
+        return configuration.get_boolean(
+            self.get_config(), constants.CONFIG_DEFER_BOOKKEEPING,
+            constants.DEFAULT_DEFER_BOOKKEEPING)
+
+    def defer_bookkeeping(self, snapshot_name):
+        """
+        Leave adding the repository's snapshot to its groups, and setting
+        the unit counts of a snapshot created by this publish, to the
+        background task. The caller schedules the task.
+        """
+        bookkeeping.defer(self.get_repo().id, snapshot_name,
+                          self.deferred_counts)
+
+    def _save_counts(self, repo_obj, counts=None):
+        with self.phases.phase('counts'):
+            # The per-type counts are already known, there is no need to
+            # have them aggregated from the new associations. A delta
+            # snapshot only gets them once materialized.
+            if counts is not None and self.defers_bookkeeping:
+                self.deferred_counts = dict(counts)
+            elif counts is not None:
+                repo_obj.content_unit_counts = dict(counts)
+            # All associations are written, the snapshot is complete
+            checkpoint.finish(repo_obj.notes)
+            repo_obj.save()
+            self.phases.add_documents(1)
+
+    def _index_snapshot(self, snapshot_name, now, units_digest, counts=None):
+        # Without a digest, only the counts are known
+        if counts is None:
+            counts = units_digest.counts
+        with self.phases.phase('index'):
+            index.add(self.get_repo().id, index.SnapshotEntry(
+                snapshot_id=snapshot_name, timestamp=now,
+                digest=units_digest.hexdigest() if units_digest else None,
+                units=sum(counts.values())))
+            self.phases.add_documents(1)
+
+    def write_manifest(self, snapshot_name):
+        """
+        Write a manifest of a snapshot's units to the configured directory,
+        unless there already is one: snapshots never change once complete.
+
+        :return: path of the manifest, or None if no directory is configured
+        :rtype:  str
+        """
+        directory = self.get_config().get(constants.CONFIG_MANIFEST_DIR)
+        if not directory:
+            # Only an override config can get here, see validate_config
+            _LOG.warning(_("Not writing a manifest of %(snap)s: %(k)s is not "
+                           "set") % {'snap': snapshot_name,
+                                     'k': constants.CONFIG_MANIFEST_DIR})
+            return None
+        path = os.path.join(directory, manifest.file_name(snapshot_name))
+        if os.path.exists(path):
+            return path
+        snapshot = RepoModel.objects(repo_id=snapshot_name).first()
+        notes = snapshot.notes if snapshot is not None else {}
+        units = self._cached_units(snapshot_name)
+        if units is None:
+            units = UnitKeySet(self._get_snapshot_units(
+                RepoContentUnit.get_collection(), snapshot_name, notes))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        manifest.write(path, units, snapshot_id=snapshot_name,
+                       repo_id=self.get_repo().id,
+                       timestamp=notes.get(REPO_SNAPSHOT_TIMESTAMP),
+                       digest=notes.get(REPO_SNAPSHOT_DIGEST),
+                       repo_type=notes.get('_repo-type'))
+        self.phases.add_documents(len(units))
+        return path
+
+    def _materialize(self, snapshot_id, notes=None):
+        batch_size, retries = self._copy_options()
+        return delta.materialize(snapshot_id, batch_size, retries=retries,
+                                 notes=notes)
+
+    def prune(self, now, snapshot_name):
+        """
+        Expire the repository's snapshots that the configured retention
+        policy no longer retains. Neither the repository's current snapshot
+        nor the one named in its notes are ever expired. Expired snapshots
+        leave the index at once, so that no publish reuses them, and are
+        deleted by the bookkeeping task.
+
+        :param now: current time
+        :type  now: float
+        :param snapshot_name: the repository's current snapshot
+        :type  snapshot_name: str
+        """
+        policy = retention.get_policy(self.get_config())
+        if not policy:
+            return
+        with self.phases.phase('prune'):
+            self._prune(now, snapshot_name, policy)
+
+    def _prune(self, now, snapshot_name, policy):
+        repo = self.get_repo()
+        keep = set([snapshot_name, repo.notes.get(REPO_SNAPSHOT_NAME)])
+        expired = [x for x in retention.expired(
+            retention.find_snapshots(repo.id), now, **policy)
+            if x not in keep]
+        if not expired:
+            return
+        config = self.get_config()
+        batch_size, retries = self._copy_options()
+        index.remove(expired)
+        bookkeeping.defer_prune(
+            expired,
+            configuration.get_integer(config,
+                                      constants.CONFIG_PRUNE_BATCH_SIZE,
+                                      constants.DEFAULT_PRUNE_BATCH_SIZE),
+            configuration.get_float(config, constants.CONFIG_PRUNE_DELAY,
+                                    constants.DEFAULT_PRUNE_DELAY),
+            batch_size, retries)
+        bookkeeping.schedule()
+        self.phases.add_documents(len(expired))
+        self.pruned_snapshots.extend(expired)
+
+    def log_phases(self, snapshot_name, created):
+        """
+        Log the time spent in each phase of the publish, on a single line
+        of key=value pairs.
+        """
+        _LOG.info("snapshot_publish repo=%s snapshot=%s created=%s %s",
+                  self.get_repo().id, snapshot_name, created,
+                  self.phases.format())
+
+    def _copy_units(self, collection, repo_id, units, count,
+                    checkpoints=False):
+        """
+        Associate units with a repository, using batched bulk inserts.
+
+        Progress is reported as each batch is written. With checkpoints, the
+        last unit key of each batch is recorded in the repository's notes
+        once the batch is written, so an interrupted copy can be resumed.
+
+        :param collection: the repo content units collection
+        :type  collection: pymongo.collection.Collection
+        :param repo_id: repository to associate the units with
+        :type  repo_id: str
+        :param units: units to associate
+        :type  units: iterable of REPO_UNIT
+        :param count: number of units
+        :type  count: int
+        :param checkpoints: whether to record checkpoints; units must then
+                            be in ascending order
+        :type  checkpoints: bool
+        """
+        if not count:
+            return
+        collection, batch_size, retries = self._write_options(collection)
+
+        self.total_units += count
+        last = [None]
+
+        def documents():
+            for unit in units:
+                last[0] = unit
+                yield RepoContentUnit(repo_id=repo_id,
+                                      unit_id=unit.unit_id,
+                                      unit_type_id=unit.unit_type_id)
+
+        def copied(batch_count):
+            # Batches are read lazily, the last unit read ends the batch
+            if checkpoints and not checkpoint.advance(repo_id, last[0],
+                                                      self._owner):
+                raise PulpCodedException(error_code=error_codes.SNAP0102,
+                                         repo=self.get_repo().id,
+                                         snapshot=repo_id)
+            self._units_copied(batch_count)
+        bulk.insert(collection, documents(), batch_size, retries=retries,
+                    callback=copied)
+
+    def _merge_units(self, collection, repo_id):
+        """
+        Copy the repository's unit associations to a snapshot on the
+        database server.
+
+        :return: number of units of each type copied, or None if the server
+                 could not copy them and they have to be copied by the
+                 worker
+        :rtype:  dict
+        """
+        collection, _batch_size, _retries = self._write_options(collection)
+        if not bulk.supports_merge_copy(collection):
+            _LOG.info(_("The database server cannot copy units to %(snap)s, "
+                        "copying them through the worker") %
+                      {'snap': repo_id})
+            return None
+        source = self._unit_query(self.get_repo().id)
+        try:
+            counts = bulk.merge_copy(collection, source, repo_id)
+        except OperationFailure as e:
+            _LOG.warning(_("Unable to copy units to %(snap)s on the server, "
+                           "copying them through the worker: %(err)s") %
+                         {'snap': repo_id, 'err': e})
+            return None
+        count = sum(counts.values())
+        self.total_units += count
+        self._units_copied(count)
+        return counts
+
+    def _write_options(self, collection):
+        """
+        :return: the collection with the configured write concern, and the
+                 configured bulk insert batch size and number of retries
+        :rtype:  tuple
+        """
+        config = self.get_config()
+        write_concern = config.get(constants.CONFIG_COPY_WRITE_CONCERN)
+        if write_concern is not None:
+            if isinstance(write_concern, basestring) and \
+                    write_concern.isdigit():
+                write_concern = int(write_concern)
+            collection = collection.with_options(
+                write_concern=WriteConcern(w=write_concern))
+        batch_size, retries = self._copy_options()
+        return collection, batch_size, retries
+
+    def _copy_options(self):
+        """
+        :return: the configured bulk insert batch size and number of retries
+        :rtype:  tuple
+        """
+        config = self.get_config()
+        batch_size = configuration.get_integer(
+            config, constants.CONFIG_COPY_BATCH_SIZE,
+            constants.DEFAULT_COPY_BATCH_SIZE)
+        retries = configuration.get_integer(
+            config, constants.CONFIG_COPY_RETRIES,
+            constants.DEFAULT_COPY_RETRIES)
+        return batch_size, retries
+
+    def _units_copied(self, count):
+        self.phases.add_documents(count)
+        self.progress_successes += count
+        self.report_progress()
+
+    @property
+    def _diff_engine(self):
+        return self.get_config().get(constants.CONFIG_DIFF_ENGINE,
+                                     constants.DEFAULT_DIFF_ENGINE)
+
+    @property
+    def _copy_engine(self):
+        return self.get_config().get(constants.CONFIG_COPY_ENGINE,
+                                     constants.DEFAULT_COPY_ENGINE)
+
+    @property
+    def _unit_cache(self):
+        return cache.get_cache(configuration.get_integer(
+            self.get_config(), constants.CONFIG_UNIT_CACHE_SIZE,
+            constants.DEFAULT_UNIT_CACHE_SIZE))
+
+    @property
+    def _fetch_threads(self):
+        return configuration.get_integer(
+            self.get_config(), constants.CONFIG_FETCH_THREADS,
+            constants.DEFAULT_FETCH_THREADS)
+
+    @property
+    def _storage(self):
+        return self.get_config().get(constants.CONFIG_SNAPSHOT_STORAGE,
+                                     constants.DEFAULT_SNAPSHOT_STORAGE)
+
+    def _aggregate_diff(self, collection, repo_id, snapshot_name):
+        """
+        Compare the repository with its snapshot on the database server.
+
+        :return: the difference, or None if the server could not compute it
+                 and the units have to be compared in the worker
+        :rtype:  pulp_snapshot.plugins.distributors.diff.UnitDiff
+        """
+        try:
+            ret = diff.aggregate_diff(
+                collection, repo_id, snapshot_name,
+                configuration.get_unit_filter(self.get_config()))
+        except OperationFailure as e:
+            _LOG.warning(_("Unable to compare %(repo)s with %(snap)s on the "
+                           "server, comparing units locally: %(err)s") %
+                         {'repo': repo_id, 'snap': snapshot_name, 'err': e})
+            return None
+        _LOG.info(_("%(repo)s: %(added)d units added, %(removed)d removed "
+                    "since %(snap)s") %
+                  {'repo': repo_id, 'snap': snapshot_name,
+                   'added': ret.added, 'removed': ret.removed})
+        self.units_diff = ret._asdict()
+        return ret
+
+    def _get_snapshot_digest(self, collection, snapshot_name):
+        """
+        Return the digest recorded in a snapshot's notes.
+
+        Snapshots created before digests were recorded get theirs computed
+        from their unit associations, and stored for the next publish.
+        """
+        snapshot = RepoModel.objects(repo_id=snapshot_name).first()
+        notes = snapshot.notes if snapshot is not None else {}
+        if REPO_SNAPSHOT_DIGEST in notes:
+            return UnitSetDigest(notes[REPO_SNAPSHOT_DIGEST],
+                                 notes.get(REPO_SNAPSHOT_UNIT_COUNTS))
+        ret = UnitSetDigest()
+        for unit in self._get_units(collection, snapshot_name):
+            ret.add(unit['unit_type_id'], unit['unit_id'])
+        if snapshot is not None:
+            _LOG.info(_("Recording digest for snapshot %(repo)s") %
+                      {'repo': snapshot_name})
+            self._record_digest(snapshot_name, ret)
+        return ret
+
+    @classmethod
+    def _record_digest(cls, repo_id, units_digest):
+        update = {
+            'set__notes__%s' % REPO_SNAPSHOT_DIGEST: units_digest.hexdigest(),
+            'set__notes__%s' % REPO_SNAPSHOT_UNIT_COUNTS: units_digest.counts,
+        }
+        RepoModel.objects(repo_id=repo_id).update_one(**update)
+
+    def _get_sorted_units(self, collection, repo_id):
+        """
+        Stream the unit keys associated with a repository, in ascending
+        order. Each unit type is read with its own query sorted by unit id,
+        which the unique index of unit associations serves.
+        """
+        for unit_type_id in sorted(collection.distinct(
+                'unit_type_id', self._unit_query(repo_id))):
+            for x in self._get_units(collection, repo_id,
+                                     sort=diff.UNIT_ID_ORDER,
+                                     unit_type_id=unit_type_id):
+                yield REPO_UNIT(x['unit_type_id'], x['unit_id'])
+
+    def _get_delta_notes(self, snapshot_name):
+        """
+        :return: the notes of a snapshot, as far as needed to tell whether it
+                 is a delta snapshot. They are only looked up when delta
+                 storage is configured; a snapshot left over from delta
+                 storage is otherwise seen as changed, and a full snapshot
+                 is taken.
+        :rtype:  dict
+        """
+        if self._storage != constants.SNAPSHOT_STORAGE_DELTA:
+            return {}
+        return delta.get_notes(snapshot_name)
+
+    def _get_snapshot_units(self, collection, snapshot_name, notes=None):
+        """
+        Stream the unit keys of a snapshot in ascending order, applying the
+        changes of delta snapshots to their base.
+        """
+        if snapshot_name != self.get_repo().id:
+            units = self._cached_units(snapshot_name)
+            if units is not None:
+                return iter(units)
+        if notes is None:
+            notes = self._get_delta_notes(snapshot_name)
+        if not delta.is_delta(notes):
+            return self._get_sorted_units(collection, snapshot_name)
+        batch_size = configuration.get_integer(
+            self.get_config(), constants.CONFIG_FETCH_BATCH_SIZE,
+            constants.DEFAULT_FETCH_BATCH_SIZE)
+        return (REPO_UNIT(*x) for x in delta.logical_units(
+            collection, snapshot_name, notes, batch_size))
+
+    def _diff_units(self, collection, new, old):
+        """
+        Compare the units of two repositories, given as (repository id,
+        notes) pairs; the notes tell whether a snapshot is a delta.
+
+        With fetch threads, both are read into sets concurrently;
+        otherwise they are streamed from sorted cursors.
+
+        :return: generator of (diff.ADDED or diff.REMOVED, unit key)
+        :rtype:  generator
+        """
+        if self._fetch_threads > 1:
+            new_units, old_units = self._fetch_unit_sets(
+                collection, [new[0], old[0]], dict([new, old]))
+            return new_units.diff(old_units)
+        return diff.merge_diff(
+            self._get_snapshot_units(collection, *new),
+            self._get_snapshot_units(collection, *old))
+
+    def _fetch_unit_sets(self, collection, repo_ids, notes=None):
+        """
+        Read the unit keys of repositories with one query per repository
+        and unit type, running up to fetch_threads queries at a time.
+        Delta snapshots are read as a single stream each.
+
+        :param repo_ids: repositories to read
+        :type  repo_ids: list of str
+        :param notes: notes of the snapshots among repo_ids, keyed by id;
+                      looked up when needed if not given
+        :type  notes: dict
+        :return: the units of each repository, in the order of repo_ids
+        :rtype:  list of UnitKeySet
+        """
+        notes = notes or {}
+        tasks = []
+        cached = {}
+        for position, repo_id in enumerate(repo_ids):
+            if repo_id == self.get_repo().id:
+                repo_notes = {}
+            else:
+                cached[position] = self._cached_units(repo_id)
+                if cached[position] is not None:
+                    continue
+                repo_notes = notes.get(repo_id)
+                if repo_notes is None:
+                    repo_notes = self._get_delta_notes(repo_id)
+            if delta.is_delta(repo_notes):
+                tasks.append((position, partial(
+                    self._get_snapshot_units, collection, repo_id,
+                    repo_notes)))
+                continue
+            for unit_type_id in sorted(collection.distinct(
+                    'unit_type_id', self._unit_query(repo_id))):
+                tasks.append((position, partial(
+                    self._get_units_by_type, collection, repo_id,
+                    unit_type_id)))
+
+        def fetch(task):
+            return task[0], UnitKeySet(task[1]())
+        if tasks:
+            pool = ThreadPool(min(self._fetch_threads, len(tasks)))
+            try:
+                results = pool.map(fetch, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = []
+        return [cached.get(x) or
+                UnitKeySet.combine(units for position, units in results
+                                   if position == x)
+                for x in range(len(repo_ids))]
+
+    def _cached_units(self, snapshot_id):
+        """
+        :return: the unit keys of a snapshot, if the cache has them
+        :rtype:  UnitKeySet
+        """
+        unit_cache = self._unit_cache
+        if unit_cache is None:
+            return None
+        return unit_cache.get(snapshot_id)
+
+    def _cache_units(self, snapshot_id, units):
+        """
+        Cache the unit keys of a snapshot that is complete.
+        """
+        unit_cache = self._unit_cache
+        if unit_cache is not None and units is not None:
+            unit_cache.put(snapshot_id, units)
+
+    def _get_units_by_type(self, collection, repo_id, unit_type_id):
+        return ((x['unit_type_id'], x['unit_id'])
+                for x in self._get_units(collection, repo_id,
+                                         unit_type_id=unit_type_id))
+
+    def _get_units(self, collection, repo_id, sort=None, unit_type_id=None):
+        """
+        Stream the unit keys associated with a repository, optionally only
+        those of one unit type.
+
+        Documents are yielded as the cursor returns them, so the caller
+        decides what (if anything) is held in memory. The number of
+        documents and bytes read is accumulated in units_read.
+        """
+        batch_size = configuration.get_integer(
+            self.get_config(), constants.CONFIG_FETCH_BATCH_SIZE,
+            constants.DEFAULT_FETCH_BATCH_SIZE)
+        kwargs = dict(batch_size=batch_size)
+        if sort is not None:
+            kwargs.update(sort=sort)
+        query = self._unit_query(repo_id)
+        if unit_type_id is not None:
+            query['unit_type_id'] = unit_type_id
+        # A copy, as queries may run concurrently and drivers are free to
+        # modify the projection they are given
+        cursor = collection.find(query, dict(UNIT_KEY_PROJECTION), **kwargs)
+        documents = nbytes = 0
+        try:
+            for unit in cursor:
+                documents += 1
+                nbytes += _bson_size(unit)
+                yield unit
+        finally:
+            with self._read_lock:
+                self.units_read['documents'] += documents
+                self.units_read['bytes'] += nbytes
+                self.phases.add_documents(documents)
+            _LOG.debug("Read %d unit associations (%d bytes) for %s",
+                       documents, nbytes, repo_id)
+
+    def _unit_query(self, repo_id):
+        """
+        Select the unit associations of a repository. Those of the
+        repository being published are restricted to the configured unit
+        types and criteria; its snapshots only hold those already.
+        """
+        query = dict(repo_id=repo_id)
+        if repo_id == self.get_repo().id:
+            query.update(configuration.get_unit_filter(self.get_config()))
+        return query
+
+    @classmethod
+    def _units_to_set(cls, units):
+        return UnitKeySet.from_documents(units)
+
+    def _build_report(self, repo_id):
+        self.repo_snapshot = repo_id
+
+    def get_progress_report_summary(self):
+        ret = super(Publisher, self).get_progress_report_summary()
+        if self.repo_snapshot:
+            ret.update(repository_snapshot=self.repo_snapshot)
+        ret.update(units_read=dict(self.units_read))
+        ret.update(phases=self.phases.as_dict())
+        if self.units_diff is not None:
+            ret.update(units_diff=dict(self.units_diff))
+        if self.reused_snapshot:
+            ret.update(reused_snapshot=True)
+        if self.coalesced:
+            ret.update(coalesced=True)
+        if self.pruned_snapshots:
+            ret.update(pruned_snapshots=list(self.pruned_snapshots))
+        if self.manifest:
+            ret.update(manifest=self.manifest)
+        if self.query_plan_warnings:
+            ret.update(query_plan_warnings=dict(self.query_plan_warnings))
+        unit_cache = self._unit_cache
+        if unit_cache is not None:
+            ret.update(unit_cache=unit_cache.stats())
+        return ret
+
+
+def _bson_size(document):
+    """
+    Compute the size of a projected unit key document as it was sent over
+    the wire: an int32 length, one string element per field and a trailing
+    NUL.
+    """
+    size = 5
+    for key, value in document.items():
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        # type byte, NUL-terminated name, int32 length, NUL-terminated value
+        size += len(key) + len(str(value)) + 7
+    return size
@@ -0,0 +1,67 @@
+import itertools
+from operator import itemgetter
+
+from pulp.common import dateutils
+from pulp.server.db.model import Repository as RepoModel
+from . import bulk
+
+
+def remove_units(collection, repo_id, units, batch_size, callback=None):
+    """
+    Remove unit associations from a repository, in batches. Every batch is
+    removed with one delete per unit type.
+
+    :param collection: the repo content units collection
+    :type  collection: pymongo.collection.Collection
+    :param repo_id: repository to remove the units from
+    :type  repo_id: str
+    :param units: keys of the units to remove, in ascending order
+    :type  units: iterable of tuple
+    :param batch_size: number of units per batch
+    :type  batch_size: int
+    :param callback: called with the number of units in each batch once it
+                     is removed
+    :type  callback: callable
+    :return: number of associations removed
+    :rtype:  int
+    """
+    total = 0
+    for batch in bulk.batches(units, batch_size):
+        for unit_type_id, keys in itertools.groupby(batch, itemgetter(0)):
+            result = collection.delete_many({
+                'repo_id': repo_id,
+                'unit_type_id': unit_type_id,
+                'unit_id': {'$in': [x[1] for x in keys]},
+            })
+            total += result.deleted_count
+        if callback is not None:
+            callback(len(batch))
+    return total
+
+
+def update_repo(repo_id, notes, count_changes, added, removed):
+    """
+    Record a restore on the repository: set notes, adjust its unit counts
+    by the number of units added and removed of each type, and update its
+    last unit added and removed times.
+
+    :param notes: notes to set
+    :type  notes: dict
+    :param count_changes: change in the number of units, keyed by type
+    :type  count_changes: dict
+    :param added: whether units were added
+    :type  added: bool
+    :param removed: whether units were removed
+    :type  removed: bool
+    """
+    update = dict(('set__notes__%s' % key, value)
+                  for key, value in notes.items())
+    for unit_type_id, change in count_changes.items():
+        if change:
+            update['inc__content_unit_counts__%s' % unit_type_id] = change
+    now = dateutils.now_utc_datetime_with_tzinfo()
+    if added:
+        update['set__last_unit_added'] = now
+    if removed:
+        update['set__last_unit_removed'] = now
+    RepoModel.objects(repo_id=repo_id).update_one(**update)
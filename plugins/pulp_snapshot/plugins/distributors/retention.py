@@ -0,0 +1,195 @@
+import calendar
+import datetime
+import logging
+import re
+import time
+
+from gettext import gettext as _
+from pulp.server.db.model import Repository as RepoModel
+from pulp.server.db.model.repository import RepoContentUnit
+from pulp.server.db.model.repo_group import RepoGroup
+from pulp.server.controllers import repository as repo_controller
+from pulp_snapshot.common import constants
+from . import bookkeeping, bulk, cache, configuration, delta, index
+
+_LOG = logging.getLogger(__name__)
+
+# Suffix of a snapshot's name, encoding its timestamp
+SNAPSHOT_SUFFIX = re.compile(r'__(\d{14})\.(\d{4})Z$')
+
+SECONDS_PER_DAY = 86400
+
+# Retention rules, keyed by the configuration key setting them
+POLICY_KEYS = {
+    constants.CONFIG_RETAIN_LAST: 'last',
+    constants.CONFIG_RETAIN_DAYS: 'days',
+    constants.CONFIG_RETAIN_DAILY: 'daily',
+    constants.CONFIG_RETAIN_WEEKLY: 'weekly',
+}
+
+
+def get_policy(config):
+    """
+    :param config: distributor configuration
+    :type  config: pulp.plugins.config.PluginCallConfiguration or dict
+    :return: the configured retention rules, as keyword arguments for
+             expired(); empty if snapshots are kept forever
+    :rtype:  dict
+    """
+    ret = {}
+    for key, rule in POLICY_KEYS.items():
+        value = configuration.get_integer(config, key)
+        if value is not None:
+            ret[rule] = value
+    return ret
+
+
+def parse_timestamp(snapshot_id):
+    """
+    :return: the timestamp encoded in a snapshot's name, or None if the name
+             is not a snapshot's
+    :rtype:  float
+    """
+    match = SNAPSHOT_SUFFIX.search(snapshot_id)
+    if match is None:
+        return None
+    seconds = calendar.timegm(time.strptime(match.group(1), "%Y%m%d%H%M%S"))
+    return seconds + int(match.group(2)) / 10000.0
+
+
+def source_repo_id(snapshot_id):
+    """
+    :return: id of the repository a snapshot was taken of, or None if the
+             name is not a snapshot's
+    :rtype:  str
+    """
+    match = SNAPSHOT_SUFFIX.search(snapshot_id)
+    return snapshot_id[:match.start()] if match is not None else None
+
+
+def find_snapshots(repo_id):
+    """
+    :return: (snapshot id, timestamp) of the snapshots of a repository. The
+             timestamp is the last time the snapshot became current, from
+             the snapshot index, so that a reused snapshot is as new as its
+             reuse; snapshots missing from the index get the time in their
+             name.
+    :rtype:  list of tuple
+    """
+    # Oldest first: later entries of reused snapshots win
+    latest = dict((x.snapshot_id, x.timestamp)
+                  for x in index.get_snapshots(repo_id))
+    prefix = '%s__' % repo_id
+    ret = []
+    for repo in RepoModel.objects(repo_id__startswith=prefix).only('repo_id'):
+        # Leave out snapshots of other repositories sharing the prefix
+        suffix = repo.repo_id[len(repo_id):]
+        if SNAPSHOT_SUFFIX.match(suffix):
+            ret.append((repo.repo_id, latest.get(repo.repo_id,
+                                                 parse_timestamp(suffix))))
+    return ret
+
+
+def expired(snapshots, now, last=None, days=None, daily=None, weekly=None):
+    """
+    Apply a retention policy. A snapshot is retained if any of the rules
+    retains it; with no rules, every snapshot is retained.
+
+    :param snapshots: (snapshot id, timestamp) of the snapshots to consider
+    :type  snapshots: iterable of tuple
+    :param now: current time
+    :type  now: float
+    :param last: retain this many of the newest snapshots
+    :type  last: int
+    :param days: retain snapshots newer than this many days
+    :type  days: int
+    :param daily: retain the newest snapshot of each of this many most
+                  recent days that have snapshots
+    :type  daily: int
+    :param weekly: retain the newest snapshot of each of this many most
+                   recent weeks that have snapshots
+    :type  weekly: int
+    :return: ids of the snapshots not retained, sorted
+    :rtype:  list of str
+    """
+    if last is None and days is None and daily is None and weekly is None:
+        return []
+    newest_first = sorted(snapshots, key=lambda x: x[1], reverse=True)
+    keep = set()
+    if last:
+        keep.update(x[0] for x in newest_first[:last])
+    if days is not None:
+        keep.update(x[0] for x in newest_first
+                    if x[1] >= now - days * SECONDS_PER_DAY)
+    for count, period in ((daily, _day), (weekly, _week)):
+        seen = set()
+        for snapshot_id, timestamp in newest_first:
+            if len(seen) >= (count or 0):
+                break
+            if period(timestamp) not in seen:
+                seen.add(period(timestamp))
+                keep.add(snapshot_id)
+    return sorted(x[0] for x in newest_first if x[0] not in keep)
+
+
+def prune(snapshot_ids, batch_size, delay,
+          copy_batch_size=constants.DEFAULT_COPY_BATCH_SIZE,
+          copy_retries=constants.DEFAULT_COPY_RETRIES):
+    """
+    Delete snapshot repositories, a batch at a time.
+
+    The associations of a whole batch are removed with one delete, and the
+    batch is removed from all groups with one update, before the
+    repositories themselves are deleted. The pause between batches keeps
+    pruning from monopolizing the database.
+
+    Delta snapshots based on a deleted snapshot, but not deleted
+    themselves, are materialized first, and join the groups of their
+    repositories.
+
+    :param snapshot_ids: ids of the snapshots to delete
+    :type  snapshot_ids: list of str
+    :param batch_size: number of snapshots deleted per batch
+    :type  batch_size: int
+    :param delay: seconds to wait between batches
+    :type  delay: float
+    :param copy_batch_size: number of associations written per bulk insert
+                            when materializing
+    :type  copy_batch_size: int
+    :param copy_retries: number of times a failing bulk insert is retried
+    :type  copy_retries: int
+    """
+    materialized = []
+    for snapshot_id in delta.dependents(snapshot_ids):
+        if snapshot_id not in snapshot_ids and delta.materialize(
+                snapshot_id, copy_batch_size, retries=copy_retries):
+            materialized.append((source_repo_id(snapshot_id), snapshot_id))
+    units_coll = RepoContentUnit.get_collection()
+    delta_coll = delta.get_collection()
+    group_coll = RepoGroup.get_collection()
+    if materialized:
+        group_coll.bulk_write(bookkeeping.group_requests(materialized),
+                              ordered=False)
+    for i, batch in enumerate(bulk.batches(snapshot_ids, batch_size)):
+        if i and delay:
+            time.sleep(delay)
+        _LOG.info(_("Deleting snapshots %(repos)s") %
+                  {'repos': ', '.join(batch)})
+        units_coll.delete_many({'repo_id': {'$in': batch}})
+        delta_coll.delete_many({'snapshot_id': {'$in': batch}})
+        index.remove(batch)
+        cache.invalidate(batch)
+        group_coll.update_many({'repo_ids': {'$in': batch}},
+                               {'$pull': {'repo_ids': {'$in': batch}}})
+        RepoModel.objects(repo_id__in=batch).update(
+            set__content_unit_counts={})
+        for repo_id in batch:
+            repo_controller.delete(repo_id)
+
+
+def _day(timestamp):
+    return int(timestamp // SECONDS_PER_DAY)
+
+
+def _week(timestamp):
+    return datetime.datetime.utcfromtimestamp(timestamp).isocalendar()[:2]
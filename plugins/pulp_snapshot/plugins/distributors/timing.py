@@ -0,0 +1,69 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Python 2 has no time.monotonic
+from monotonic import monotonic as clock
+
+
+class Phases(object):
+    """
+    Wall time spent in, and number of documents touched by, each phase of
+    a publish.
+
+    Time is measured with a monotonic clock and accumulates when a phase
+    runs more than once. Phases are reported in the order they first ran.
+    """
+    def __init__(self):
+        self._phases = OrderedDict()
+        self._current = None
+
+    def _get(self, name):
+        return self._phases.setdefault(name, dict(seconds=0.0, documents=0))
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Time the enclosed block as phase name. Documents added while it
+        runs are counted towards it.
+        """
+        record = self._get(name)
+        previous, self._current = self._current, name
+        start = clock()
+        try:
+            yield
+        finally:
+            record['seconds'] += clock() - start
+            self._current = previous
+
+    def add_documents(self, count, name=None):
+        """
+        Count documents towards a phase, by default the one running.
+        """
+        name = name or self._current
+        if name is not None:
+            self._get(name)['documents'] += count
+
+    @property
+    def seconds(self):
+        return sum(x['seconds'] for x in self._phases.values())
+
+    def as_dict(self):
+        """
+        :return: seconds (rounded to the microsecond) and documents, keyed
+                 by phase
+        :rtype:  dict
+        """
+        return dict((name, dict(seconds=round(x['seconds'], 6),
+                                documents=x['documents']))
+                    for name, x in self._phases.items())
+
+    def format(self):
+        """
+        :return: the phases as space-separated key=value pairs, for logging
+        :rtype:  str
+        """
+        ret = ["total_seconds=%.6f" % self.seconds]
+        for name, x in self._phases.items():
+            ret.append("%s_seconds=%.6f %s_documents=%d" %
+                       (name, x['seconds'], name, x['documents']))
+        return ' '.join(ret)
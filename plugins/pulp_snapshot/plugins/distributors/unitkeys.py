@@ -0,0 +1,437 @@
+import binascii
+import bisect
+import itertools
+from collections import namedtuple
+from operator import itemgetter
+
+from . import diff
+
+UnitKey = namedtuple("UnitKey", "unit_type_id unit_id")
+
+# How the unit ids of a type are packed: canonical UUID strings as their 16
+# bytes, anything else as UTF-8 padded with NULs to the longest id. Both
+# keep the ids in the order the database sorts them in.
+CODEC_UUID = 'uuid'
+CODEC_RAW = 'raw'
+CODECS = (CODEC_UUID, CODEC_RAW)
+UUID_WIDTH = 16
+# Number of entries compared at once when diffing buffers; runs of
+# identical entries are skipped a block at a time
+DIFF_BLOCK = 64
+
+
+def _encode_uuid(unit_id):
+    """
+    :return: the 16 bytes of a unit id in canonical UUID form, or None if
+             it is not one
+    :rtype:  str
+    """
+    if len(unit_id) != 36 or unit_id[8:24:5] != u'----':
+        return None
+    digits = unit_id[:8] + unit_id[9:13] + unit_id[14:18] + \
+        unit_id[19:23] + unit_id[24:]
+    if digits != digits.lower():
+        # Upper case would not survive the round trip
+        return None
+    try:
+        return binascii.unhexlify(digits)
+    except (TypeError, ValueError, UnicodeError):
+        return None
+
+
+def _decode_uuid(entry):
+    digits = binascii.hexlify(entry)
+    return u'%s-%s-%s-%s-%s' % (digits[:8], digits[8:12], digits[12:16],
+                                digits[16:20], digits[20:])
+
+
+class _Keys(object):
+    """
+    The unit ids of one unit type, packed into a sorted buffer of fixed
+    width entries.
+    """
+    __slots__ = ('codec', 'width', 'buf')
+
+    def __init__(self, codec, width, buf):
+        self.codec = codec
+        self.width = width
+        self.buf = buf
+
+    def __len__(self):
+        return len(self.buf) // self.width if self.width else 0
+
+    def __getitem__(self, index):
+        start = index * self.width
+        return self.buf[start:start + self.width]
+
+    def encode(self, unit_id):
+        """
+        :return: the entry a unit id is stored as, or None if it cannot be
+                 in this buffer
+        :rtype:  str
+        """
+        if self.codec == CODEC_UUID:
+            return _encode_uuid(unit_id)
+        entry = unit_id.encode('utf-8')
+        if len(entry) > self.width:
+            return None
+        return entry.ljust(self.width, '\0')
+
+    def decode(self, entry):
+        if self.codec == CODEC_UUID:
+            return _decode_uuid(entry)
+        return entry.rstrip('\0').decode('utf-8')
+
+    def __iter__(self):
+        for index in xrange(len(self)):
+            yield self.decode(self[index])
+
+    def __contains__(self, unit_id):
+        entry = self.encode(unit_id)
+        if entry is None:
+            return False
+        index = bisect.bisect_left(self, entry)
+        return index < len(self) and self[index] == entry
+
+    def same_as(self, other):
+        """
+        :return: whether both buffers hold the same ids in the same form,
+                 which is cheaper to check than comparing the ids
+        :rtype:  bool
+        """
+        return (self.codec, self.width, self.buf) == \
+            (other.codec, other.width, other.buf)
+
+    def diff_entries(self, other):
+        """
+        Compare with a buffer packed with the same codec and width, without
+        decoding the entries. Identical runs are compared a block at a time,
+        so only the blocks holding changes are walked entry by entry.
+
+        :return: generator of (diff.ADDED, entry) for entries only in this
+                 buffer and (diff.REMOVED, entry) for entries only in
+                 other, in ascending order
+        :rtype:  generator
+        """
+        width = self.width
+        new, old = self.buf, other.buf
+        new_end, old_end = len(new), len(old)
+        block = DIFF_BLOCK * width
+        i = j = 0
+        while i < new_end and j < old_end:
+            chunk = new[i:i + block]
+            if chunk == old[j:j + block]:
+                i += len(chunk)
+                j += len(chunk)
+                continue
+            stop_i, stop_j = i + block, j + block
+            while i < min(stop_i, new_end) and j < min(stop_j, old_end):
+                x, y = new[i:i + width], old[j:j + width]
+                if x == y:
+                    i += width
+                    j += width
+                elif x < y:
+                    yield diff.ADDED, x
+                    i += width
+                else:
+                    yield diff.REMOVED, y
+                    j += width
+        for start in xrange(i, new_end, width):
+            yield diff.ADDED, new[start:start + width]
+        for start in xrange(j, old_end, width):
+            yield diff.REMOVED, old[start:start + width]
+
+
+class _KeysBuilder(object):
+    """
+    Packs the unit ids of one type as they are added. Ids added in
+    ascending order are appended to the buffer as is; otherwise the
+    entries are sorted once all are added.
+    """
+    def __init__(self):
+        self.codec = None
+        self.width = 0
+        self.buf = bytearray()
+        self.last = None
+        self.ordered = True
+
+    def add(self, unit_id):
+        if self.codec is None:
+            if _encode_uuid(unit_id) is not None:
+                self.codec, self.width = CODEC_UUID, UUID_WIDTH
+            else:
+                # Even empty ids take a byte, so every entry has a width
+                self.codec, self.width = CODEC_RAW, 1
+        if self.codec == CODEC_UUID:
+            entry = _encode_uuid(unit_id)
+            if entry is None:
+                self._repack(CODEC_RAW, 0)
+        if self.codec == CODEC_RAW:
+            entry = unit_id.encode('utf-8')
+            if len(entry) > self.width:
+                self._repack(CODEC_RAW, len(entry))
+            entry = entry.ljust(self.width, '\0')
+        if self.last is not None and entry <= self.last:
+            if entry == self.last:
+                return
+            self.ordered = False
+        self.buf.extend(entry)
+        self.last = entry
+
+    def _repack(self, codec, width):
+        """
+        Store the entries added so far with another codec or width; only
+        needed when an id does not fit the ones used until then.
+        """
+        keys = _Keys(self.codec, self.width, bytes(self.buf))
+        unit_ids = list(keys)
+        if codec == CODEC_RAW:
+            width = max([width] + [len(x.encode('utf-8')) for x in unit_ids])
+        self.codec, self.width, self.buf = codec, width, bytearray()
+        entries = [_Keys(codec, width, None).encode(x) for x in unit_ids]
+        for entry in entries:
+            self.buf.extend(entry)
+        if self.last is not None:
+            self.last = entries[-1]
+
+    def build(self):
+        buf = bytes(self.buf)
+        self.buf = None
+        if not self.ordered:
+            width = self.width
+            entries = sorted(set(buf[i:i + width]
+                                 for i in xrange(0, len(buf), width)))
+            buf = b''.join(entries)
+        return _Keys(self.codec, self.width, buf)
+
+
+class UnitKeySet(object):
+    """
+    Immutable set of (unit_type_id, unit_id) keys, stored compactly.
+
+    Unit type ids are interned in a small table, and the unit ids of each
+    type are packed into one sorted buffer of fixed width entries, which
+    is searched by bisection. A set of a million units takes about 16 MB
+    when the unit ids are UUIDs, rather than hundreds of bytes per unit
+    for a set of tuples of strings.
+
+    Iterating yields UnitKey tuples in ascending order, the order in which
+    the database sorts unit keys.
+    """
+    def __init__(self, units=()):
+        """
+        :param units: unit keys, in any order; duplicates are ignored
+        :type  units: iterable of tuple
+        """
+        builder = UnitKeySetBuilder()
+        for unit_type_id, unit_id in units:
+            builder.add(unit_type_id, unit_id)
+        self._types, self._keys = builder.build()
+
+    @classmethod
+    def from_documents(cls, documents):
+        """
+        :param documents: unit association documents
+        :type  documents: iterable of dict
+        :rtype: UnitKeySet
+        """
+        return cls((x['unit_type_id'], x['unit_id']) for x in documents)
+
+    @classmethod
+    def from_buffers(cls, buffers):
+        """
+        Wrap buffers of packed unit ids, such as those of a manifest mapped
+        into memory, without copying them.
+
+        :param buffers: (unit_type_id, codec, width, buffer) for each unit
+                        type, as returned by buffers()
+        :type  buffers: iterable of tuple
+        :rtype: UnitKeySet
+        :raise ValueError: if a buffer is not one UnitKeySet packs
+        """
+        pairs = []
+        for unit_type_id, codec, width, buf in buffers:
+            if codec not in CODECS or width < 1 or len(buf) % width or \
+                    codec == CODEC_UUID and width != UUID_WIDTH:
+                raise ValueError("Invalid buffer for unit type %s" %
+                                 unit_type_id)
+            pairs.append((unit_type_id, _Keys(codec, width, buf)))
+        pairs.sort(key=itemgetter(0))
+        ret = cls()
+        ret._types = tuple(x[0] for x in pairs)
+        ret._keys = tuple(x[1] for x in pairs)
+        return ret
+
+    def buffers(self):
+        """
+        :return: (unit_type_id, codec, width, buffer) for each unit type,
+                 in ascending order of unit type; each buffer holds the
+                 sorted fixed width entries of the type's unit ids
+        :rtype:  list of tuple
+        """
+        return [(unit_type_id, keys.codec, keys.width, keys.buf)
+                for unit_type_id, keys in zip(self._types, self._keys)]
+
+    @classmethod
+    def combine(cls, sets):
+        """
+        Join sets holding the units of different types. Their buffers are
+        shared rather than copied.
+
+        :param sets: sets with no unit type in common
+        :type  sets: iterable of UnitKeySet
+        :rtype: UnitKeySet
+        """
+        pairs = sorted(itertools.chain.from_iterable(
+            zip(x._types, x._keys) for x in sets), key=itemgetter(0))
+        types = tuple(x[0] for x in pairs)
+        if len(set(types)) != len(types):
+            raise ValueError("Sets to combine share unit types")
+        ret = cls()
+        ret._types, ret._keys = types, tuple(x[1] for x in pairs)
+        return ret
+
+    def _get(self, unit_type_id):
+        index = bisect.bisect_left(self._types, unit_type_id)
+        if index < len(self._types) and self._types[index] == unit_type_id:
+            return self._keys[index]
+        return None
+
+    def __len__(self):
+        return sum(len(x) for x in self._keys)
+
+    def __iter__(self):
+        for unit_type_id, keys in zip(self._types, self._keys):
+            for unit_id in keys:
+                yield UnitKey(unit_type_id, unit_id)
+
+    def __contains__(self, unit):
+        keys = self._get(unit[0])
+        return keys is not None and unit[1] in keys
+
+    def counts(self):
+        """
+        :return: number of units of each type
+        :rtype:  dict
+        """
+        return dict((unit_type_id, len(keys))
+                    for unit_type_id, keys in zip(self._types, self._keys))
+
+    @property
+    def nbytes(self):
+        """
+        Approximate memory held by the set, in bytes.
+        """
+        return sum(len(x.buf) for x in self._keys) + \
+            64 * len(self._keys)
+
+    def diff(self, other):
+        """
+        Compare with the units of another set, or any stream of unit keys
+        in ascending order. Unit types packed alike in both sets are
+        compared on their packed entries, and only the changes decoded.
+
+        :param other: the units considered old
+        :type  other: UnitKeySet or iterable
+        :return: generator of (diff.ADDED, key) for keys only in this set
+                 and (diff.REMOVED, key) for keys only in other, in
+                 ascending order
+        :rtype:  generator
+        """
+        if not isinstance(other, UnitKeySet):
+            return diff.merge_diff(self, other)
+        return self._diff_sets(other)
+
+    def _diff_sets(self, other):
+        for unit_type_id in sorted(set(self._types) | set(other._types)):
+            new, old = self._get(unit_type_id), other._get(unit_type_id)
+            if new is not None and old is not None and \
+                    (new.codec, new.width) == (old.codec, old.width):
+                if new.same_as(old):
+                    continue
+                for change, entry in new.diff_entries(old):
+                    yield change, UnitKey(unit_type_id, new.decode(entry))
+                continue
+            for change, unit_id in diff.merge_diff(new or (), old or ()):
+                yield change, UnitKey(unit_type_id, unit_id)
+
+    def __eq__(self, other):
+        if not isinstance(other, UnitKeySet):
+            return NotImplemented
+        if self._types != other._types:
+            return False
+        if all(x.same_as(y) for x, y in zip(self._keys, other._keys)):
+            return True
+        return not diff.differ(self, other)
+
+    def __ne__(self, other):
+        ret = self.__eq__(other)
+        if ret is NotImplemented:
+            return ret
+        return not ret
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "<%s %r>" % (self.__class__.__name__, self.counts())
+
+
+class UnitKeySetBuilder(object):
+    """
+    Packs unit keys as they are added, one buffer per unit type.
+    """
+    def __init__(self):
+        self._builders = {}
+
+    def add(self, unit_type_id, unit_id):
+        builder = self._builders.get(unit_type_id)
+        if builder is None:
+            builder = self._builders[unit_type_id] = _KeysBuilder()
+        builder.add(unit_id)
+
+    def passthrough(self, units):
+        """
+        Add units as they are iterated over.
+
+        :param units: unit keys
+        :type  units: iterable of tuple
+        :return: generator of the same units
+        :rtype:  generator
+        """
+        for unit in units:
+            self.add(unit[0], unit[1])
+            yield unit
+
+    def build(self):
+        """
+        :return: the unit types, in ascending order, and their keys
+        :rtype:  tuple of (tuple of str, tuple of _Keys)
+        """
+        types = tuple(sorted(self._builders))
+        keys = tuple(self._builders.pop(x).build() for x in types)
+        return types, keys
+
+    def build_set(self):
+        """
+        :return: the units added; the builder cannot be used afterwards
+        :rtype:  UnitKeySet
+        """
+        ret = UnitKeySet()
+        ret._types, ret._keys = self.build()
+        return ret
+
+
+def split_changes(changes):
+    """
+    Collect the units added and removed by a stream of changes, without
+    holding the changes themselves.
+
+    :param changes: (diff.ADDED or diff.REMOVED, unit key)
+    :type  changes: iterable of tuple
+    :return: the units added and the units removed
+    :rtype:  tuple of (UnitKeySet, UnitKeySet)
+    """
+    added, removed = UnitKeySetBuilder(), UnitKeySetBuilder()
+    for change, unit in changes:
+        (added if change == diff.ADDED else removed).add(unit[0], unit[1])
+    return added.build_set(), removed.build_set()
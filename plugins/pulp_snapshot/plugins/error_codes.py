@@ -4,3 +4,10 @@ from pulp.common.error_codes import Error
 
 SNAP0100 = Error("SNAP0100", _("Error snapshotting repository %(repo)s"),
                  ['repo'])
+SNAP0101 = Error("SNAP0101",
+                 _("Repository %(repo)s has no snapshot %(snapshot)s"),
+                 ['repo', 'snapshot'])
+SNAP0102 = Error("SNAP0102",
+                 _("Snapshot %(snapshot)s of repository %(repo)s was taken "
+                   "over by another publish"),
+                 ['repo', 'snapshot'])
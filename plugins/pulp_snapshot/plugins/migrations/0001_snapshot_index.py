@@ -0,0 +1,48 @@
+"""
+Build the snapshot index from the existing snapshot repositories.
+"""
+import logging
+from collections import defaultdict
+
+from gettext import gettext as _
+from pulp.server.db import connection
+from pulp_snapshot.plugins.distributors import checkpoint, index, retention
+from pulp_snapshot.plugins.distributors.publisher import (
+    REPO_SNAPSHOT_DIGEST, REPO_SNAPSHOT_NAME, REPO_SNAPSHOT_TIMESTAMP,
+    REPO_SNAPSHOT_UNIT_COUNTS, is_snapshot)
+
+_LOG = logging.getLogger(__name__)
+
+
+def migrate(*args, **kwargs):
+    repos_coll = connection.get_collection('repos')
+    snapshots = defaultdict(list)
+    cursor = repos_coll.find(
+        {'notes.%s' % REPO_SNAPSHOT_NAME: {'$exists': True}},
+        {'repo_id': 1, 'notes': 1, 'content_unit_counts': 1})
+    for repo in cursor:
+        repo_id = repo['repo_id']
+        notes = repo.get('notes') or {}
+        match = retention.SNAPSHOT_SUFFIX.search(repo_id)
+        # Repositories name their current snapshot too; incomplete
+        # snapshots are resumed or deleted by the next publish
+        if match is None or not is_snapshot(repo_id, notes) or \
+                checkpoint.is_incomplete(notes):
+            continue
+        timestamp = notes.get(REPO_SNAPSHOT_TIMESTAMP)
+        if timestamp is None:
+            timestamp = retention.parse_timestamp(repo_id)
+        # Delta snapshots, and snapshots whose counts are left to the
+        # bookkeeping task, only have their counts in the notes. Snapshots
+        # older than the note have their associations counted.
+        counts = notes.get(REPO_SNAPSHOT_UNIT_COUNTS)
+        if counts is None:
+            counts = repo.get('content_unit_counts') or {}
+        snapshots[repo_id[:match.start()]].append(index.SnapshotEntry(
+            snapshot_id=repo_id, timestamp=timestamp,
+            digest=notes.get(REPO_SNAPSHOT_DIGEST),
+            units=sum(counts.values())))
+    for repo_id, entries in sorted(snapshots.items()):
+        _LOG.info(_("Indexing %(count)d snapshots of %(repo)s") %
+                  {'count': len(entries), 'repo': repo_id})
+        index.rebuild(repo_id, entries)
@@ -0,0 +1,15 @@
+"""
+Create the indexes the snapshot distributors' queries need.
+"""
+import logging
+
+from gettext import gettext as _
+from pulp_snapshot.plugins.distributors import indexes
+
+_LOG = logging.getLogger(__name__)
+
+
+def migrate(*args, **kwargs):
+    for name, created in sorted(indexes.ensure_indexes().items()):
+        _LOG.info(_("Ensured indexes %(indexes)s on %(collection)s") %
+                  {'indexes': ', '.join(created), 'collection': name})
@@ -11,13 +11,19 @@ setup(
     entry_points={
         'pulp.distributors': [
             'distributor = pulp_snapshot.plugins.distributors.distributor:entry_point',  # noqa
-        ]
+        ],
+        'pulp.group_distributors': [
+            'group_distributor = pulp_snapshot.plugins.distributors.group_distributor:entry_point',  # noqa
+        ],
+        'pulp.server.db.migrations': [
+            'pulp_snapshot = pulp_snapshot.plugins.migrations',
+        ],
     },
     include_package_data=True,
     data_files=[
         ('/usr/lib/pulp/plugins/types', ['types/snapshot.json']),
     ],
-    install_requires=['blinker', 'celery', 'django', 'kombu', 'mongoengine',
-                      'oauth2', 'semantic_version'],
-    tests_require=['mock', 'pytest'],
+    install_requires=['blinker', 'celery', 'django', 'kombu', 'monotonic',
+                      'mongoengine', 'oauth2', 'semantic_version'],
+    tests_require=['mock', 'mongomock', 'pytest'],
 )
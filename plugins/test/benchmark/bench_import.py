@@ -0,0 +1,52 @@
+"""
+Cost of loading the plugin modules, as every Pulp process does through
+their entry points, compared with the publishers they import on demand.
+
+Each module is imported in a fresh interpreter, several times, and the
+best wall time is reported with the number of modules the import loaded.
+
+Run from the plugins directory:
+
+    python -m test.benchmark.bench_import [runs]
+"""
+import os
+import subprocess
+import sys
+
+MODULES = (
+    "pulp_snapshot.plugins.distributors.distributor",
+    "pulp_snapshot.plugins.distributors.group_distributor",
+    "pulp_snapshot.plugins.distributors.group_publisher",
+    "pulp_snapshot.plugins.distributors.publisher",
+)
+SCRIPT = """
+import sys, time
+before = set(sys.modules)
+start = time.time()
+__import__(%r)
+elapsed = time.time() - start
+print elapsed, len(set(sys.modules) - before)
+"""
+
+
+def measure(module, runs):
+    env = dict(os.environ,
+               PYTHONPATH=os.pathsep.join(x for x in sys.path if x))
+    results = []
+    for _run in range(runs):
+        output = subprocess.check_output(
+            [sys.executable, '-c', SCRIPT % module], env=env)
+        elapsed, count = output.split()
+        results.append((float(elapsed), int(count)))
+    return min(results)
+
+
+def main(runs):
+    print "%-55s %10s %8s" % ("module", "ms", "modules")
+    for module in MODULES:
+        elapsed, count = measure(module, runs)
+        print "%-55s %10.1f %8d" % (module, 1000 * elapsed, count)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if sys.argv[1:] else 5)
@@ -0,0 +1,54 @@
+"""
+Time to write and diff snapshot manifests.
+
+Two manifests of synthetic unit keys in the UUID form Pulp gives unit ids
+are written, the second with a number of units removed and added, then
+diffed from their memory mappings.
+
+Run from the plugins directory:
+
+    python -m test.benchmark.bench_manifest [units [changes]]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from pulp_snapshot.plugins.distributors import manifest, unitkeys
+
+TYPES = (u"erratum", u"rpm", u"srpm")
+
+
+def unit_keys(size, changes, offset=0):
+    # Every step-th unit is replaced by one with another id
+    step = size // changes if changes else size + 1
+    for i in xrange(size):
+        number = i + offset * size if i % step == 0 else i
+        yield (TYPES[i % len(TYPES)],
+               u'%08x-0000-4000-8000-%012x' % (number & 0xffffffff, number))
+
+
+def main(size, changes):
+    work_dir = tempfile.mkdtemp()
+    try:
+        old_path = os.path.join(work_dir, "old.manifest")
+        new_path = os.path.join(work_dir, "new.manifest")
+        start = time.time()
+        manifest.write(old_path, unitkeys.UnitKeySet(unit_keys(size, 0)))
+        manifest.write(new_path,
+                       unitkeys.UnitKeySet(unit_keys(size, changes, 1)))
+        elapsed = time.time() - start
+        print "wrote 2 x %d units in %.2fs, %d bytes each" % (
+            size, elapsed, os.path.getsize(old_path))
+        start = time.time()
+        count = sum(1 for _change in manifest.diff(old_path, new_path))
+        elapsed = time.time() - start
+        print "diffed in %.3fs, %d changes" % (elapsed, count)
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    args = [int(x) for x in sys.argv[1:]]
+    main(*(args + [1000000, 1000][len(args):]))
@@ -0,0 +1,79 @@
+"""
+Peak memory of the snapshot comparison engines as the repository grows.
+
+Each engine compares a synthetic repository with a snapshot differing in
+its last unit, reading both from generators that stand in for database
+cursors. Every run happens in a fresh process so that peak RSS can be
+measured.
+
+Run from the plugins directory:
+
+    python -m test.benchmark.bench_merge_diff [units ...]
+"""
+import multiprocessing
+import resource
+import sys
+import time
+from collections import namedtuple
+
+from pulp_snapshot.plugins.distributors import diff
+
+REPO_UNIT = namedtuple("REPO_UNIT", "unit_type_id unit_id")
+SIZES = (10000, 100000, 1000000, 2000000)
+TYPES = (u"erratum", u"rpm", u"srpm")
+
+
+def cursor(size, last):
+    """
+    Generate size unit keys in ascending order; the last key is numbered
+    last instead of size - 1.
+    """
+    for offset, unit_type_id in enumerate(TYPES):
+        for i in xrange(offset, size, len(TYPES)):
+            if i == size - 1:
+                i = last
+            yield REPO_UNIT(unit_type_id, u"%036d" % i)
+
+
+def compare_sets(size):
+    return set(cursor(size, size)) != set(cursor(size, size + 1))
+
+
+def compare_merge(size):
+    return diff.differ(cursor(size, size), cursor(size, size + 1))
+
+
+ENGINES = (("set", compare_sets), ("merge", compare_merge))
+
+
+def _measure(engine, size, queue):
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    changed = engine(size)
+    elapsed = time.time() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((changed, elapsed, peak - baseline))
+
+
+def measure(engine, size):
+    queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=_measure,
+                                   args=(engine, size, queue))
+    proc.start()
+    ret = queue.get()
+    proc.join()
+    return ret
+
+
+def main(sizes):
+    print "%-8s %10s %10s %14s" % ("engine", "units", "seconds",
+                                   "peak RSS (KB)")
+    for name, engine in ENGINES:
+        for size in sizes:
+            changed, elapsed, rss = measure(engine, size)
+            assert changed
+            print "%-8s %10d %10.2f %14d" % (name, size, elapsed, rss)
+
+
+if __name__ == '__main__':
+    main([int(x) for x in sys.argv[1:]] or SIZES)
@@ -0,0 +1,359 @@
+"""
+End to end benchmark of the snapshot publisher.
+
+Synthetic repositories with a mix of unit types are generated in a local
+mongod (--mongo-uri) or, by default, in mongomock. For every repository
+size, diff engine and number of fetch threads (--fetch-threads; the merge
+engine streams its units and only runs with one), the publisher is run
+through three phases:
+
+  initial    first snapshot of the repository
+  unchanged  publish with no change since the snapshot
+  changed    publish after --change-rate of the units were replaced
+
+Wall time, peak RSS, the number of queries and the number of documents
+read and written are recorded per phase, and written as JSON so that
+results can be compared across releases.
+
+Run from the plugins directory:
+
+    python -m test.benchmark.bench_publisher --sizes 10000,100000 \\
+        --output results.json
+"""
+import json
+import optparse
+import platform
+import resource
+import sys
+import threading
+import time
+
+import mock
+
+from test import testbase  # noqa
+from test.unit.plugins.distributors.test_distributor import ModuleFinder
+
+SIZES = (10000, 100000, 1000000)
+ENGINES = ('python', 'aggregate', 'merge')
+FETCH_THREADS = (1, 4)
+PHASES = ('initial', 'unchanged', 'changed')
+# Share of the units of each type in the generated repositories
+TYPE_MIX = (('rpm', 70), ('srpm', 15), ('erratum', 10),
+            ('package_group', 4), ('distribution', 1))
+INSERT_BATCH_SIZE = 10000
+
+
+class Stats(object):
+    """
+    Database operations performed through a CountingCollection.
+    """
+    FIELDS = ('queries', 'documents_read', 'writes', 'documents_written')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def add(self, field, count=1):
+        # Publishers may query from several threads
+        with self._lock:
+            setattr(self, field, getattr(self, field) + count)
+
+    def reset(self):
+        for field in self.FIELDS:
+            setattr(self, field, 0)
+
+    def as_dict(self):
+        return dict((x, getattr(self, x)) for x in self.FIELDS)
+
+
+class CountingCollection(object):
+    """
+    Collection proxy counting queries, writes and the documents they
+    transfer.
+    """
+    def __init__(self, collection, stats):
+        self._collection = collection
+        self._stats = stats
+
+    def __getattr__(self, name):
+        return getattr(self._collection, name)
+
+    def _read(self, cursor):
+        documents = 0
+        try:
+            for doc in cursor:
+                documents += 1
+                yield doc
+        finally:
+            self._stats.add('documents_read', documents)
+
+    def find(self, *args, **kwargs):
+        self._stats.add('queries')
+        return self._read(self._collection.find(*args, **kwargs))
+
+    def aggregate(self, *args, **kwargs):
+        self._stats.add('queries')
+        return self._read(self._collection.aggregate(*args, **kwargs))
+
+    def count(self, *args, **kwargs):
+        self._stats.add('queries')
+        return self._collection.count(*args, **kwargs)
+
+    def distinct(self, *args, **kwargs):
+        self._stats.add('queries')
+        return self._collection.distinct(*args, **kwargs)
+
+    def insert_many(self, documents, *args, **kwargs):
+        self._stats.add('writes')
+        self._stats.add('documents_written', len(documents))
+        return self._collection.insert_many(documents, *args, **kwargs)
+
+    def update(self, *args, **kwargs):
+        self._stats.add('writes')
+        return self._collection.update(*args, **kwargs)
+
+    def bulk_write(self, requests, *args, **kwargs):
+        self._stats.add('writes')
+        return self._collection.bulk_write(requests, *args, **kwargs)
+
+    def with_options(self, *args, **kwargs):
+        return CountingCollection(
+            self._collection.with_options(*args, **kwargs), self._stats)
+
+
+class PeakRSS(object):
+    """
+    Sample the resident set size of the process while a block runs, and
+    record its peak above the size at the start, in KB.
+    """
+    INTERVAL = 0.01
+
+    def __init__(self):
+        self.peak = 0
+        self._done = threading.Event()
+
+    @classmethod
+    def current(cls):
+        with open('/proc/self/statm') as statm:
+            pages = int(statm.read().split()[1])
+        return pages * resource.getpagesize() // 1024
+
+    def _sample(self):
+        while not self._done.wait(self.INTERVAL):
+            self.peak = max(self.peak, self.current() - self._start)
+
+    def __enter__(self):
+        self._start = self.current()
+        self._thread = threading.Thread(target=self._sample)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._done.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.current() - self._start)
+
+
+class Repo(object):
+    def __init__(self, repo_id, notes=None):
+        self.id = self.repo_id = repo_id
+        self.notes = dict(notes or {})
+        self.content_unit_counts = {}
+
+    def save(self):
+        pass
+
+
+class Repos(object):
+    """
+    Stand-in for the repository controller and model, remembering the
+    snapshots created by the publisher.
+    """
+    def __init__(self):
+        self.repos = {}
+
+    def create_repo(self, repo_id, notes=None, **kwargs):
+        self.repos[repo_id] = Repo(repo_id, notes)
+        return self.repos[repo_id]
+
+    def objects(self, repo_id=None, **kwargs):
+        query = mock.MagicMock()
+        query.first.return_value = self.repos.get(repo_id)
+        return query
+
+
+def unit_id(i):
+    return u'%08x-0000-4000-8000-%012x' % (i & 0xffffffff, i)
+
+
+def unit_type_id(i):
+    i %= 100
+    for type_id, share in TYPE_MIX:
+        if i < share:
+            return type_id
+        i -= share
+
+
+def generate(collection, repo_id, size):
+    batch = []
+    for i in xrange(size):
+        batch.append(dict(repo_id=repo_id, unit_type_id=unit_type_id(i),
+                          unit_id=unit_id(i)))
+        if len(batch) == INSERT_BATCH_SIZE:
+            collection.insert_many(batch)
+            batch = []
+    if batch:
+        collection.insert_many(batch)
+
+
+def change(collection, repo_id, size, rate):
+    """
+    Replace rate * size units of a repository with new ones.
+    """
+    count = int(size * rate)
+    if not count:
+        return
+    step = size // count
+    removed = [unit_id(i) for i in xrange(0, size, step)][:count]
+    collection.delete_many({'repo_id': repo_id, 'unit_id': {'$in': removed}})
+    generate_range = xrange(size, size + count)
+    collection.insert_many([
+        dict(repo_id=repo_id, unit_type_id=unit_type_id(i), unit_id=unit_id(i))
+        for i in generate_range])
+
+
+def run_engine(db, module, size, engine, change_rate, fetch_threads):
+    """
+    Run the three phases for a repository, an engine and a number of fetch
+    threads.
+
+    :return: one result per phase
+    :rtype:  list of dict
+    """
+    repo_id = 'bench-%d-%s-%d' % (size, engine, fetch_threads)
+    units_coll = db.repo_content_units
+    generate(units_coll, repo_id, size)
+
+    stats = Stats()
+    repos = Repos()
+    repo = Repo(repo_id)
+    config = dict(diff_engine=engine, fetch_threads=fetch_threads)
+
+    prefix = "pulp_snapshot.plugins.distributors."
+    patches = [
+        mock.patch(prefix + "index.get_collection",
+                   return_value=CountingCollection(
+                       db.repo_snapshot_index, stats)),
+        mock.patch(prefix + "delta.RepoModel", objects=repos.objects),
+        mock.patch(prefix + "checkpoint.RepoModel", objects=repos.objects),
+        mock.patch(prefix + "publisher.RepoContentUnit", side_effect=dict,
+                   **{'get_collection.return_value':
+                      CountingCollection(units_coll, stats)}),
+        mock.patch(prefix + "publisher.RepoGroup", **{
+            'get_collection.return_value':
+            CountingCollection(db.repo_groups, stats)}),
+        mock.patch(prefix + "publisher.RepoImporter"),
+        mock.patch(prefix + "publisher.RepoModel", objects=repos.objects),
+        mock.patch(prefix + "publisher.repo_controller",
+                   create_repo=repos.create_repo),
+    ]
+    for patch in patches:
+        patch.start()
+    results = []
+    try:
+        for phase in PHASES:
+            if phase == 'changed':
+                change(units_coll, repo_id, size, change_rate)
+            stats.reset()
+            publisher = module.Publisher(repo=repo,
+                                         conduit=mock.MagicMock(),
+                                         config=config)
+            with PeakRSS() as rss:
+                start = time.time()
+                publisher.process_lifecycle()
+                elapsed = time.time() - start
+            result = dict(size=size, engine=engine, phase=phase,
+                          fetch_threads=fetch_threads,
+                          seconds=round(elapsed, 3), peak_rss_kb=rss.peak,
+                          snapshot=publisher.repo_snapshot,
+                          bytes_read=publisher.units_read['bytes'],
+                          phases=publisher.phases.as_dict())
+            result.update(stats.as_dict())
+            results.append(result)
+            repo.notes[module.REPO_SNAPSHOT_NAME] = \
+                publisher.repo_snapshot
+    finally:
+        for patch in reversed(patches):
+            patch.stop()
+        units_coll.delete_many({'repo_id': {'$regex': '^%s' % repo_id}})
+        db.repo_snapshot_index.delete_one({'_id': repo_id})
+    return results
+
+
+def get_database(mongo_uri):
+    if mongo_uri:
+        import pymongo
+        client = pymongo.MongoClient(mongo_uri)
+        db = client.get_default_database()
+        backend = 'mongod %s' % client.server_info()['version']
+    else:
+        import mongomock
+        db = mongomock.MongoClient().db
+        backend = 'mongomock %s' % mongomock.__version__
+    return db, backend
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--sizes", default=','.join(str(x) for x in SIZES),
+                      help="comma-separated repository sizes")
+    parser.add_option("--engines", default=','.join(ENGINES),
+                      help="comma-separated diff engines")
+    parser.add_option("--fetch-threads",
+                      default=','.join(str(x) for x in FETCH_THREADS),
+                      help="comma-separated numbers of fetch threads")
+    parser.add_option("--change-rate", type="float", default=0.01,
+                      help="share of units replaced before the last phase")
+    parser.add_option("--mongo-uri",
+                      help="database to use, e.g. "
+                      "mongodb://localhost/snapshot_bench; mongomock is "
+                      "used if not set")
+    parser.add_option("--output", help="file to write the results to")
+    options, _args = parser.parse_args(argv)
+
+    sys.meta_path.insert(0, ModuleFinder())
+    from pulp_snapshot.plugins.distributors import publisher
+
+    db, backend = get_database(options.mongo_uri)
+    results = []
+    for size in [int(x) for x in options.sizes.split(',')]:
+        for engine in options.engines.split(','):
+            for threads in [int(x)
+                            for x in options.fetch_threads.split(',')]:
+                if engine == 'merge' and threads > 1:
+                    continue
+                for result in run_engine(db, publisher, size, engine,
+                                         options.change_rate, threads):
+                    print("%(size)9d %(engine)-10s %(fetch_threads)2d "
+                          "%(phase)-10s %(seconds)9.3fs "
+                          "%(peak_rss_kb)9dKB %(queries)4d queries "
+                          "%(documents_read)9d read "
+                          "%(documents_written)9d written" % result)
+                    results.append(result)
+
+    report = dict(
+        timestamp=time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        python=platform.python_version(),
+        backend=backend,
+        change_rate=options.change_rate,
+        results=results,
+    )
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    return report
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
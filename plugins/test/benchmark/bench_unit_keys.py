@@ -0,0 +1,79 @@
+"""
+Memory per unit of the unit key sets held by the python diff engine.
+
+Each container is filled with synthetic unit keys in the UUID form Pulp
+gives unit ids, read from a generator that stands in for a database
+cursor: a set of REPO_UNIT tuples as the engine used to build, and a
+UnitKeySet. Every run happens in a fresh process so that peak RSS can be
+measured.
+
+Run from the plugins directory:
+
+    python -m test.benchmark.bench_unit_keys [units ...]
+"""
+import multiprocessing
+import resource
+import sys
+import time
+from collections import namedtuple
+
+from pulp_snapshot.plugins.distributors import unitkeys
+
+REPO_UNIT = namedtuple("REPO_UNIT", "unit_type_id unit_id")
+SIZES = (10000, 100000, 1000000, 2000000)
+TYPES = (u"erratum", u"rpm", u"srpm")
+
+
+def cursor(size):
+    for i in xrange(size):
+        yield dict(unit_type_id=TYPES[i % len(TYPES)],
+                   unit_id=u'%08x-0000-4000-8000-%012x' % (i & 0xffffffff,
+                                                           i))
+
+
+def build_set(size):
+    units = set(REPO_UNIT(x['unit_type_id'], x['unit_id'])
+                for x in cursor(size))
+    # As the engine did before copying
+    return len(sorted(units))
+
+
+def build_unit_keys(size):
+    return len(unitkeys.UnitKeySet.from_documents(cursor(size)))
+
+
+CONTAINERS = (("set", build_set), ("unitkeys", build_unit_keys))
+
+
+def _measure(container, size, queue):
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    count = container(size)
+    elapsed = time.time() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((count, elapsed, peak - baseline))
+
+
+def measure(container, size):
+    queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=_measure,
+                                   args=(container, size, queue))
+    proc.start()
+    ret = queue.get()
+    proc.join()
+    return ret
+
+
+def main(sizes):
+    print "%-9s %10s %10s %14s %14s" % ("container", "units", "seconds",
+                                        "peak RSS (KB)", "bytes/unit")
+    for name, container in CONTAINERS:
+        for size in sizes:
+            count, elapsed, rss = measure(container, size)
+            assert count == size
+            print "%-9s %10d %10.2f %14d %14.1f" % (
+                name, size, elapsed, rss, 1024.0 * rss / size)
+
+
+if __name__ == '__main__':
+    main([int(x) for x in sys.argv[1:]] or SIZES)
@@ -0,0 +1,147 @@
+import unittest
+
+import mock
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+from .test_delta import SnapshotsTestCase
+from .test_distributor import BaseTest
+
+
+@unittest.skipIf(mongomock is None, "mongomock is not available")
+class TestUpdateSnapshots(BaseTest):
+    def setUp(self):
+        super(TestUpdateSnapshots, self).setUp()
+        from pulp_snapshot.plugins.distributors import bookkeeping
+        self.Bookkeeping = bookkeeping
+        db = mongomock.MongoClient().db
+        self.pending_coll = db.repo_snapshot_bookkeeping
+        self.prune_coll = db.repo_snapshot_prunes
+        self.repos_coll = db.repos
+        self.groups_coll = db.repo_groups
+        prefix = "pulp_snapshot.plugins.distributors.bookkeeping."
+        self.patches = [
+            mock.patch(prefix + "get_collection",
+                       return_value=self.pending_coll),
+            mock.patch(prefix + "get_prune_collection",
+                       return_value=self.prune_coll),
+            mock.patch(prefix + "connection", **{
+                'get_collection.return_value': self.repos_coll}),
+            mock.patch("pulp.server.db.model.repo_group.RepoGroup", **{
+                'get_collection.return_value': self.groups_coll}),
+            mock.patch(prefix + "BATCH_SIZE", 2),
+        ]
+        for patch in self.patches:
+            patch.start()
+        self.groups_coll.insert_many([
+            dict(_id="group-1", repo_ids=["repo-1", "repo-2"]),
+            dict(_id="group-2", repo_ids=["repo-2"]),
+        ])
+
+    def tearDown(self):
+        for patch in reversed(self.patches):
+            patch.stop()
+        super(TestUpdateSnapshots, self).tearDown()
+
+    def group(self, group_id):
+        return sorted(self.groups_coll.find_one(group_id)['repo_ids'])
+
+    def test_update_snapshots(self):
+        for repo_id, snapshot_id in [("repo-1", "repo-1__1"),
+                                     ("repo-2", "repo-2__1"),
+                                     ("repo-2", "repo-2__2")]:
+            self.repos_coll.insert_one(dict(repo_id=snapshot_id))
+            self.Bookkeeping.defer(repo_id, snapshot_id, dict(rpm=1))
+        # Reused snapshots only need adding to the groups
+        self.repos_coll.insert_one(dict(repo_id="repo-1__0"))
+        self.Bookkeeping.defer("repo-1", "repo-1__0")
+        # Pruned before the task ran
+        self.Bookkeeping.defer("repo-2", "repo-2__0", dict(rpm=1))
+
+        self.assertEquals(4, self.Bookkeeping.update_snapshots())
+        self.assertEquals(
+            ["repo-1", "repo-1__0", "repo-1__1", "repo-2", "repo-2__1",
+             "repo-2__2"], self.group("group-1"))
+        self.assertEquals(["repo-2", "repo-2__1", "repo-2__2"],
+                          self.group("group-2"))
+        counts = dict((x['repo_id'], x.get('content_unit_counts'))
+                      for x in self.repos_coll.find())
+        self.assertEquals({"repo-1__0": None, "repo-1__1": dict(rpm=1),
+                           "repo-2__1": dict(rpm=1),
+                           "repo-2__2": dict(rpm=1)}, counts)
+        self.assertEquals(None, self.pending_coll.find_one())
+
+        # Nothing left to do, and running again changes nothing
+        self.assertEquals(0, self.Bookkeeping.update_snapshots())
+        self.Bookkeeping.defer("repo-2", "repo-2__2", dict(rpm=1))
+        self.assertEquals(1, self.Bookkeeping.update_snapshots())
+        self.assertEquals(["repo-2", "repo-2__1", "repo-2__2"],
+                          self.group("group-2"))
+
+    @mock.patch("pulp_snapshot.plugins.distributors.retention.prune")
+    def test_prune_snapshots(self, _prune):
+        for snapshot_id in ["repo-1__1", "repo-1__2", "repo-2__1"]:
+            self.repos_coll.insert_one(dict(repo_id=snapshot_id))
+        self.Bookkeeping.defer_prune(["repo-1__2", "repo-1__1"], 10, 1.0,
+                                     1000, 3)
+        self.Bookkeeping.defer_prune(["repo-2__1"], 5, 0.5, 1000, 3)
+        # Deleted by an earlier run
+        self.Bookkeeping.defer_prune(["repo-2__0"], 5, 0.5, 1000, 3)
+
+        self.assertEquals(0, self.Bookkeeping.update_snapshots())
+        self.assertEquals(
+            [mock.call(["repo-2__1"], batch_size=5, delay=0.5,
+                       copy_batch_size=1000, copy_retries=3),
+             mock.call(["repo-1__1", "repo-1__2"], batch_size=10, delay=1.0,
+                       copy_batch_size=1000, copy_retries=3)],
+            _prune.call_args_list)
+        self.assertEquals(None, self.prune_coll.find_one())
+        self.assertEquals(0, self.Bookkeeping.prune_snapshots())
+
+
+@unittest.skipIf(mongomock is None, "mongomock is not available")
+class TestDeferBookkeeping(SnapshotsTestCase):
+    def setUp(self):
+        super(TestDeferBookkeeping, self).setUp()
+        from pulp_snapshot.plugins.distributors import bookkeeping
+        self.Bookkeeping = bookkeeping
+        self.pending_coll = mongomock.MongoClient().db.pending
+        prefix = "pulp_snapshot.plugins.distributors."
+        self.patches.extend([
+            mock.patch(prefix + "bookkeeping.get_collection",
+                       return_value=self.pending_coll),
+            mock.patch(prefix + "bookkeeping.update_snapshots"),
+            mock.patch(prefix + "publisher.RepoGroup"),
+        ])
+        for patch in self.patches[-3:]:
+            patch.start()
+
+    def test_publish(self):
+        config = dict(snapshot_storage='full', defer_bookkeeping='true')
+        publ = self.Module.Publisher(self.repo, self._config_conduit(),
+                                     config)
+        snapshot_name = publ.publish_snapshot()
+        self.assertFalse(self.Module.RepoGroup.get_collection.called)
+        self.Bookkeeping.update_snapshots.apply_async.assert_called_once_with(
+            countdown=self.Bookkeeping.DELAY)
+        self.assertEquals(
+            [dict(_id=snapshot_name, repo_id="repo-1",
+                  counts=dict(rpm=5, srpm=5))],
+            list(self.pending_coll.find()))
+        # The associations are complete; the counts are left to the task
+        notes = self.notes(snapshot_name)
+        self.assertNotIn('_repository_snapshot_status', notes)
+        self.assertNotIsInstance(
+            self.repos.repos[snapshot_name].content_unit_counts, dict)
+
+    def test_validate_config(self):
+        repo = mock.MagicMock(id="repo-1")
+        validate = self.Distributor.Snapshot_Distributor().validate_config
+        self.assertEquals((True, None),
+                          validate(repo, dict(defer_bookkeeping=True), None))
+        self.assertEquals(
+            (False, 'Configuration key [defer_bookkeeping] must be true or '
+             'false, but was [yes]'),
+            validate(repo, dict(defer_bookkeeping='yes'), None))
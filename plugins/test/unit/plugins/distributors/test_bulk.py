@@ -0,0 +1,210 @@
+import unittest
+
+import mock
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+from pymongo.errors import AutoReconnect, BulkWriteError, OperationFailure
+
+from pulp_snapshot.plugins.distributors import bulk
+from .... import testbase
+from .test_delta import SnapshotsTestCase
+
+
+class TestBulkInsert(testbase.TestCase):
+    def test_batches(self):
+        self.assertEquals([[0, 1, 2], [3, 4, 5], [6]],
+                          list(bulk.batches(iter(range(7)), 3)))
+        self.assertEquals([], list(bulk.batches([], 3)))
+
+    def test_insert(self):
+        coll = mock.MagicMock()
+        callback = mock.MagicMock()
+        documents = (dict(a=i) for i in range(5))
+        self.assertEquals(
+            5, bulk.insert(coll, documents, 2, callback=callback))
+        self.assertEquals(
+            [mock.call([dict(a=0), dict(a=1)], ordered=False),
+             mock.call([dict(a=2), dict(a=3)], ordered=False),
+             mock.call([dict(a=4)], ordered=False)],
+            coll.insert_many.call_args_list)
+        self.assertEquals([mock.call(2), mock.call(2), mock.call(1)],
+                          callback.call_args_list)
+
+    @mock.patch("pulp_snapshot.plugins.distributors.bulk.time.sleep")
+    def test_insert_retry(self, _sleep):
+        coll = mock.MagicMock()
+        # The batch is partially written before the connection drops; the
+        # retry finds the written documents already present
+        coll.insert_many.side_effect = [
+            AutoReconnect("connection reset"),
+            BulkWriteError(dict(writeErrors=[dict(code=11000)])),
+        ]
+        self.assertEquals(2, bulk.insert(coll, [1, 2], 10, retries=1))
+        self.assertEquals(2, coll.insert_many.call_count)
+        _sleep.assert_called_once_with(bulk.RETRY_DELAY)
+
+    @mock.patch("pulp_snapshot.plugins.distributors.bulk.time.sleep")
+    def test_insert_retries_exhausted(self, _sleep):
+        coll = mock.MagicMock()
+        coll.insert_many.side_effect = AutoReconnect("connection reset")
+        self.assertRaises(AutoReconnect, bulk.insert, coll, [1, 2], 10,
+                          retries=2)
+        self.assertEquals(3, coll.insert_many.call_count)
+
+    def test_insert_write_error(self):
+        coll = mock.MagicMock()
+        coll.insert_many.side_effect = BulkWriteError(
+            dict(writeErrors=[dict(code=11000), dict(code=2)]))
+        self.assertRaises(BulkWriteError, bulk.insert, coll, [1, 2], 10,
+                          retries=5)
+        self.assertEquals(1, coll.insert_many.call_count)
+
+
+class TestMergeCopy(testbase.TestCase):
+    @mock.patch("pulp_snapshot.plugins.distributors.bulk.dateutils")
+    def test_merge_copy(self, _dateutils):
+        _dateutils.format_iso8601_datetime.return_value = "2009-02-13T23:31"
+        coll = mock.MagicMock()
+        coll.name = "repo_content_units"
+        coll.aggregate.side_effect = [
+            iter([]), iter([dict(_id="rpm", count=3)])]
+        query = dict(repo_id="repo-1", unit_type_id="rpm")
+        self.assertEquals(
+            dict(rpm=3), bulk.merge_copy(coll, query, "repo-1__1"))
+        pipeline = coll.aggregate.call_args_list[0][0][0]
+        self.assertEquals({'$match': query}, pipeline[0])
+        self.assertEquals(
+            {'repo_id': {'$literal': "repo-1__1"},
+             'created': {'$literal': "2009-02-13T23:31"},
+             'updated': {'$literal': "2009-02-13T23:31"},
+             '_id': 0, 'unit_type_id': 1, 'unit_id': 1},
+            pipeline[1]['$project'])
+        self.assertEquals(
+            {'into': "repo_content_units",
+             'on': ['repo_id', 'unit_id', 'unit_type_id'],
+             'whenMatched': 'keepExisting', 'whenNotMatched': 'insert'},
+            pipeline[2]['$merge'])
+        self.assertEquals(
+            [{'$match': {'repo_id': "repo-1__1"}},
+             {'$group': {'_id': '$unit_type_id', 'count': {'$sum': 1}}}],
+            coll.aggregate.call_args_list[1][0][0])
+
+    def test_supports_merge_copy(self):
+        coll = mock.MagicMock()
+        server_info = coll.database.client.server_info
+        for version, expected in [([4, 2, 8, 0], False), ([4, 4, 0, 0], True),
+                                  ([5, 0, 1, 0], True), ([], False)]:
+            server_info.return_value = dict(versionArray=version)
+            self.assertEquals(expected, bulk.supports_merge_copy(coll))
+
+
+@unittest.skipIf(mongomock is None, "mongomock is not available")
+class TestServerCopy(SnapshotsTestCase):
+    """
+    Copying snapshot associations with $merge, which mongomock lacks; the
+    aggregation is run without its $merge stage and its results inserted.
+    """
+    def setUp(self):
+        super(TestServerCopy, self).setUp()
+        self.merges = []
+        self.before_merge = None
+        aggregate = self.units_coll.aggregate
+
+        def merge(pipeline, **kwargs):
+            if '$merge' not in pipeline[-1]:
+                return aggregate(pipeline, **kwargs)
+            self.merges.append(pipeline)
+            if self.before_merge is not None:
+                self.before_merge()
+            for doc in aggregate(pipeline[:-1], **kwargs):
+                key = dict((x, doc[x]) for x in pipeline[-1]['$merge']['on'])
+                if not self.units_coll.find_one(key):
+                    self.units_coll.insert_one(doc)
+            return iter([])
+        self.units_coll.aggregate = merge
+        # mongomock says it is MongoDB 3.0
+        patch = mock.patch.object(self.Module.bulk, "supports_merge_copy",
+                                  return_value=True)
+        self.supports_merge_copy = patch.start()
+        self.addCleanup(patch.stop)
+
+    def check_snapshot(self, snapshot_id, digest=True):
+        self.assertEquals(self.units("repo-1"), self.units(snapshot_id))
+        expected = self.Module.UnitSetDigest.from_units(
+            self.Module.REPO_UNIT(*x) for x in self.units("repo-1"))
+        notes = self.notes(snapshot_id)
+        if digest:
+            self.assertEquals(expected.hexdigest(),
+                              notes['_repository_digest'])
+        else:
+            self.assertNotIn('_repository_digest', notes)
+        self.assertEquals(expected.counts,
+                          notes['_repository_unit_counts'])
+        self.assertEquals(expected.counts,
+                          self.repos.repos[snapshot_id].content_unit_counts)
+
+    def test_server_copy(self):
+        for engine in self.Configuration.constants.DIFF_ENGINES:
+            self.set_units(range(len(self.merges), 10))
+            snapshot_id, created, publ = self.snapshot(
+                snapshot_storage='full', copy_engine='server',
+                diff_engine=engine)
+            self.assertTrue(created)
+            # The merge diff reads no units before the copy
+            self.check_snapshot(snapshot_id, digest=engine != 'merge')
+            self.assertEquals(dict(repo_id="repo-1"),
+                              self.merges[-1][0]['$match'])
+            self.assertEquals(len(self.units(snapshot_id)),
+                              publ.progress_successes)
+        self.assertEquals(3, len(self.merges))
+
+    def test_changed_while_copying(self):
+        def change():
+            self.units_coll.insert_one(dict(
+                repo_id="repo-1", unit_type_id="rpm", unit_id="0100"))
+        self.before_merge = change
+        snapshot_id, created, publ = self.snapshot(
+            snapshot_storage='full', copy_engine='server')
+        # The units read before the copy no longer describe the snapshot,
+        # and what was copied is not read back
+        self.check_snapshot(snapshot_id, digest=False)
+        self.assertIn(("rpm", "0100"), self.units(snapshot_id))
+        self.assertEquals(len(self.units("repo-1")) - 1,
+                          publ.units_read['documents'])
+        # The next publish comparing with it records its digest
+        self.before_merge = None
+        self.assertEquals((snapshot_id, False),
+                          self.snapshot(snapshot_storage='full',
+                                        copy_engine='server')[:2])
+        self.check_snapshot(snapshot_id)
+
+    def test_no_units_read(self):
+        snapshot_id, created, publ = self.snapshot(
+            snapshot_storage='full', copy_engine='server',
+            diff_engine='merge')
+        self.assertTrue(created)
+        self.check_snapshot(snapshot_id, digest=False)
+        self.assertEquals(0, publ.units_read['documents'])
+        (_spec, update), _kwargs = self.index_collection.update_one.call_args
+        self.assertEquals(
+            [dict(snapshot_id=snapshot_id, timestamp=mock.ANY, digest=None,
+                  units=len(self.units("repo-1")))],
+            update['$push']['snapshots']['$each'])
+
+    def test_old_server(self):
+        self.supports_merge_copy.return_value = False
+        snapshot_id, created, _publ = self.snapshot(
+            snapshot_storage='full', copy_engine='server')
+        self.check_snapshot(snapshot_id)
+        self.assertEquals([], self.merges)
+
+    def test_fallback(self):
+        def unsupported(pipeline, **kwargs):
+            raise OperationFailure("Unrecognized pipeline stage name: "
+                                   "'$merge'")
+        self.units_coll.aggregate = unsupported
+        snapshot_id, created, _publ = self.snapshot(
+            snapshot_storage='full', copy_engine='server')
+        self.check_snapshot(snapshot_id)
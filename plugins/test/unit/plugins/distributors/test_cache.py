@@ -0,0 +1,157 @@
+import unittest
+
+import mock
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+from pulp_snapshot.plugins.distributors import cache, unitkeys
+from .test_delta import SnapshotsTestCase
+
+
+def unit_set(*numbers):
+    return unitkeys.UnitKeySet((u"rpm", u"%04d" % i) for i in numbers)
+
+
+class TestUnitSetCache(unittest.TestCase):
+    def setUp(self):
+        self.nbytes = unit_set(1).nbytes
+        self.cache = cache.UnitSetCache(3 * self.nbytes)
+
+    def test_lru(self):
+        for name in "abc":
+            self.cache.put(name, unit_set(1))
+        self.assertEquals(unit_set(1), self.cache.get("a"))
+        # "b" is now the least recently used
+        self.cache.put("d", unit_set(2))
+        self.assertIsNone(self.cache.get("b"))
+        for name in "acd":
+            self.assertIsNotNone(self.cache.get(name))
+        self.assertEquals(
+            dict(hits=4, misses=1, evictions=1, entries=3,
+                 bytes=3 * self.nbytes, max_bytes=3 * self.nbytes),
+            self.cache.stats())
+
+    def test_too_large(self):
+        self.cache.put("a", unit_set(1))
+        self.cache.put("b", unit_set(*range(100)))
+        self.assertIsNone(self.cache.get("b"))
+        self.assertIsNotNone(self.cache.get("a"))
+
+    def test_replace(self):
+        self.cache.put("a", unit_set(1))
+        self.cache.put("a", unit_set(2))
+        self.assertEquals(unit_set(2), self.cache.get("a"))
+        self.assertEquals(self.nbytes, self.cache.stats()['bytes'])
+
+    def test_invalidate(self):
+        for name in "abc":
+            self.cache.put(name, unit_set(1))
+        self.cache.invalidate(["a", "c", "x"])
+        self.assertIsNone(self.cache.get("a"))
+        self.assertIsNotNone(self.cache.get("b"))
+        self.assertEquals(1, self.cache.stats()['entries'])
+
+    def test_resize(self):
+        for name in "abc":
+            self.cache.put(name, unit_set(1))
+        self.cache.resize(self.nbytes)
+        self.assertEquals(["c"], [x for x in "abc" if self.cache.get(x)])
+
+
+class TestGetCache(unittest.TestCase):
+    def setUp(self):
+        cache._cache = None
+
+    def tearDown(self):
+        cache._cache = None
+
+    def test_get_cache(self):
+        self.assertIsNone(cache.get_cache(0))
+        unit_cache = cache.get_cache(1000)
+        self.assertIs(unit_cache, cache.get_cache(2000))
+        self.assertEquals(2000, unit_cache.max_bytes)
+        # Smaller sizes do not shrink it
+        unit_cache.put("a", unit_set(1))
+        self.assertIs(unit_cache, cache.get_cache(1))
+        self.assertEquals(2000, unit_cache.max_bytes)
+        self.assertIsNotNone(unit_cache.get("a"))
+
+    def test_invalidate(self):
+        # Nothing to do while the cache is not in use
+        cache.invalidate(["a"])
+        cache.get_cache(1000).put("a", unit_set(1))
+        cache.invalidate(["a"])
+        self.assertIsNone(cache.get_cache(1000).get("a"))
+
+
+@unittest.skipIf(mongomock is None, "mongomock is not available")
+class TestCachedSnapshots(SnapshotsTestCase):
+    def setUp(self):
+        super(TestCachedSnapshots, self).setUp()
+        cache._cache = None
+
+    def tearDown(self):
+        cache._cache = None
+        super(TestCachedSnapshots, self).tearDown()
+
+    def snapshot_queries(self, find):
+        return [x[0][0]['repo_id'] for x in find.call_args_list
+                if x[0][0].get('repo_id') != "repo-1"]
+
+    def test_full_snapshots(self):
+        config = dict(snapshot_storage='full', unit_cache_size=2 ** 20)
+        full, _created, _publ = self.snapshot(**config)
+        self.set_units(range(1, 12))
+        snap, created, publ = self.snapshot(**config)
+        self.assertTrue(created)
+        self.assertEquals(self.units("repo-1"), self.units(snap))
+        self.assertEquals(
+            self.units("repo-1"), list(cache.get_cache(2 ** 20).get(snap)))
+        stats = publ.get_progress_report_summary()['unit_cache']
+        self.assertEquals(2, stats['entries'])
+
+    def test_streamed_snapshots(self):
+        config = dict(snapshot_storage='full', diff_engine='merge',
+                      unit_cache_size=2 ** 20)
+        full, _created, _publ = self.snapshot(**config)
+        self.assertEquals(
+            self.units("repo-1"),
+            list(cache.get_cache(2 ** 20).get(full)))
+
+    def test_delta_snapshots(self):
+        config = dict(unit_cache_size=2 ** 20)
+        self.snapshot(**config)
+        self.set_units(range(1, 12))
+        snap1, _created, _publ = self.snapshot(**config)
+        self.assertEquals(
+            sorted(self.Delta.logical_units(self.units_coll, snap1)),
+            list(cache.get_cache(2 ** 20).get(snap1)))
+        self.set_units(range(2, 13))
+        with mock.patch.object(self.units_coll, "find",
+                               wraps=self.units_coll.find) as find:
+            snap2, _created, publ = self.snapshot(**config)
+        self.assertEquals(dict(added=1, removed=1), publ.units_diff)
+        # The base snapshot was not read
+        self.assertEquals([], self.snapshot_queries(find))
+        stats = publ.get_progress_report_summary()['unit_cache']
+        self.assertEquals(3, stats['entries'])
+        self.assertEquals(0, stats['misses'])
+        self.assertEquals(self.units("repo-1"), sorted(
+            self.Delta.logical_units(self.units_coll, snap2)))
+
+    def test_disabled(self):
+        _full, _created, publ = self.snapshot()
+        self.assertIsNone(cache._cache)
+        self.assertNotIn('unit_cache', publ.get_progress_report_summary())
+
+    def test_validate_config(self):
+        repo = mock.MagicMock(id="repo-1")
+        validate = self.Distributor.Snapshot_Distributor().validate_config
+        self.assertEquals((True, None),
+                          validate(repo, dict(unit_cache_size=0), None))
+        self.assertEquals(
+            (False, 'Configuration key [unit_cache_size] must be an integer '
+             'greater than or equal to 0, but was [-1]'),
+            validate(repo, dict(unit_cache_size=-1), None))
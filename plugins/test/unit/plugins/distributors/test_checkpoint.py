@@ -0,0 +1,182 @@
+import datetime
+import threading
+import unittest
+
+import mock
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+from pulp.server.exceptions import PulpCodedException
+from .test_delta import SnapshotsTestCase
+from .test_distributor import HEARTBEAT
+
+
+@unittest.skipIf(mongomock is None, "mongomock is not available")
+class TestResume(SnapshotsTestCase):
+    def setUp(self):
+        super(TestResume, self).setUp()
+        from pulp_snapshot.plugins.distributors import checkpoint
+        self.Checkpoint = checkpoint
+        self.repo.last_unit_added = self.repo.last_unit_removed = None
+        self.insert_many = self.units_coll.insert_many
+        self.inserts = []
+
+    def crash_after(self, batches):
+        """
+        Make the worker die while writing the batch after the given number.
+        """
+        def insert_many(documents, **kwargs):
+            self.inserts.append(len(documents))
+            if len(self.inserts) > batches:
+                raise RuntimeError("worker lost")
+            return self.insert_many(documents, **kwargs)
+        self.units_coll.insert_many = insert_many
+
+    def crash(self, **config):
+        config.setdefault('snapshot_storage', 'full')
+        self.crash_after(2)
+        with self.assertRaises(RuntimeError):
+            self.snapshot(copy_batch_size=3, **config)
+        self.units_coll.insert_many = self.insert_many
+        (snapshot_id, notes), = self.Checkpoint.find_incomplete("repo-1")
+        return snapshot_id, notes
+
+    def check_resume(self, **config):
+        snapshot_id, notes = self.crash(**config)
+        # Two batches of three units were written
+        self.assertEquals(("srpm", "0001"), self.Checkpoint.last_unit(notes))
+        self.assertEquals(6, len(self.units(snapshot_id)))
+        self.assertEquals(None, self.repo.notes.get('_repository_snapshot'))
+
+        self.inserts = []
+        self.crash_after(10)
+        snapshot_name, created, publ = self.snapshot(
+            snapshot_storage='full', copy_batch_size=3, **config)
+        self.assertEquals((snapshot_id, True), (snapshot_name, created))
+        # Only the units after the checkpoint were written again
+        self.assertEquals([3, 1], self.inserts)
+        self.assertEquals(self.units("repo-1"), self.units(snapshot_id))
+        self.assertEquals([snapshot_id], sorted(self.repos.repos))
+        notes = self.notes(snapshot_id)
+        self.assertFalse(self.Checkpoint.is_incomplete(notes))
+        self.assertNotIn('_repository_snapshot_checkpoint', notes)
+        expected = self.Module.UnitSetDigest.from_units(
+            self.Module.REPO_UNIT(*x) for x in self.units("repo-1"))
+        self.assertEquals(expected.hexdigest(), notes['_repository_digest'])
+        self.assertEquals(dict(rpm=5, srpm=5),
+                          self.repos.repos[snapshot_id].content_unit_counts)
+        self.assertEquals([], self.Checkpoint.find_incomplete("repo-1"))
+
+    def test_resume_python(self):
+        self.check_resume(diff_engine='python')
+
+    def test_resume_merge(self):
+        self.check_resume(diff_engine='merge')
+
+    def test_changed(self):
+        snapshot_id, _notes = self.crash()
+        self.set_units(range(12))
+        with mock.patch.object(self.Module.retention, "prune") as prune:
+            snapshot_name, created, _publ = self.snapshot(
+                snapshot_storage='full')
+        self.assertTrue(created)
+        self.assertNotEquals(snapshot_id, snapshot_name)
+        prune.assert_called_once_with([snapshot_id], 10, 0, 1000, 3)
+        self.assertEquals(self.units("repo-1"), self.units(snapshot_name))
+
+    def test_changed_merge(self):
+        # Without a digest, the repository's last unit times tell
+        snapshot_id, _notes = self.crash(diff_engine='merge')
+        self.repo.last_unit_removed = datetime.datetime(2100, 1, 1)
+        with mock.patch.object(self.Module.retention, "prune") as prune:
+            snapshot_name, created, _publ = self.snapshot(
+                snapshot_storage='full', diff_engine='merge')
+        self.assertNotEquals(snapshot_id, snapshot_name)
+        prune.assert_called_once_with([snapshot_id], 10, 0, 1000, 3)
+
+    def test_delta_not_resumed(self):
+        self.snapshot()
+        self.set_units(range(1, 12))
+        with self.assertRaises(RuntimeError):
+            with mock.patch.object(self.Delta, "write_changes",
+                                   side_effect=RuntimeError()):
+                self.snapshot()
+        (snapshot_id, _notes), = self.Checkpoint.find_incomplete("repo-1")
+        with mock.patch.object(self.Module.retention, "prune") as prune:
+            snapshot_name, created, _publ = self.snapshot()
+        self.assertTrue(created)
+        prune.assert_called_once_with([snapshot_id], 10, 0, 1000, 3)
+
+    def test_other_repository(self):
+        # A repository whose id starts like the snapshots of repo-1
+        snapshot_id, _notes = self.crash()
+        other = "repo-1__x__20090213233130.1234Z"
+        self.repos.create_repo(other, notes=dict(
+            self.notes(snapshot_id), _repository_snapshot=other))
+        self.assertEquals([snapshot_id], [
+            x[0] for x in self.Checkpoint.find_incomplete("repo-1")])
+        self.assertEquals([other], [
+            x[0] for x in self.Checkpoint.find_incomplete("repo-1__x")])
+
+    def test_owned(self):
+        # Still being written by a publish of the repository's group
+        snapshot_id, _notes = self.crash()
+        self.notes(snapshot_id).update(
+            _repository_snapshot_owner="group",
+            _repository_snapshot_heartbeat=HEARTBEAT - 10)
+        with mock.patch.object(self.Module.retention, "prune") as prune:
+            snapshot_name, created, _publ = self.snapshot(
+                snapshot_storage='full')
+        self.assertTrue(created)
+        self.assertNotEquals(snapshot_id, snapshot_name)
+        self.assertFalse(prune.called)
+        self.assertEquals("group", self.notes(snapshot_id)[
+            '_repository_snapshot_owner'])
+
+    def test_owner_died(self):
+        snapshot_id, _notes = self.crash()
+        # The worker was killed, the snapshot was never released
+        self.notes(snapshot_id).update(
+            _repository_snapshot_owner="lost",
+            _repository_snapshot_heartbeat=(
+                HEARTBEAT - self.Checkpoint.OWNER_TIMEOUT))
+        snapshot_name, created, publ = self.snapshot(
+            snapshot_storage='full', copy_batch_size=3)
+        self.assertEquals((snapshot_id, True), (snapshot_name, created))
+        self.assertEquals(self.units("repo-1"), self.units(snapshot_id))
+        self.assertNotIn('_repository_snapshot_owner',
+                         self.notes(snapshot_id))
+
+    def test_taken_over(self):
+        def insert_many(documents, **kwargs):
+            # Another publish decides this one is dead
+            snapshot_id, notes = self.Checkpoint.find_incomplete("repo-1")[0]
+            self.Checkpoint.take_over(snapshot_id, notes, "other")
+            return self.insert_many(documents, **kwargs)
+        self.units_coll.insert_many = insert_many
+        with self.assertRaises(PulpCodedException):
+            self.snapshot(snapshot_storage='full', copy_batch_size=3)
+        (snapshot_id, notes), = self.Checkpoint.find_incomplete("repo-1")
+        # Neither released nor advanced by the publish that lost it
+        self.assertEquals("other", notes['_repository_snapshot_owner'])
+        self.assertEquals(HEARTBEAT, notes['_repository_snapshot_heartbeat'])
+        self.assertEquals(None, self.Checkpoint.last_unit(notes))
+
+    def test_heartbeat(self):
+        snapshot_id, _notes = self.crash()
+        self.assertTrue(self.Checkpoint.take_over(
+            snapshot_id, self.notes(snapshot_id), "owner"))
+        beats = threading.Semaphore(0)
+
+        def beat(snapshot_id, owner):
+            self.assertEquals("owner", owner)
+            beats.release()
+        with mock.patch.object(self.Checkpoint, "HEARTBEAT_INTERVAL", 0.01), \
+                mock.patch.object(self.Checkpoint, "beat", beat):
+            with self.Checkpoint.owned(snapshot_id, "owner"):
+                beats.acquire()
+                beats.acquire()
+        self.assertTrue(self.Checkpoint.beat(snapshot_id, "owner"))
+        self.assertFalse(self.Checkpoint.beat(snapshot_id, "other"))
@@ -0,0 +1,181 @@
+import datetime
+import unittest
+
+import mock
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+from .test_distributor import BaseTest
+
+NOW = 1234567890.0
+
+
+class Clock(object):
+    """
+    Time that only passes while sleeping.
+    """
+    def __init__(self, now):
+        self.now = now
+        self.sleeps = []
+        self.on_sleep = None
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+        if self.on_sleep is not None:
+            self.on_sleep()
+
+
+@unittest.skipIf(mongomock is None, "mongomock is not available")
+class TestCoalesce(BaseTest):
+    def setUp(self):
+        super(TestCoalesce, self).setUp()
+        from pulp_snapshot.plugins.distributors import coalesce
+        self.Coalesce = coalesce
+        self.collection = mongomock.MongoClient().db.repo_snapshot_leases
+        self.clock = Clock(NOW)
+        self.patches = [
+            mock.patch.object(coalesce, "get_collection",
+                              return_value=self.collection),
+            mock.patch.object(coalesce, "clock", self.clock),
+            mock.patch.object(coalesce, "sleep", self.clock.sleep),
+        ]
+        for patch in self.patches:
+            patch.start()
+        self.repo = mock.MagicMock(id="repo-1", last_unit_added=None,
+                                   last_unit_removed=None)
+        self.publish = mock.MagicMock(return_value="repo-1__1")
+
+    def tearDown(self):
+        for patch in reversed(self.patches):
+            patch.stop()
+        super(TestCoalesce, self).tearDown()
+
+    def run_publish(self, window=5):
+        return self.Coalesce.run(self.repo, window, 60, self.publish)
+
+    def test_run(self):
+        # No other request: nothing to wait for
+        self.assertEquals(("repo-1__1", False), self.run_publish())
+        self.publish.assert_called_once_with()
+        self.assertEquals([], self.clock.sleeps)
+        doc = self.Coalesce.get("repo-1")
+        self.assertEquals(None, doc['holder'])
+        self.assertEquals("repo-1__1", doc['result'])
+        self.assertEquals(NOW, doc['covers'])
+
+    def test_burst(self):
+        self.Coalesce.request("repo-1", NOW - 1)
+
+        # Another request comes in while the holder waits for quiet
+        def request():
+            self.clock.on_sleep = None
+            self.Coalesce.request("repo-1", self.clock.now - 2)
+        self.clock.on_sleep = request
+        self.assertEquals(("repo-1__1", False), self.run_publish())
+        self.assertEquals([5, 3], self.clock.sleeps)
+        self.assertEquals(NOW + 8, self.Coalesce.get("repo-1")['covers'])
+
+    def test_no_burst(self):
+        # The last request is older than the window
+        self.Coalesce.request("repo-1", NOW - 6)
+        self.assertEquals(("repo-1__1", False), self.run_publish())
+        self.assertEquals([], self.clock.sleeps)
+
+    def test_renew(self):
+        # The lease is renewed while the publish runs
+        beats = []
+        clock = self.clock
+
+        class Heartbeat(object):
+            def __init__(self, interval, beat):
+                beats.append(interval)
+                self.beat = beat
+
+            def __enter__(self):
+                clock.now += 50
+                self.beat()
+
+            def __exit__(self, *exc_info):
+                pass
+
+        def publish():
+            self.assertEquals(NOW + 110,
+                              self.Coalesce.get("repo-1")['expires'])
+            return "repo-1__1"
+        with mock.patch.object(self.Coalesce.heartbeat, "Heartbeat",
+                               Heartbeat):
+            self.assertEquals(("repo-1__1", False),
+                              self.Coalesce.run(self.repo, 5, 60, publish))
+        self.assertEquals([20.0], beats)
+
+    def test_wait_for_holder(self):
+        self.collection.insert_one(dict(_id="repo-1", holder="other",
+                                        expires=NOW + 60))
+
+        def release():
+            self.Coalesce.release("repo-1", "other", "repo-1__0",
+                                  covers=self.clock.now)
+        self.clock.on_sleep = release
+        self.assertEquals(("repo-1__0", True), self.run_publish())
+        self.assertFalse(self.publish.called)
+
+    def test_expired_lease(self):
+        self.collection.insert_one(dict(_id="repo-1", holder="other",
+                                        expires=NOW - 1))
+        self.assertEquals(("repo-1__1", False), self.run_publish(window=0))
+        self.publish.assert_called_once_with()
+        self.assertEquals([], self.clock.sleeps)
+
+    def test_recent_run(self):
+        self.collection.insert_one(dict(
+            _id="repo-1", holder=None, result="repo-1__0",
+            covers=NOW - 3, finished=NOW - 2))
+        self.repo.last_unit_added = datetime.datetime.utcfromtimestamp(
+            NOW - 10)
+        self.assertEquals(("repo-1__0", True), self.run_publish())
+
+        # Units were added since the run started
+        self.repo.last_unit_added = datetime.datetime.utcfromtimestamp(
+            NOW - 1)
+        self.assertEquals(("repo-1__1", False), self.run_publish())
+
+        # Or there is no telling
+        del self.repo.last_unit_removed
+        self.assertFalse(self.Coalesce.unchanged_since(self.repo, NOW))
+
+    def test_failed_publish(self):
+        self.publish.side_effect = RuntimeError()
+        with self.assertRaises(RuntimeError):
+            self.run_publish(window=0)
+        doc = self.Coalesce.get("repo-1")
+        self.assertEquals(None, doc['holder'])
+        self.assertNotIn('covers', doc)
+
+    def test_process_main(self):
+        repo = mock.MagicMock(id="repo-1", notes={})
+        config = dict(coalesce_window=5)
+        publ = self.Module.Publisher(repo, self._config_conduit(), config)
+        with mock.patch.object(self.Coalesce, "run",
+                               return_value=("repo-1__0", True)) as run:
+            publ.process_main()
+        run.assert_called_once_with(repo, 5.0, 3600, publ.publish_snapshot)
+        self.assertEquals("repo-1__0", publ.repo_snapshot)
+        self.assertTrue(publ.get_progress_report_summary()['coalesced'])
+
+    def test_validate_config(self):
+        repo = mock.MagicMock(id="repo-1")
+        validate = self.Distributor.Snapshot_Distributor().validate_config
+        self.assertEquals(
+            (True, None),
+            validate(repo, dict(coalesce_window=2.5,
+                                coalesce_lease_timeout=600), None))
+        self.assertEquals(
+            (False, 'Configuration key [coalesce_window] must be a number '
+             'greater than or equal to 0, but was [-1]'),
+            validate(repo, dict(coalesce_window=-1), None))
@@ -0,0 +1,117 @@
+import unittest
+
+import mock
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+from .test_delta import SnapshotsTestCase
+from .test_distributor import BaseTest
+
+
+class TestUnitFilter(BaseTest):
+    def validate(self, **config):
+        return self.Configuration.validate_config(
+            mock.MagicMock(id="repo-1"), config, None)
+
+    def test_get_unit_filter(self):
+        get_unit_filter = self.Configuration.get_unit_filter
+        self.assertEquals({}, get_unit_filter({}))
+        self.assertEquals(
+            dict(unit_type_id={'$in': ["erratum", "rpm"],
+                               '$nin': ["srpm"]},
+                 unit_id={'$gte': "0005"}),
+            get_unit_filter(dict(include_types="rpm, erratum",
+                                 exclude_types=["srpm"],
+                                 unit_criteria=dict(
+                                     unit_id={'$gte': "0005"}))))
+
+    def test_validate_types(self):
+        self.assertEquals(
+            (True, None),
+            self.validate(include_types=["rpm", "erratum"],
+                          exclude_types="srpm,drpm"))
+        self.assertEquals(
+            (False, 'Configuration key [include_types] must be a list of '
+             'unit type ids, but was [[]]'),
+            self.validate(include_types=[]))
+        self.assertEquals(
+            (False, 'Configuration key [exclude_types] must be a list of '
+             'unit type ids, but was [[1]]'),
+            self.validate(exclude_types=[1]))
+
+    def test_validate_criteria(self):
+        self.assertEquals(
+            (True, None),
+            self.validate(unit_criteria=dict(
+                created={'$gte': "2016-01-01T00:00:00Z"},
+                unit_id="0001")))
+        self.assertEquals(
+            (False, 'Configuration key [unit_criteria] must be a dictionary, '
+             'but was [rpm]'),
+            self.validate(unit_criteria="rpm"))
+        self.assertEquals(
+            (False, 'Configuration key [unit_criteria] may only restrict the '
+             'fields created, unit_id, updated, but restricts [repo_id]'),
+            self.validate(unit_criteria=dict(repo_id="repo-2")))
+        self.assertEquals(
+            (False, 'Configuration key [unit_criteria] may only use the '
+             'operators $eq, $gt, $gte, $in, $lt, $lte, $ne, $nin, $regex, '
+             'but uses [$where]'),
+            self.validate(unit_criteria=dict(unit_id={'$where': "1"})))
+        self.assertEquals(
+            (False, 'Configuration key [unit_criteria] must give a list of '
+             'values for [$in], but was [0001]'),
+            self.validate(unit_criteria=dict(unit_id={'$in': "0001"})))
+
+
+@unittest.skipIf(mongomock is None, "mongomock is not available")
+class TestFilteredSnapshots(SnapshotsTestCase):
+    def check_filtered(self, **config):
+        config.update(include_types=["rpm"])
+        first, created, _publ = self.snapshot(**config)
+        self.assertTrue(created)
+        self.assertEquals(
+            [("rpm", "%04d" % i) for i in range(0, 10, 2)],
+            sorted(self.Delta.logical_units(self.units_coll, first)))
+
+        # Excluded units are not compared
+        self.set_units(range(0, 10, 2) + [11, 13])
+        self.assertEquals((first, False), self.snapshot(**config)[:2])
+
+        self.set_units(range(0, 12, 2))
+        second, created, publ = self.snapshot(**config)
+        self.assertTrue(created)
+        self.assertEquals(
+            [("rpm", "%04d" % i) for i in range(0, 12, 2)],
+            sorted(self.Delta.logical_units(self.units_coll, second)))
+        self.assertEquals(dict(rpm=6),
+                          self.notes(second)['_repository_unit_counts'])
+
+    def test_python(self):
+        self.check_filtered(snapshot_storage='full', diff_engine='python')
+
+    def test_aggregate(self):
+        self.check_filtered(snapshot_storage='full', diff_engine='aggregate')
+
+    def test_merge(self):
+        self.check_filtered(snapshot_storage='full', diff_engine='merge')
+
+    def test_delta(self):
+        self.check_filtered(unit_criteria=dict(unit_id={'$lt': "0020"}))
+
+    def test_restore(self):
+        snapshot, _created, _publ = self.snapshot(include_types=["rpm"])
+        self.set_units(range(1, 15))
+        publ = self.Module.Publisher(
+            self.repo, self._config_conduit(),
+            dict(restore_snapshot=snapshot, include_types=["rpm"]))
+        with mock.patch.object(self.Module.restore, "RepoModel"):
+            publ.process_main()
+        # The srpm units are left alone
+        self.assertEquals(
+            sorted([("rpm", "%04d" % i) for i in range(0, 10, 2)] +
+                   [("srpm", "%04d" % i) for i in range(1, 15, 2)]),
+            self.units("repo-1"))
+        self.assertEquals(dict(added=1, removed=3), publ.units_diff)
@@ -0,0 +1,337 @@
+import unittest
+
+import mock
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+from .test_distributor import BaseTest
+
+
+class Repos(object):
+    """
+    Repositories created by the publisher, and their notes.
+    """
+    def __init__(self):
+        self.repos = {}
+        self.distributors = {}
+
+    def create_repo(self, repo_id, notes=None, distributor_list=(),
+                    **kwargs):
+        self.repos[repo_id] = mock.MagicMock(repo_id=repo_id,
+                                             notes=dict(notes))
+        self.distributors[repo_id] = list(distributor_list)
+        return self.repos[repo_id]
+
+    def objects(self, repo_id=None, repo_id__startswith=None, **kwargs):
+        query = mock.MagicMock()
+        query.first.return_value = self.repos.get(repo_id)
+        notes = dict((key.split('__')[-1], value)
+                     for key, value in kwargs.items()
+                     if key.startswith('notes__'))
+
+        def matches(repo):
+            return all(repo.notes.get(k) == v for k, v in notes.items())
+        if repo_id__startswith is not None:
+            query.only.return_value = [
+                x for key, x in sorted(self.repos.items())
+                if key.startswith(repo_id__startswith) and matches(x)]
+
+        def update_one(**kwargs):
+            repo = self.repos.get(repo_id)
+            if repo is None or not matches(repo):
+                return 0
+            for key, value in kwargs.items():
+                if not key.startswith(('set__notes__', 'unset__notes__')):
+                    # set__<field>
+                    setattr(repo, key.split('__', 1)[1], value)
+                    continue
+                operator, _notes, note = key.split('__', 2)
+                if operator == 'set':
+                    repo.notes[note] = value
+                else:
+                    repo.notes.pop(note, None)
+            return 1
+        query.update_one.side_effect = update_one
+        return query
+
+
+class DeltaBaseTest(BaseTest):
+    def setUp(self):
+        super(DeltaBaseTest, self).setUp()
+        from pulp_snapshot.plugins.distributors import delta
+        self.Delta = delta
+
+
+class TestApplyChanges(DeltaBaseTest):
+    def test_apply_changes(self):
+        ADDED, REMOVED = self.Module.diff.ADDED, self.Module.diff.REMOVED
+        units = [("rpm", "1"), ("rpm", "3"), ("srpm", "5")]
+        changes = [(ADDED, ("erratum", "0")), (REMOVED, ("rpm", "1")),
+                   (ADDED, ("rpm", "2")), (ADDED, ("srpm", "6"))]
+        self.assertEquals(
+            [("erratum", "0"), ("rpm", "2"), ("rpm", "3"), ("srpm", "5"),
+             ("srpm", "6")],
+            list(self.Delta.apply_changes(units, changes)))
+        self.assertEquals(units,
+                          list(self.Delta.apply_changes(units, [])))
+        self.assertEquals([("rpm", "2")], list(self.Delta.apply_changes(
+            [], [(ADDED, ("rpm", "2")), (REMOVED, ("rpm", "4"))])))
+
+    def test_round_trip(self):
+        old = [("rpm", "1"), ("rpm", "2"), ("srpm", "9")]
+        new = [("rpm", "2"), ("rpm", "3"), ("srpm", "4")]
+        changes = list(self.Module.diff.merge_diff(new, old))
+        self.assertEquals(new,
+                          list(self.Delta.apply_changes(old, changes)))
+
+
+class SnapshotsTestCase(DeltaBaseTest):
+    """
+    Snapshots of a repository in mongomock, with delta storage.
+    """
+    def setUp(self):
+        super(SnapshotsTestCase, self).setUp()
+        db = mongomock.MongoClient().db
+        self.units_coll = db.repo_content_units
+        self.delta_coll = db.repo_snapshot_deltas
+        self.repos = Repos()
+        prefix = "pulp_snapshot.plugins.distributors."
+        self.patches = [
+            mock.patch(prefix + "delta.connection", **{
+                'get_collection.return_value': self.delta_coll}),
+            mock.patch(prefix + "delta.RepoModel", objects=self.repos.objects),
+            mock.patch(prefix + "checkpoint.RepoModel",
+                       objects=self.repos.objects),
+            mock.patch(prefix + "publisher.RepoModel",
+                       objects=self.repos.objects),
+            mock.patch(prefix + "delta.RepoContentUnit", side_effect=dict,
+                       **{'get_collection.return_value': self.units_coll}),
+            mock.patch(prefix + "publisher.RepoContentUnit",
+                       side_effect=dict,
+                       **{'get_collection.return_value': self.units_coll}),
+            mock.patch(prefix + "publisher.RepoImporter"),
+            mock.patch(prefix + "publisher.repo_controller",
+                       create_repo=self.repos.create_repo),
+        ]
+        for patch in self.patches:
+            patch.start()
+        self.repo = mock.MagicMock(id="repo-1", notes={})
+        self.now = 1234567890.0
+        self.set_units(range(10))
+
+    def tearDown(self):
+        for patch in reversed(self.patches):
+            patch.stop()
+        super(SnapshotsTestCase, self).tearDown()
+
+    def set_units(self, numbers):
+        self.units_coll.delete_many(dict(repo_id="repo-1"))
+        for i in numbers:
+            self.units_coll.insert_one(dict(
+                repo_id="repo-1", unit_type_id=["rpm", "srpm"][i % 2],
+                unit_id="%04d" % i))
+
+    def units(self, repo_id):
+        return sorted((x['unit_type_id'], x['unit_id'])
+                      for x in self.units_coll.find(dict(repo_id=repo_id)))
+
+    def snapshot(self, **config):
+        config.setdefault('snapshot_storage', 'delta')
+        config.setdefault('checkpoint_interval', 3)
+        publ = self.Module.Publisher(self.repo, self._config_conduit(),
+                                     config)
+        self.now += 1
+        snapshot_name, created = publ.snapshot(self.now)
+        self.repo.notes['_repository_snapshot'] = snapshot_name
+        return snapshot_name, created, publ
+
+    def notes(self, repo_id):
+        return self.repos.repos[repo_id].notes
+
+
+@unittest.skipIf(mongomock is None, "mongomock is not available")
+class TestDeltaSnapshots(SnapshotsTestCase):
+    def test_delta_snapshots(self):
+        full, created, _publ = self.snapshot()
+        self.assertTrue(created)
+        self.assertFalse(self.Delta.is_delta(self.notes(full)))
+        self.assertEquals(self.units("repo-1"), self.units(full))
+
+        self.set_units(range(1, 12))
+        snap1, created, publ = self.snapshot()
+        self.assertTrue(created)
+        self.assertEquals(full, self.notes(snap1)['_repository_base'])
+        self.assertEquals(1, self.notes(snap1)['_repository_delta_depth'])
+        self.assertEquals(dict(added=2, removed=1), publ.units_diff)
+        # Only the changes were written
+        self.assertEquals([], self.units(snap1))
+        self.assertEquals(3, self.delta_coll.count_documents(
+            dict(snapshot_id=snap1)))
+        # Its counts are only set once it has associations to count
+        self.assertNotIsInstance(
+            self.repos.repos[snap1].content_unit_counts, dict)
+        self.assertEquals(dict(rpm=5, srpm=6),
+                          self.notes(snap1)['_repository_unit_counts'])
+        expected = self.Module.UnitSetDigest.from_units(
+            self.Module.REPO_UNIT(*x) for x in self.units("repo-1"))
+        self.assertEquals(expected.hexdigest(),
+                          self.notes(snap1)['_repository_digest'])
+
+        # Unchanged, with any diff engine
+        for engine in self.Configuration.constants.DIFF_ENGINES:
+            self.assertEquals((snap1, False),
+                              self.snapshot(diff_engine=engine)[:2])
+
+        self.set_units(range(2, 13))
+        snap2, created, _publ = self.snapshot(diff_engine='merge')
+        self.assertTrue(created)
+        self.assertEquals(snap1, self.notes(snap2)['_repository_base'])
+        self.assertEquals(2, self.notes(snap2)['_repository_delta_depth'])
+        self.assertEquals(self.units("repo-1"), sorted(
+            self.Delta.logical_units(self.units_coll, snap2)))
+
+        # A full checkpoint every third snapshot
+        self.set_units(range(3, 14))
+        snap3, created, _publ = self.snapshot()
+        self.assertTrue(created)
+        self.assertFalse(self.Delta.is_delta(self.notes(snap3)))
+        self.assertEquals(self.units("repo-1"), self.units(snap3))
+
+        # Materializing snap2 turns it into a full snapshot
+        expected = sorted(self.Delta.logical_units(self.units_coll, snap2))
+        self.assertTrue(self.Delta.materialize(snap2, 4))
+        self.assertEquals(expected, self.units(snap2))
+        self.assertFalse(self.Delta.is_delta(self.notes(snap2)))
+        self.assertEquals(0, self.delta_coll.count_documents(
+            dict(snapshot_id=snap2)))
+        self.assertEquals(dict(rpm=6, srpm=5),
+                          self.repos.repos[snap2].content_unit_counts)
+        self.assertFalse(self.Delta.materialize(snap2, 4))
+
+    def test_publish_delta_snapshot(self):
+        self.snapshot()
+        self.set_units(range(5))
+        snap1, created, _publ = self.snapshot()
+        expected = sorted(self.Delta.logical_units(self.units_coll, snap1))
+
+        snapshot_repo = mock.MagicMock(id=snap1, notes=self.notes(snap1))
+        publ = self.Module.Publisher(snapshot_repo, self._config_conduit(),
+                                     {})
+        with mock.patch.object(self.Module, "RepoGroup") as group:
+            publ.process_main()
+        self.assertEquals(expected, self.units(snap1))
+        self.assertEquals(snap1, publ.repo_snapshot)
+        # Now that it has associations, it joins the repository's groups
+        (requests,), _kwargs = \
+            group.get_collection.return_value.bulk_write.call_args
+        self.assertEquals(
+            [(dict(repo_ids="repo-1"), {'$addToSet': dict(repo_ids=snap1)})],
+            [(x._filter, x._doc) for x in requests])
+
+    def test_snapshot_distributor(self):
+        full, _created, _publ = self.snapshot()
+        self.assertEquals([], self.repos.distributors[full])
+        self.set_units(range(5))
+        snap1, _created, _publ = self.snapshot()
+        expected = sorted(self.Delta.logical_units(self.units_coll, snap1))
+
+        # Publish the delta snapshot with the distributor it was created with
+        dist, = self.repos.distributors[snap1]
+        self.assertEquals(self.Module.ids.TYPE_ID_DISTRIBUTOR_SNAPSHOT,
+                          dist['distributor_type_id'])
+        self.assertFalse(dist['auto_publish'])
+        snapshot_repo = mock.MagicMock(id=snap1, notes=self.notes(snap1))
+        distributor = self.Distributor.Snapshot_Distributor()
+        conduit = self._config_conduit()
+        self.assertEquals(
+            (True, None),
+            distributor.validate_config(snapshot_repo,
+                                        dist['distributor_config'], conduit))
+        publ = self.Module.Publisher(snapshot_repo, conduit,
+                                     dist['distributor_config'])
+        with mock.patch.object(self.Module, "RepoGroup") as group:
+            publ.process_main()
+        self.assertEquals(expected, self.units(snap1))
+        self.assertFalse(self.Delta.is_delta(self.notes(snap1)))
+        self.assertTrue(group.get_collection.return_value.bulk_write.called)
+
+        # Publishing it again, or a full snapshot, changes nothing
+        for repo_id in [snap1, full]:
+            publ = self.Module.Publisher(
+                mock.MagicMock(id=repo_id, notes=self.notes(repo_id)),
+                conduit, {})
+            with mock.patch.object(self.Module, "RepoGroup") as group, \
+                    mock.patch.object(self.Delta, "materialize") as mat:
+                publ.process_main()
+            self.assertEquals(repo_id, publ.repo_snapshot)
+            self.assertFalse(mat.called)
+            self.assertFalse(group.get_collection.called)
+        self.assertEquals(expected, self.units(snap1))
+
+    def test_groups(self):
+        self.snapshot()
+        self.set_units(range(1, 12))
+        publ = self.Module.Publisher(self.repo, self._config_conduit(),
+                                     dict(snapshot_storage='delta'))
+        with mock.patch.object(self.Module, "RepoGroup") as group:
+            snap1 = publ.publish_snapshot()
+        self.assertTrue(self.Delta.is_delta(self.notes(snap1)))
+        # Group consumers would find no associations
+        self.assertFalse(group.get_collection.called)
+
+
+@unittest.skipIf(mongomock is None, "mongomock is not available")
+class TestParallelFetch(SnapshotsTestCase):
+    def queries(self, find):
+        # mongomock's distinct() reads through find() too
+        return sorted((x[0][0]['repo_id'], x[0][0]['unit_type_id'])
+                      for x in find.call_args_list
+                      if 'unit_type_id' in x[0][0])
+
+    def test_full_snapshots(self):
+        full, _created, _publ = self.snapshot(snapshot_storage='full')
+        self.set_units(range(1, 12))
+        with mock.patch.object(self.units_coll, "find",
+                               wraps=self.units_coll.find) as find:
+            snap, created, publ = self.snapshot(
+                snapshot_storage='full', fetch_threads=4)
+        self.assertTrue(created)
+        self.assertEquals(self.units("repo-1"), self.units(snap))
+        # One query per unit type
+        self.assertEquals([("repo-1", "rpm"), ("repo-1", "srpm")],
+                          self.queries(find))
+        self.assertEquals(11, publ.units_read['documents'])
+        self.assertEquals(dict(rpm=5, srpm=6),
+                          self.repos.repos[snap].content_unit_counts)
+
+    def test_delta_snapshots(self):
+        full, _created, _publ = self.snapshot(fetch_threads=4)
+        self.set_units(range(1, 12))
+        with mock.patch.object(self.units_coll, "find",
+                               wraps=self.units_coll.find) as find:
+            snap1, _created, publ = self.snapshot(fetch_threads=4)
+        self.assertEquals(dict(added=2, removed=1), publ.units_diff)
+        # Both repositories are read by unit type
+        self.assertEquals(
+            [("repo-1", "rpm"), ("repo-1", "srpm"), (full, "rpm"),
+             (full, "srpm")], self.queries(find))
+
+        # A delta snapshot is read as one stream
+        self.set_units(range(2, 14))
+        snap2, created, publ = self.snapshot(fetch_threads=4)
+        self.assertEquals(dict(added=2, removed=1), publ.units_diff)
+        self.assertEquals(snap1, self.notes(snap2)['_repository_base'])
+        self.assertEquals(self.units("repo-1"), sorted(
+            self.Delta.logical_units(self.units_coll, snap2)))
+
+    def test_validate_config(self):
+        repo = mock.MagicMock(id="repo-1")
+        validate = self.Distributor.Snapshot_Distributor().validate_config
+        self.assertEquals((True, None),
+                          validate(repo, dict(fetch_threads=8), None))
+        self.assertEquals(
+            (False, 'Configuration key [fetch_threads] must be an integer '
+             'greater than or equal to 1, but was [0]'),
+            validate(repo, dict(fetch_threads=0), None))
@@ -0,0 +1,102 @@
+import unittest
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+from pulp_snapshot.plugins.distributors import diff
+from .... import testbase
+
+
+class UnitsTestCase(testbase.TestCase):
+    def setUp(self):
+        super(UnitsTestCase, self).setUp()
+        self.collection = mongomock.MongoClient().db.repo_content_units
+        for repo_id, unit_type_id, unit_id in [
+                ("old", "rpm", "1"),
+                ("old", "rpm", "2"),
+                ("old", "srpm", "9"),
+                ("new", "rpm", "2"),
+                ("new", "rpm", "3"),
+                ("new", "srpm", "4"),
+                ("new", "erratum", "5"),
+                ("other", "rpm", "6")]:
+            self.collection.insert_one(dict(
+                repo_id=repo_id, unit_type_id=unit_type_id, unit_id=unit_id,
+                created="2016-01-01T00:00:00Z"))
+
+
+@unittest.skipIf(mongomock is None, "mongomock is not available")
+class TestAggregateDiff(UnitsTestCase):
+    def test_aggregate_diff(self):
+        self.assertEquals(
+            diff.UnitDiff(added=3, removed=2),
+            diff.aggregate_diff(self.collection, "new", "old"))
+        self.assertEquals(
+            diff.UnitDiff(added=2, removed=3),
+            diff.aggregate_diff(self.collection, "old", "new"))
+
+    def test_aggregate_diff_filtered(self):
+        # Only the rpm units of "new" are compared with all of "old"
+        self.assertEquals(
+            diff.UnitDiff(added=1, removed=2),
+            diff.aggregate_diff(self.collection, "new", "old",
+                                dict(unit_type_id={'$in': ["rpm"]})))
+
+    def test_aggregate_diff_same(self):
+        self.assertEquals(
+            diff.UnitDiff(added=0, removed=0),
+            diff.aggregate_diff(self.collection, "new", "new"))
+
+    def test_aggregate_diff_missing(self):
+        self.assertEquals(
+            diff.UnitDiff(added=3, removed=0),
+            diff.aggregate_diff(self.collection, "old", "missing"))
+
+
+class TestMergeDiff(testbase.TestCase):
+    def test_merge_diff(self):
+        new = [("rpm", "2"), ("rpm", "3"), ("srpm", "4")]
+        old = [("erratum", "0"), ("rpm", "1"), ("rpm", "2"), ("srpm", "9")]
+        self.assertEquals(
+            [(diff.REMOVED, ("erratum", "0")),
+             (diff.REMOVED, ("rpm", "1")),
+             (diff.ADDED, ("rpm", "3")),
+             (diff.ADDED, ("srpm", "4")),
+             (diff.REMOVED, ("srpm", "9"))],
+            list(diff.merge_diff(new, old)))
+        self.assertEquals([], list(diff.merge_diff(new, new)))
+        self.assertEquals([], list(diff.merge_diff([], [])))
+        self.assertEquals([(diff.ADDED, ("rpm", "1"))],
+                          list(diff.merge_diff([("rpm", "1")], [])))
+
+    def test_differ_stops_early(self):
+        consumed = []
+
+        def units(prefix):
+            for i in range(1000):
+                consumed.append(prefix)
+                yield ("rpm", "%s%04d" % (prefix, i))
+
+        self.assertTrue(diff.differ(units("a"), units("b")))
+        self.assertEquals(["a", "b"], consumed)
+        self.assertFalse(diff.differ(iter([("rpm", "1")]),
+                                     iter([("rpm", "1")])))
+
+
+@unittest.skipIf(mongomock is None, "mongomock is not available")
+class TestDiffRepos(UnitsTestCase):
+    def test_diff_repos(self):
+        self.assertEquals(
+            [(diff.ADDED, ("erratum", "5")),
+             (diff.REMOVED, ("rpm", "1")),
+             (diff.ADDED, ("rpm", "3")),
+             (diff.ADDED, ("srpm", "4")),
+             (diff.REMOVED, ("srpm", "9"))],
+            list(diff.diff_repos(self.collection, "new", "old")))
+        self.assertEquals(
+            [], list(diff.diff_repos(self.collection, "new", "new")))
+        # The sort index is created by the migrations, not on every read
+        self.assertEquals(["_id_"],
+                          list(self.collection.index_information()))
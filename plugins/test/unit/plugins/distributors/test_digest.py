@@ -0,0 +1,30 @@
+from pulp_snapshot.plugins.distributors.digest import UnitSetDigest
+from .... import testbase
+
+
+class TestUnitSetDigest(testbase.TestCase):
+    def test_order_independent(self):
+        d1 = UnitSetDigest()
+        d1.add(u"rpm", u"aaa")
+        d1.add(u"srpm", u"bbb")
+        d2 = UnitSetDigest()
+        d2.add(u"srpm", u"bbb")
+        d2.add(u"rpm", u"aaa")
+        self.assertEquals(d1, d2)
+        self.assertEquals(d1.hexdigest(), d2.hexdigest())
+        self.assertEquals({u"rpm": 1, u"srpm": 1}, d1.counts)
+
+    def test_different(self):
+        d1 = UnitSetDigest()
+        d1.add(u"rpm", u"aaa")
+        d2 = UnitSetDigest()
+        d2.add(u"srpm", u"aaa")
+        self.assertNotEquals(d1, d2)
+        self.assertNotEquals(UnitSetDigest(), d1)
+
+    def test_round_trip(self):
+        d1 = UnitSetDigest()
+        d1.add(u"rpm", u"aaa")
+        d2 = UnitSetDigest(d1.hexdigest(), d1.counts)
+        self.assertEquals(d1, d2)
+        self.assertEquals('0' * 40, UnitSetDigest().hexdigest())
@@ -1,11 +1,34 @@
+import itertools
+import os
 import shutil
+import subprocess
 import sys
+import unittest
 
 import mock
 from pulp.server.managers import factory
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
 # from pulp.server.exceptions import PulpCodedException
 from .... import testbase
 
+# Time of the heartbeats of the snapshots being written
+HEARTBEAT = 1234567890.5
+
+# Modules the distributor plugins only need once they publish
+DEFERRED_MODULES = (
+    "pulp.plugins.util.publish_step",
+    "pulp.server.controllers.repository",
+    "pulp.server.db.model",
+    "pulp.server.db.model.repo_group",
+    "pulp.server.db.model.repository",
+    "pulp_snapshot.plugins.distributors.group_publisher",
+    "pulp_snapshot.plugins.distributors.publisher",
+    "pymongo",
+)
+
 
 class Attributer(object):
     def __init__(self, **kwargs):
@@ -99,16 +122,32 @@ class BaseTest(testbase.TestCase):
         super(BaseTest, self).setUp()
         self._meta_path = sys.meta_path
         sys.meta_path = [ModuleFinder()] + sys.meta_path
-        from pulp_snapshot.plugins.distributors import distributor
-        self.Module = distributor
-        self.Configuration = distributor.configuration
+        from pulp_snapshot.plugins.distributors import distributor, publisher
+        self.Distributor = distributor
+        self.Module = publisher
+        self.Configuration = publisher.configuration
         self._confmock = mock.patch.dict(
-            distributor.configuration.__dict__,
+            publisher.configuration.__dict__,
         )
         self._confmock.start()
+        # New snapshots are added to the snapshot index
+        self._indexmock = mock.patch(
+            "pulp_snapshot.plugins.distributors.index.get_collection")
+        self.index_collection = self._indexmock.start().return_value
+        # and checkpointed while they are written
+        self._checkpointmock = mock.patch(
+            "pulp_snapshot.plugins.distributors.checkpoint.RepoModel")
+        self.checkpoint_repomodel = self._checkpointmock.start()
+        self._clockmock = mock.patch(
+            "pulp_snapshot.plugins.distributors.checkpoint.clock",
+            return_value=HEARTBEAT)
+        self._clockmock.start()
         factory.reset()
 
     def tearDown(self):
+        self._clockmock.stop()
+        self._checkpointmock.stop()
+        self._indexmock.stop()
         self._confmock.stop()
         sys.meta_path = self._meta_path
         shutil.rmtree(self.work_dir, ignore_errors=True)
@@ -128,31 +167,100 @@ class TestEntryPoint(BaseTest):
         """
         Assert the correct return value for the entry_point() function.
         """
-        return_value = self.Module.entry_point()
+        return_value = self.Distributor.entry_point()
 
-        expected_value = (self.Module.Snapshot_Distributor, {})
+        expected_value = (self.Distributor.Snapshot_Distributor, {})
         self.assertEqual(return_value, expected_value)
 
+    def test_lazy_imports(self):
+        """
+        Assert that loading the plugins and their metadata, as every Pulp
+        process does, imports neither the publishers nor the server's
+        controllers and models.
+        """
+        script = "\n".join([
+            "import sys",
+            "from pulp_snapshot.plugins.distributors import (",
+            "    distributor, group_distributor)",
+            "distributor.entry_point()[0].metadata()",
+            "group_distributor.entry_point()[0].metadata()",
+            "print '\\n'.join(sorted(sys.modules))",
+        ])
+        env = dict(os.environ,
+                   PYTHONPATH=os.pathsep.join(x for x in sys.path if x))
+        modules = set(subprocess.check_output(
+            [sys.executable, '-c', script], env=env).split())
+        self.assertIn("pulp_snapshot.plugins.distributors.distributor",
+                      modules)
+        self.assertEquals([], sorted(modules.intersection(DEFERRED_MODULES)))
+
+    def test_registers_tasks(self):
+        """
+        Assert that loading the plugins registers the bookkeeping task, so
+        that the worker receiving its messages knows it.
+        """
+        script = "\n".join([
+            "import celery",
+            "from pulp_snapshot.plugins.distributors import (",
+            "    distributor, group_distributor)",
+            "print '\\n'.join(sorted(celery.current_app.tasks))",
+        ])
+        env = dict(os.environ,
+                   PYTHONPATH=os.pathsep.join(x for x in sys.path if x))
+        tasks = subprocess.check_output(
+            [sys.executable, '-c', script], env=env).split()
+        self.assertIn(
+            "pulp_snapshot.plugins.distributors.bookkeeping.update_snapshots",
+            tasks)
+
 
 class TestConfiguration(BaseTest):
     def test_validate_config(self):
         repo = mock.MagicMock(id="repo-1")
         conduit = self._config_conduit()
         config = dict()
-        distributor = self.Module.Snapshot_Distributor()
+        distributor = self.Distributor.Snapshot_Distributor()
         self.assertEquals(
             distributor.validate_config(repo, config, conduit),
             (True, None))
 
+    def test_validate_config_fetch_batch_size(self):
+        repo = mock.MagicMock(id="repo-1")
+        conduit = self._config_conduit()
+        distributor = self.Distributor.Snapshot_Distributor()
+        self.assertEquals(
+            distributor.validate_config(
+                repo, dict(fetch_batch_size=1000), conduit),
+            (True, None))
+        self.assertEquals(
+            distributor.validate_config(
+                repo, dict(fetch_batch_size=0), conduit),
+            (False, 'Configuration key [fetch_batch_size] must be an '
+             'integer greater than or equal to 1, but was [0]'))
+
+    def test_validate_config_diff_engine(self):
+        repo = mock.MagicMock(id="repo-1")
+        conduit = self._config_conduit()
+        distributor = self.Distributor.Snapshot_Distributor()
+        self.assertEquals(
+            distributor.validate_config(
+                repo, dict(diff_engine='aggregate'), conduit),
+            (True, None))
+        self.assertEquals(
+            distributor.validate_config(
+                repo, dict(diff_engine='bogus'), conduit),
+            (False, 'Configuration key [diff_engine] must be one of '
+             'python, aggregate, merge, but was [bogus]'))
+
 
 class TestPublish(BaseTest):
-    @mock.patch("pulp_snapshot.plugins.distributors.distributor.Publisher")
+    @mock.patch("pulp_snapshot.plugins.distributors.publisher.Publisher")
     def test_publish_repo(self, _Publisher):
         repo = mock.MagicMock()
         conduit = mock.MagicMock()
         config = mock.MagicMock()
 
-        d = self.Module.Snapshot_Distributor()
+        d = self.Distributor.Snapshot_Distributor()
         ret = d.publish_repo(repo, conduit, config)
 
         self.assertEquals(
@@ -162,13 +270,17 @@ class TestPublish(BaseTest):
         _Publisher.assert_called_once_with(repo=repo, conduit=conduit,
                                            config=config)
 
-    @mock.patch("pulp_snapshot.plugins.distributors.distributor.time.time")
-    @mock.patch("pulp_snapshot.plugins.distributors.distributor.repo_controller")  # noqa
-    @mock.patch("pulp_snapshot.plugins.distributors.distributor.RepoGroup")
-    @mock.patch("pulp_snapshot.plugins.distributors.distributor.RepoContentUnit")  # noqa
-    @mock.patch("pulp_snapshot.plugins.distributors.distributor.RepoImporter")
-    def test_publish(self, _imp, _units, _repogroup, _repoctrl, _time):
+    @mock.patch("pulp_snapshot.plugins.distributors.timing.clock")
+    @mock.patch("pulp_snapshot.plugins.distributors.publisher.time.time")
+    @mock.patch("pulp_snapshot.plugins.distributors.publisher.repo_controller")  # noqa
+    @mock.patch("pulp_snapshot.plugins.distributors.publisher.RepoGroup")
+    @mock.patch("pulp_snapshot.plugins.distributors.publisher.RepoContentUnit")  # noqa
+    @mock.patch("pulp_snapshot.plugins.distributors.publisher.RepoImporter")
+    def test_publish(self, _imp, _units, _repogroup, _repoctrl, _time,
+                     _clock):
         _time.return_value = 1234567890.1234
+        # Every phase appears to take one second
+        _clock.side_effect = itertools.count()
 
         repo_id = "repo-1-sasmd-level0"
         exp_repo_name = 'repo-1-sasmd-level0__20090213233130.1233Z'
@@ -195,7 +307,9 @@ class TestPublish(BaseTest):
         publ.process_lifecycle()
 
         _units.get_collection.return_value.find.assert_called_once_with(
-            dict(repo_id="repo-1-sasmd-level0"))
+            dict(repo_id="repo-1-sasmd-level0"),
+            dict(_id=0, unit_type_id=1, unit_id=1),
+            batch_size=5000)
 
         _imp.objects.filter.assert_called_once_with(
             repo_id="repo-1-sasmd-level0")
@@ -212,7 +326,13 @@ class TestPublish(BaseTest):
         notes.update({
             '_repository_snapshot':
             'repo-1-sasmd-level0__20090213233130.1233Z',
-            '_repository_timestamp': 1234567890.1234})
+            '_repository_timestamp': 1234567890.1234,
+            '_repository_digest': 'a0353b25e36a7cfd2286b0b9017d745425f54fd9',
+            '_repository_unit_counts': {'rpm': 1, 'srpm': 1},
+            '_repository_snapshot_status': 'incomplete',
+            '_repository_snapshot_filter': '{}',
+            '_repository_snapshot_owner': publ._owner,
+            '_repository_snapshot_heartbeat': HEARTBEAT})
 
         imp_type_id = _imp.objects.filter.return_value.first.return_value['import_type_id']  # noqa
         _repoctrl.create_repo.assert_called_once_with(
@@ -228,18 +348,36 @@ class TestPublish(BaseTest):
                       unit_id="bbb"),
         ])
 
-        _units.get_collection.return_value.insert.assert_called_once_with(
-            [_units.return_value, _units.return_value])
-        _repoctrl.rebuild_content_unit_counts.assert_called_once_with(
-            _repoctrl.create_repo.return_value)
+        _units.get_collection.return_value.insert_many.assert_called_once_with(
+            [_units.return_value, _units.return_value], ordered=False)
+        repo_obj = _repoctrl.create_repo.return_value
+        _repoctrl.rebuild_content_unit_counts.assert_not_called()
+        self.assertEquals({'rpm': 1, 'srpm': 1},
+                          repo_obj.content_unit_counts)
+        repo_obj.save.assert_called_once_with()
+        # The copy was checkpointed after the only batch
+        self.checkpoint_repomodel.objects.assert_called_with(
+            repo_id=exp_repo_name,
+            notes___repository_snapshot_owner=publ._owner)
+        self.checkpoint_repomodel.objects.return_value.update_one.assert_called_once_with(  # noqa
+            set__notes___repository_snapshot_checkpoint=['srpm', 'bbb'],
+            set__notes___repository_snapshot_heartbeat=HEARTBEAT)
 
         conduit.build_success_report.assert_called_once_with(
             {'repository_snapshot':
-             'repo-1-sasmd-level0__20090213233130.1233Z'},
-            [{'num_processed': 1,
-              'items_total': 1,
+             'repo-1-sasmd-level0__20090213233130.1233Z',
+             'units_read': {'documents': 2, 'bytes': 89},
+             'phases': {
+                 'fetch': {'seconds': 1.0, 'documents': 2},
+                 'create_repo': {'seconds': 1.0, 'documents': 1},
+                 'copy': {'seconds': 1.0, 'documents': 2},
+                 'counts': {'seconds': 1.0, 'documents': 1},
+                 'index': {'seconds': 1.0, 'documents': 1},
+                 'groups': {'seconds': 1.0, 'documents': 0}}},
+            [{'num_processed': 3,
+              'items_total': 3,
               'state': 'FINISHED',
-              'num_success': 1,
+              'num_success': 3,
               'error_details': [],
               'description': 'Snapshotting repository',
               'num_failures': 0,
@@ -248,11 +386,105 @@ class TestPublish(BaseTest):
               'details': ''}])
 
         self.assertEquals(exp_repo_name, publ.repo_snapshot)
+        self.index_collection.update_one.assert_called_once_with(
+            {'_id': repo_id},
+            {'$push': {'snapshots': {
+                '$each': [{'snapshot_id': exp_repo_name,
+                           'timestamp': 1234567890.1234,
+                           'digest': notes['_repository_digest'],
+                           'units': 2}],
+                '$sort': {'timestamp': 1}}}},
+            upsert=True)
+
+    def test_get_units_streams(self):
+        repo = mock.MagicMock(id="repo-1")
+        conduit = self._config_conduit()
+        config = dict(fetch_batch_size=2)
+        coll = mock.MagicMock()
+        coll.find.return_value = iter([
+            dict(unit_type_id=u"rpm", unit_id=u"aaa"),
+            dict(unit_type_id=u"srpm", unit_id=u"bbb"),
+        ])
+
+        publ = self.Module.Publisher(repo, conduit, config)
+        units = publ._get_units(coll, "repo-1")
+        self.assertEquals(dict(unit_type_id=u"rpm", unit_id=u"aaa"),
+                          next(units))
+        # Counters are only updated once the cursor is exhausted
+        self.assertEquals(dict(documents=0, bytes=0), publ.units_read)
+        self.assertEquals([dict(unit_type_id=u"srpm", unit_id=u"bbb")],
+                          list(units))
+        self.assertEquals(dict(documents=2, bytes=89), publ.units_read)
+        coll.find.assert_called_once_with(
+            dict(repo_id="repo-1"),
+            dict(_id=0, unit_type_id=1, unit_id=1),
+            batch_size=2)
+
+    @mock.patch("pulp_snapshot.plugins.distributors.publisher.RepoContentUnit")  # noqa
+    def test_copy_units(self, _units):
+        repo = mock.MagicMock(id="repo-1")
+        conduit = self._config_conduit()
+        config = dict(copy_batch_size=2, copy_write_concern="majority")
+        coll = mock.MagicMock()
+        units = [self.Module.REPO_UNIT("rpm", str(i)) for i in range(5)]
+
+        publ = self.Module.Publisher(repo, conduit, config)
+        publ._copy_units(coll, "repo-1__snap", units, len(units))
 
-    @mock.patch("pulp_snapshot.plugins.distributors.distributor.RepoContentUnit")  # noqa
-    @mock.patch("pulp_snapshot.plugins.distributors.distributor.Publisher._get_units")  # noqa
-    @mock.patch("pulp_snapshot.plugins.distributors.distributor.Publisher._build_report")  # noqa
-    def test_publish_no_change(self, _build_report, _get_units, _units):
+        self.assertEquals(
+            "majority",
+            coll.with_options.call_args[1]['write_concern'].document['w'])
+        insert_many = coll.with_options.return_value.insert_many
+        self.assertEquals(3, insert_many.call_count)
+        self.assertEquals(6, publ.total_units)
+        self.assertEquals(5, publ.progress_successes)
+        _units.assert_has_calls([
+            mock.call(repo_id="repo-1__snap", unit_type_id="rpm",
+                      unit_id=str(i))
+            for i in range(5)])
+
+    @mock.patch("pulp_snapshot.plugins.distributors.publisher.RepoModel")
+    @mock.patch("pulp_snapshot.plugins.distributors.publisher.RepoContentUnit")  # noqa
+    @mock.patch("pulp_snapshot.plugins.distributors.publisher.Publisher._get_units")  # noqa
+    @mock.patch("pulp_snapshot.plugins.distributors.publisher.Publisher._build_report")  # noqa
+    def test_publish_no_change(self, _build_report, _get_units, _units,
+                               _repomodel):
+        repo_id = "repo-1-sasmd-level0"
+        repo_snapshot_other = "repo-1-timestamped"
+        notes = {'_repo-type': 'rpm',
+                 '_repository_snapshot': repo_snapshot_other}
+        repo = mock.MagicMock(id=repo_id, notes=notes)
+        conduit = self._config_conduit()
+        config = dict()
+
+        _get_units.return_value = [{'unit_id': '1', 'unit_type_id': 'rpm'}]
+        # Snapshot predating digests
+        _repomodel.objects.return_value.first.return_value.notes = {}
+
+        publ = self.Module.Publisher(repo, conduit, config)
+        publ.working_dir = self.work_dir
+
+        publ.process_lifecycle()
+        _build_report.assert_called_once_with(repo_snapshot_other)
+
+        # The snapshot's units were read once to backfill the digest
+        _get_units.assert_has_calls([
+            mock.call(_units.get_collection.return_value, repo_id),
+            mock.call(_units.get_collection.return_value,
+                      repo_snapshot_other),
+        ])
+        _repomodel.objects.assert_called_with(repo_id=repo_snapshot_other)
+        _repomodel.objects.return_value.update_one.assert_called_once_with(
+            set__notes___repository_digest=(
+                '9d012da8e6605f24bc23f013a58679b906b70ea9'),
+            set__notes___repository_unit_counts={'rpm': 1})
+
+    @mock.patch("pulp_snapshot.plugins.distributors.publisher.RepoModel")
+    @mock.patch("pulp_snapshot.plugins.distributors.publisher.RepoContentUnit")  # noqa
+    @mock.patch("pulp_snapshot.plugins.distributors.publisher.Publisher._get_units")  # noqa
+    @mock.patch("pulp_snapshot.plugins.distributors.publisher.Publisher._build_report")  # noqa
+    def test_publish_no_change_digest(self, _build_report, _get_units, _units,
+                                      _repomodel):
         repo_id = "repo-1-sasmd-level0"
         repo_snapshot_other = "repo-1-timestamped"
         notes = {'_repo-type': 'rpm',
@@ -261,17 +493,188 @@ class TestPublish(BaseTest):
         conduit = self._config_conduit()
         config = dict()
 
-        _get_units.return_value = [{'unit_id': 1, 'unit_type_id': 'rpm'}]
+        _get_units.return_value = [{'unit_id': '1', 'unit_type_id': 'rpm'}]
+        _repomodel.objects.return_value.first.return_value.notes = {
+            '_repository_digest': '9d012da8e6605f24bc23f013a58679b906b70ea9',
+            '_repository_unit_counts': {'rpm': 1},
+        }
+
+        publ = self.Module.Publisher(repo, conduit, config)
+        publ.working_dir = self.work_dir
+
+        publ.process_lifecycle()
+        _build_report.assert_called_once_with(repo_snapshot_other)
+
+        # The snapshot's units are never read
+        _get_units.assert_called_once_with(
+            _units.get_collection.return_value, repo_id)
+        _repomodel.objects.return_value.update_one.assert_not_called()
+
+    @mock.patch("pulp_snapshot.plugins.distributors.publisher.diff.aggregate_diff")  # noqa
+    @mock.patch("pulp_snapshot.plugins.distributors.publisher.RepoContentUnit")  # noqa
+    @mock.patch("pulp_snapshot.plugins.distributors.publisher.Publisher._get_units")  # noqa
+    @mock.patch("pulp_snapshot.plugins.distributors.publisher.Publisher._build_report")  # noqa
+    def test_publish_no_change_aggregate(self, _build_report, _get_units,
+                                         _units, _aggregate_diff):
+        repo_id = "repo-1-sasmd-level0"
+        repo_snapshot_other = "repo-1-timestamped"
+        notes = {'_repo-type': 'rpm',
+                 '_repository_snapshot': repo_snapshot_other}
+        repo = mock.MagicMock(id=repo_id, notes=notes)
+        conduit = self._config_conduit()
+        config = dict(diff_engine='aggregate')
+
+        _aggregate_diff.return_value = self.Module.diff.UnitDiff(0, 0)
+
+        publ = self.Module.Publisher(repo, conduit, config)
+        publ.working_dir = self.work_dir
+
+        publ.process_lifecycle()
+        _build_report.assert_called_once_with(repo_snapshot_other)
+        _aggregate_diff.assert_called_once_with(
+            _units.get_collection.return_value, repo_id, repo_snapshot_other,
+            {})
+        # No units were transferred
+        _get_units.assert_not_called()
+        self.assertEquals(dict(added=0, removed=0), publ.units_diff)
+
+    @mock.patch("pulp_snapshot.plugins.distributors.publisher.RepoContentUnit")  # noqa
+    @mock.patch("pulp_snapshot.plugins.distributors.publisher.Publisher._build_report")  # noqa
+    def test_publish_no_change_merge(self, _build_report, _units):
+        repo_id = "repo-1-sasmd-level0"
+        repo_snapshot_other = "repo-1-timestamped"
+        notes = {'_repo-type': 'rpm',
+                 '_repository_snapshot': repo_snapshot_other}
+        repo = mock.MagicMock(id=repo_id, notes=notes)
+        conduit = self._config_conduit()
+        config = dict(diff_engine='merge')
+
+        units = [dict(unit_type_id=u"rpm", unit_id=u"aaa"),
+                 dict(unit_type_id=u"srpm", unit_id=u"bbb")]
+        coll = _units.get_collection.return_value
+        coll.distinct.return_value = [u"srpm", u"rpm"]
+        coll.find.side_effect = lambda spec, *args, **kwargs: iter(
+            [x for x in units if x['unit_type_id'] == spec['unit_type_id']])
+
+        publ = self.Module.Publisher(repo, conduit, config)
+        publ.working_dir = self.work_dir
+
+        publ.process_lifecycle()
+        _build_report.assert_called_once_with(repo_snapshot_other)
+        # One query per unit type, which Pulp's unique index returns in
+        # unit id order; no index is created. The merge join reads both
+        # repositories a type at a time.
+        self.assertFalse(coll.create_index.called)
+        self.assertEquals(
+            [mock.call(dict(repo_id=rid, unit_type_id=unit_type_id),
+                       dict(_id=0, unit_type_id=1, unit_id=1),
+                       batch_size=5000, sort=[('unit_id', 1)])
+             for unit_type_id in [u"rpm", u"srpm"]
+             for rid in [repo_id, repo_snapshot_other]],
+            coll.find.call_args_list)
+
+    @mock.patch("pulp_snapshot.plugins.distributors.publisher.time.time")
+    @mock.patch("pulp_snapshot.plugins.distributors.publisher.repo_controller")  # noqa
+    @mock.patch("pulp_snapshot.plugins.distributors.publisher.RepoGroup")
+    @mock.patch("pulp_snapshot.plugins.distributors.publisher.RepoContentUnit")  # noqa
+    @mock.patch("pulp_snapshot.plugins.distributors.publisher.RepoImporter")
+    def test_publish_merge(self, _imp, _units, _repogroup, _repoctrl,
+                           _time):
+        _time.return_value = 1234567890.1234
+        repo_id = "repo-1-sasmd-level0"
+        repo_snapshot_other = "repo-1-timestamped"
+        exp_repo_name = 'repo-1-sasmd-level0__20090213233130.1233Z'
+        notes = {'_repo-type': 'rpm',
+                 '_repository_snapshot': repo_snapshot_other}
+        repo = mock.MagicMock(id=repo_id, notes=notes)
+        conduit = self._config_conduit()
+        config = dict(diff_engine='merge')
+
+        units = {
+            repo_id: [dict(unit_type_id=u"rpm", unit_id=u"aaa"),
+                      dict(unit_type_id=u"srpm", unit_id=u"bbb")],
+            repo_snapshot_other: [dict(unit_type_id=u"rpm", unit_id=u"aaa")],
+        }
+        coll = _units.get_collection.return_value
+        coll.distinct.side_effect = lambda key, spec: sorted(
+            set(x[key] for x in units[spec['repo_id']]))
+        coll.find.side_effect = lambda spec, *args, **kwargs: iter(
+            [x for x in units[spec['repo_id']]
+             if x['unit_type_id'] == spec.get('unit_type_id',
+                                              x['unit_type_id'])])
+        coll.count.return_value = 2
+        repo_obj = _repoctrl.create_repo.return_value
+        repo_obj.notes = {}
+
+        publ = self.Module.Publisher(repo, conduit, config)
+        publ.working_dir = self.work_dir
+
+        publ.process_lifecycle()
+        self.assertEquals(exp_repo_name, publ.repo_snapshot)
+
+        coll.count.assert_called_once_with(dict(repo_id=repo_id))
+        # The digest is not known until the units are copied
+        exp_notes = dict(notes)
+        exp_notes.update(_repository_timestamp=1234567890.1234,
+                         _repository_snapshot=exp_repo_name,
+                         _repository_snapshot_status='incomplete',
+                         _repository_snapshot_filter='{}',
+                         _repository_snapshot_owner=publ._owner,
+                         _repository_snapshot_heartbeat=HEARTBEAT)
+        self.assertEquals(exp_notes,
+                          _repoctrl.create_repo.call_args[1]['notes'])
+        self.assertEquals([
+            mock.call(repo_id=exp_repo_name, unit_type_id="rpm",
+                      unit_id="aaa"),
+            mock.call(repo_id=exp_repo_name, unit_type_id="srpm",
+                      unit_id="bbb"),
+        ], _units.call_args_list)
+        coll.insert_many.assert_called_once_with(
+            [_units.return_value, _units.return_value], ordered=False)
+        self.assertEquals(
+            {'_repository_digest': 'a0353b25e36a7cfd2286b0b9017d745425f54fd9',
+             '_repository_unit_counts': {'rpm': 1, 'srpm': 1}},
+            repo_obj.notes)
+        self.assertEquals({'rpm': 1, 'srpm': 1},
+                          repo_obj.content_unit_counts)
+        repo_obj.save.assert_called_once_with()
+
+    @mock.patch("pulp_snapshot.plugins.distributors.publisher.RepoModel")
+    @mock.patch("pulp_snapshot.plugins.distributors.publisher.diff.aggregate_diff")  # noqa
+    @mock.patch("pulp_snapshot.plugins.distributors.publisher.RepoContentUnit")  # noqa
+    @mock.patch("pulp_snapshot.plugins.distributors.publisher.Publisher._get_units")  # noqa
+    @mock.patch("pulp_snapshot.plugins.distributors.publisher.Publisher._build_report")  # noqa
+    def test_publish_aggregate_fallback(self, _build_report, _get_units,
+                                        _units, _aggregate_diff, _repomodel):
+        from pymongo.errors import OperationFailure
+        repo_id = "repo-1-sasmd-level0"
+        repo_snapshot_other = "repo-1-timestamped"
+        notes = {'_repo-type': 'rpm',
+                 '_repository_snapshot': repo_snapshot_other}
+        repo = mock.MagicMock(id=repo_id, notes=notes)
+        conduit = self._config_conduit()
+        config = dict(diff_engine='aggregate')
+
+        _aggregate_diff.side_effect = OperationFailure("not supported")
+        _get_units.return_value = [{'unit_id': '1', 'unit_type_id': 'rpm'}]
+        _repomodel.objects.return_value.first.return_value.notes = {
+            '_repository_digest': '9d012da8e6605f24bc23f013a58679b906b70ea9',
+            '_repository_unit_counts': {'rpm': 1},
+        }
 
         publ = self.Module.Publisher(repo, conduit, config)
         publ.working_dir = self.work_dir
 
         publ.process_lifecycle()
+        # Compared locally, using the digest
         _build_report.assert_called_once_with(repo_snapshot_other)
+        _get_units.assert_called_once_with(
+            _units.get_collection.return_value, repo_id)
+        self.assertEquals(None, publ.units_diff)
 
-    @mock.patch("pulp_snapshot.plugins.distributors.distributor.RepoContentUnit")  # noqa
-    @mock.patch("pulp_snapshot.plugins.distributors.distributor.Publisher._get_units")  # noqa
-    @mock.patch("pulp_snapshot.plugins.distributors.distributor.Publisher._build_report")  # noqa
+    @mock.patch("pulp_snapshot.plugins.distributors.publisher.RepoContentUnit")  # noqa
+    @mock.patch("pulp_snapshot.plugins.distributors.publisher.Publisher._get_units")  # noqa
+    @mock.patch("pulp_snapshot.plugins.distributors.publisher.Publisher._build_report")  # noqa
     def test_publish_empty_repo(self, _build_report, _get_units, _units):
         repo_id = "repo-1-sasmd-level0"
         notes = {'_repo-type': 'rpm'}
@@ -288,14 +691,16 @@ class TestPublish(BaseTest):
         # Expect call with no snapshot, since one was not created
         _build_report.assert_called_once_with(None)
 
-    @mock.patch("pulp_snapshot.plugins.distributors.distributor.time.time")
-    @mock.patch("pulp_snapshot.plugins.distributors.distributor.repo_controller")  # noqa
-    @mock.patch("pulp_snapshot.plugins.distributors.distributor.RepoGroup")
-    @mock.patch("pulp_snapshot.plugins.distributors.distributor.RepoContentUnit")  # noqa
-    @mock.patch("pulp_snapshot.plugins.distributors.distributor.Publisher._get_units")  # noqa
-    @mock.patch("pulp_snapshot.plugins.distributors.distributor.RepoImporter")
-    @mock.patch("pulp_snapshot.plugins.distributors.distributor.Publisher._build_report")  # noqa
-    def test_publish_empty_repo_nonempty_snapshot(self, _build_report, _imp,
+    @mock.patch("pulp_snapshot.plugins.distributors.publisher.time.time")
+    @mock.patch("pulp_snapshot.plugins.distributors.publisher.repo_controller")  # noqa
+    @mock.patch("pulp_snapshot.plugins.distributors.publisher.RepoGroup")
+    @mock.patch("pulp_snapshot.plugins.distributors.publisher.RepoContentUnit")  # noqa
+    @mock.patch("pulp_snapshot.plugins.distributors.publisher.Publisher._get_units")  # noqa
+    @mock.patch("pulp_snapshot.plugins.distributors.publisher.RepoImporter")
+    @mock.patch("pulp_snapshot.plugins.distributors.publisher.RepoModel")
+    @mock.patch("pulp_snapshot.plugins.distributors.publisher.Publisher._build_report")  # noqa
+    def test_publish_empty_repo_nonempty_snapshot(self, _build_report,
+                                                  _repomodel, _imp,
                                                   _get_units, _units,
                                                   _repogroup, _repoctrl,
                                                   _time):
@@ -307,19 +712,26 @@ class TestPublish(BaseTest):
                  '_repository_snapshot': repo_snapshot_other}
         exp_notes = dict(notes)
         exp_notes.update(_repository_timestamp=1234567890.1234,
-                         _repository_snapshot=exp_repo_name)
+                         _repository_snapshot=exp_repo_name,
+                         _repository_digest='0' * 40,
+                         _repository_unit_counts={},
+                         _repository_snapshot_status='incomplete',
+                         _repository_snapshot_filter='{}')
         repo = mock.MagicMock(id=repo_id, notes=notes)
         conduit = self._config_conduit()
         config = dict()
 
         _get_units.side_effect = [[],
-                                  [{'unit_id': 1, 'unit_type_id': 'rpm'}]]
+                                  [{'unit_id': '1', 'unit_type_id': 'rpm'}]]
+        _repomodel.objects.return_value.first.return_value.notes = {}
 
         publ = self.Module.Publisher(repo, conduit, config)
         publ.working_dir = self.work_dir
 
         publ.process_lifecycle()
         _build_report.assert_called_once_with(exp_repo_name)
+        exp_notes.update(_repository_snapshot_owner=publ._owner,
+                         _repository_snapshot_heartbeat=HEARTBEAT)
 
         _get_units.assert_has_calls([
             mock.call(_units.get_collection.return_value, repo_id),
@@ -332,7 +744,7 @@ class TestPublish(BaseTest):
         _imp.objects.filter.return_value.first.assert_called_once_with()
 
         # Nothing to insert
-        _units.get_collection.return_value.insert.assert_not_called()
+        _units.get_collection.return_value.insert_many.assert_not_called()
 
         imp_type_id = _imp.objects.filter.return_value.first.return_value['import_type_id']  # noqa
         _repoctrl.create_repo.assert_called_once_with(
@@ -340,3 +752,51 @@ class TestPublish(BaseTest):
             importer_type_id=imp_type_id,
             importer_repo_plugin_config={},
             notes=exp_notes)
+
+
+@unittest.skipIf(mongomock is None, "mongomock is not available")
+class TestUnitCounts(BaseTest):
+    """
+    The unit counts stored on a new snapshot match what
+    rebuild_content_unit_counts would aggregate from its associations.
+    """
+    def _rebuild_counts(self, collection, repo_id):
+        pipeline = [
+            {'$match': {'repo_id': repo_id}},
+            {'$group': {'_id': '$unit_type_id', 'sum': {'$sum': 1}}},
+        ]
+        return dict((x['_id'], x['sum'])
+                    for x in collection.aggregate(pipeline))
+
+    @mock.patch("pulp_snapshot.plugins.distributors.publisher.repo_controller")  # noqa
+    @mock.patch("pulp_snapshot.plugins.distributors.publisher.RepoContentUnit")  # noqa
+    @mock.patch("pulp_snapshot.plugins.distributors.publisher.RepoImporter")
+    def _test_counts(self, diff_engine, _imp, _units, _repoctrl):
+        collection = mongomock.MongoClient().db.repo_content_units
+        for i in range(50):
+            collection.insert_one(dict(
+                repo_id="repo-1",
+                unit_type_id=["rpm", "srpm", "erratum"][i % 3],
+                unit_id="%04d" % i))
+        _units.get_collection.return_value = collection
+        _units.side_effect = dict
+        repo_obj = _repoctrl.create_repo.return_value
+        repo_obj.notes = {}
+        repo = mock.MagicMock(id="repo-1", notes={})
+
+        publ = self.Module.Publisher(repo, self._config_conduit(),
+                                     dict(diff_engine=diff_engine,
+                                          copy_batch_size=7))
+        snapshot_name, created = publ.snapshot(1234567890.1234)
+
+        self.assertTrue(created)
+        expected = self._rebuild_counts(collection, snapshot_name)
+        self.assertEquals(dict(rpm=17, srpm=17, erratum=16), expected)
+        self.assertEquals(expected, repo_obj.content_unit_counts)
+        _repoctrl.rebuild_content_unit_counts.assert_not_called()
+
+    def test_counts(self):
+        self._test_counts('python')
+
+    def test_counts_merge(self):
+        self._test_counts('merge')
@@ -0,0 +1,249 @@
+import mock
+from pymongo import UpdateMany
+from pulp.server.exceptions import PulpCodedException
+
+from .test_distributor import BaseTest
+
+
+class GroupBaseTest(BaseTest):
+    def setUp(self):
+        super(GroupBaseTest, self).setUp()
+        from pulp_snapshot.plugins.distributors import (
+            group_distributor, group_publisher)
+        self.GroupDistributor = group_distributor
+        self.GroupModule = group_publisher
+        # The snapshot distributors of the group's repositories
+        self.distributors = []
+        prefix = "pulp_snapshot.plugins.distributors.group_publisher."
+        patches = [
+            mock.patch(prefix + "RepoDistributor",
+                       objects=lambda **kwargs: self.distributors),
+            mock.patch(prefix + "plugin_api", **{
+                'get_distributor_by_id.return_value': (
+                    mock.MagicMock(), dict(fetch_batch_size=100))}),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def _repo_obj(self, repo_id, notes):
+        ret = mock.MagicMock(repo_id=repo_id, notes=notes)
+        ret.to_transfer_repo.return_value = mock.MagicMock(
+            id=repo_id, notes=notes)
+        return ret
+
+
+class TestGroupEntryPoint(GroupBaseTest):
+    def test_entry_point(self):
+        self.assertEqual(
+            (self.GroupDistributor.Snapshot_GroupDistributor, {}),
+            self.GroupDistributor.entry_point())
+
+    @mock.patch("pulp_snapshot.plugins.distributors.group_publisher.GroupPublisher")  # noqa
+    def test_publish_group(self, _GroupPublisher):
+        repo_group = mock.MagicMock()
+        conduit = mock.MagicMock()
+        config = mock.MagicMock()
+
+        d = self.GroupDistributor.Snapshot_GroupDistributor()
+        ret = d.publish_group(repo_group, conduit, config)
+
+        self.assertEquals(
+            _GroupPublisher.return_value.process_lifecycle.return_value,
+            ret)
+        _GroupPublisher.assert_called_once_with(
+            repo_group=repo_group, conduit=conduit, config=config)
+
+
+class TestGroupPublish(GroupBaseTest):
+    @mock.patch("pulp_snapshot.plugins.distributors.group_publisher.time.time")  # noqa
+    @mock.patch("pulp_snapshot.plugins.distributors.publisher.RepoGroup")
+    @mock.patch("pulp_snapshot.plugins.distributors.group_publisher.RepoModel")  # noqa
+    def test_publish(self, _repomodel, _repogroup, _time):
+        _time.return_value = 1234567890.1234
+        repo_group = mock.MagicMock(id="group-1",
+                                    repo_ids=["repo-1", "repo-2", "repo-3",
+                                              "repo-1__snap"])
+        conduit = self._config_conduit()
+        config = dict(group_threads=2)
+
+        _repomodel.objects.return_value = [
+            self._repo_obj("repo-1", {'_repository_snapshot': 'repo-1__old'}),
+            self._repo_obj("repo-2", {}),
+            self._repo_obj("repo-3", {'_repository_snapshot': 'repo-3__old'}),
+            self._repo_obj("repo-1__snap",
+                           {'_repository_snapshot': 'repo-1__snap'}),
+        ]
+        results = {
+            "repo-1": ("repo-1__new", True),
+            "repo-2": (None, False),
+            "repo-3": ("repo-3__old", False),
+        }
+        repos = []
+
+        def snapshot(publ, now):
+            self.assertEquals(1234567890.1234, now)
+            repos.append(publ.get_repo().id)
+            return results[publ.get_repo().id]
+
+        with mock.patch.object(self.Module.Publisher, "snapshot",
+                               autospec=True, side_effect=snapshot):
+            publ = self.GroupModule.GroupPublisher(repo_group, conduit,
+                                                   config)
+            publ.working_dir = self.work_dir
+            publ.process_lifecycle()
+
+        _repomodel.objects.assert_called_once_with(
+            repo_id__in=repo_group.repo_ids)
+        # Snapshots are not snapshotted
+        self.assertEquals(["repo-1", "repo-2", "repo-3"], sorted(repos))
+        self.assertEquals(
+            {"repo-1": "repo-1__new", "repo-2": None,
+             "repo-3": "repo-3__old"},
+            publ.repo_snapshots)
+        bulk_write = _repogroup.get_collection.return_value.bulk_write
+        self.assertEquals(1, bulk_write.call_count)
+        bulk_write.assert_called_once_with(
+            [UpdateMany({'repo_ids': 'repo-1'},
+                        {'$addToSet': {'repo_ids': 'repo-1__new'}})],
+            ordered=False)
+        self.assertEquals(
+            {"repo-1": "repo-1__new", "repo-2": None,
+             "repo-3": "repo-3__old"},
+            conduit.build_success_report.call_args[0][0][
+                'repository_snapshots'])
+
+    @mock.patch("pulp_snapshot.plugins.distributors.publisher.RepoGroup")
+    @mock.patch("pulp_snapshot.plugins.distributors.group_publisher.RepoModel")  # noqa
+    def test_publish_failure(self, _repomodel, _repogroup):
+        repo_group = mock.MagicMock(id="group-1",
+                                    repo_ids=["repo-1", "repo-2"])
+        conduit = self._config_conduit()
+        config = dict()
+
+        _repomodel.objects.return_value = [
+            self._repo_obj("repo-1", {}),
+            self._repo_obj("repo-2", {}),
+        ]
+
+        def snapshot(publ, now):
+            if publ.get_repo().id == "repo-2":
+                raise ValueError("boom")
+            return "repo-1__new", True
+
+        with mock.patch.object(self.Module.Publisher, "snapshot",
+                               autospec=True, side_effect=snapshot):
+            publ = self.GroupModule.GroupPublisher(repo_group, conduit,
+                                                   config)
+            publ.working_dir = self.work_dir
+            with self.assertRaises(PulpCodedException) as ctx:
+                publ.process_main()
+
+        self.assertEquals(dict(repo="repo-2"), ctx.exception.error_data)
+        # The successful snapshot still joins its groups
+        bulk_write = _repogroup.get_collection.return_value.bulk_write
+        self.assertEquals(1, bulk_write.call_count)
+
+    @mock.patch("pulp_snapshot.plugins.distributors.bookkeeping.update_snapshots")  # noqa
+    @mock.patch("pulp_snapshot.plugins.distributors.bookkeeping.defer")
+    @mock.patch("pulp_snapshot.plugins.distributors.publisher.RepoGroup")
+    @mock.patch("pulp_snapshot.plugins.distributors.group_publisher.RepoModel")  # noqa
+    def test_publish_deferred(self, _repomodel, _repogroup, _defer,
+                              _update_snapshots):
+        repo_group = mock.MagicMock(id="group-1",
+                                    repo_ids=["repo-1", "repo-2"])
+        config = dict(defer_bookkeeping=True)
+        _repomodel.objects.return_value = [
+            self._repo_obj("repo-1", {}),
+            self._repo_obj("repo-2", {'_repository_snapshot': 'repo-2__old'}),
+        ]
+
+        def snapshot(publ, now):
+            if publ.get_repo().id == "repo-2":
+                return "repo-2__old", False
+            publ.deferred_counts = dict(rpm=3)
+            return "repo-1__new", True
+
+        with mock.patch.object(self.Module.Publisher, "snapshot",
+                               autospec=True, side_effect=snapshot):
+            publ = self.GroupModule.GroupPublisher(
+                repo_group, self._config_conduit(), config)
+            publ.working_dir = self.work_dir
+            publ.process_main()
+
+        self.assertFalse(_repogroup.get_collection.called)
+        _defer.assert_called_once_with("repo-1", "repo-1__new", dict(rpm=3))
+        _update_snapshots.apply_async.assert_called_once_with(countdown=5)
+
+    @mock.patch("pulp_snapshot.plugins.distributors.publisher.RepoGroup")
+    @mock.patch("pulp_snapshot.plugins.distributors.group_publisher.RepoModel")  # noqa
+    def test_repo_configs(self, _repomodel, _repogroup):
+        repo_group = mock.MagicMock(id="group-1",
+                                    repo_ids=["repo-1", "repo-2"])
+        config = dict(group_threads=2, include_types=["srpm"])
+        _repomodel.objects.return_value = [
+            self._repo_obj("repo-1", {}),
+            self._repo_obj("repo-2", {}),
+        ]
+        self.distributors = [mock.MagicMock(
+            repo_id="repo-1", config=dict(include_types=["rpm"]))]
+        configs = {}
+
+        def snapshot(publ, now):
+            configs[publ.get_repo().id] = publ.get_config()
+            return None, False
+
+        with mock.patch.object(self.Module.Publisher, "snapshot",
+                               autospec=True, side_effect=snapshot):
+            publ = self.GroupModule.GroupPublisher(
+                repo_group, self._config_conduit(), config)
+            publ.working_dir = self.work_dir
+            publ.process_main()
+
+        # As its own distributor would snapshot it
+        self.assertEquals(["rpm"], configs["repo-1"].get("include_types"))
+        self.assertEquals(100, configs["repo-1"].get("fetch_batch_size"))
+        self.assertEquals(None, configs["repo-1"].get("group_threads"))
+        # Without a snapshot distributor, with the group's
+        self.assertEquals(config, configs["repo-2"])
+
+    @mock.patch("pulp_snapshot.plugins.distributors.publisher.coalesce.run")
+    @mock.patch("pulp_snapshot.plugins.distributors.publisher.RepoGroup")
+    @mock.patch("pulp_snapshot.plugins.distributors.group_publisher.RepoModel")  # noqa
+    def test_coalesced(self, _repomodel, _repogroup, _run):
+        repo_group = mock.MagicMock(id="group-1",
+                                    repo_ids=["repo-1", "repo-2"])
+        _repomodel.objects.return_value = [
+            self._repo_obj("repo-1", {}),
+            self._repo_obj("repo-2", {}),
+        ]
+        self.distributors = [
+            mock.MagicMock(repo_id=repo_id, config=dict(coalesce_window=5))
+            for repo_id in ("repo-1", "repo-2")]
+
+        def run(repo, window, timeout, publish):
+            self.assertEquals((5, 3600), (window, timeout))
+            if repo.id == "repo-2":
+                # Snapshotted by a publish of the repository
+                return "repo-2__other", True
+            return publish(), False
+        _run.side_effect = run
+
+        with mock.patch.object(self.Module.Publisher, "snapshot",
+                               autospec=True,
+                               return_value=("repo-1__new", True)) as snap:
+            publ = self.GroupModule.GroupPublisher(
+                repo_group, self._config_conduit(), {})
+            publ.working_dir = self.work_dir
+            publ.process_main()
+
+        # Every snapshot is taken under the repository's lease
+        self.assertEquals(["repo-1", "repo-2"],
+                          sorted(x[0][0].id for x in _run.call_args_list))
+        self.assertEquals(1, snap.call_count)
+        self.assertEquals({"repo-1": "repo-1__new", "repo-2": "repo-2__other"},
+                          publ.repo_snapshots)
+        _repogroup.get_collection.return_value.bulk_write.assert_called_once_with(  # noqa
+            [UpdateMany({'repo_ids': 'repo-1'},
+                        {'$addToSet': {'repo_ids': 'repo-1__new'}})],
+            ordered=False)
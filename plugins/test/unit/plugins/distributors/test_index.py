@@ -0,0 +1,135 @@
+import unittest
+
+import mock
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+from .test_delta import SnapshotsTestCase
+from .test_distributor import BaseTest
+
+
+@unittest.skipIf(mongomock is None, "mongomock is not available")
+class TestIndex(BaseTest):
+    def setUp(self):
+        super(TestIndex, self).setUp()
+        from pulp_snapshot.plugins.distributors import index
+        self.Index = index
+        self.collection = mongomock.MongoClient().db.repo_snapshot_index
+        index.get_collection.return_value = self.collection
+
+    def entry(self, repo_id, timestamp):
+        return self.Index.SnapshotEntry(
+            snapshot_id="%s__%d" % (repo_id, timestamp),
+            timestamp=timestamp, digest="%040x" % timestamp, units=timestamp)
+
+    def test_add(self):
+        for timestamp in [20, 10, 30]:
+            self.Index.add("repo-1", self.entry("repo-1", timestamp))
+        self.Index.add("repo-2", self.entry("repo-2", 15))
+        self.assertEquals(
+            [self.entry("repo-1", x) for x in [10, 20, 30]],
+            self.Index.get_snapshots("repo-1"))
+        self.assertEquals([self.entry("repo-2", 15)],
+                          self.Index.get_snapshots("repo-2"))
+        self.assertEquals([], self.Index.get_snapshots("repo-3"))
+
+    def test_as_of(self):
+        self.Index.rebuild("repo-1",
+                           [self.entry("repo-1", x) for x in [30, 10, 20]])
+        self.assertEquals(None, self.Index.as_of("repo-1", 9.9))
+        self.assertEquals(self.entry("repo-1", 10),
+                          self.Index.as_of("repo-1", 10))
+        self.assertEquals(self.entry("repo-1", 20),
+                          self.Index.as_of("repo-1", 29.9))
+        self.assertEquals(self.entry("repo-1", 30),
+                          self.Index.as_of("repo-1", 1000))
+        self.assertEquals(None, self.Index.as_of("repo-2", 1000))
+
+    def test_remove(self):
+        self.Index.rebuild("repo-1",
+                           [self.entry("repo-1", x) for x in [10, 20, 30]])
+        self.Index.rebuild("repo-2", [self.entry("repo-2", 10)])
+        self.Index.remove(["repo-1__10", "repo-1__30", "repo-2__10"])
+        self.assertEquals([self.entry("repo-1", 20)],
+                          self.Index.get_snapshots("repo-1"))
+        self.assertEquals([], self.Index.get_snapshots("repo-2"))
+
+
+@unittest.skipIf(mongomock is None, "mongomock is not available")
+class TestReuseSnapshot(SnapshotsTestCase):
+    def setUp(self):
+        super(TestReuseSnapshot, self).setUp()
+        self.Module.index.get_collection.return_value = \
+            mongomock.MongoClient().db.repo_snapshot_index
+
+    def check_reuse(self, **config):
+        first, created, _publ = self.snapshot(**config)
+        self.assertTrue(created)
+        self.set_units(range(1, 12))
+        second, created, _publ = self.snapshot(**config)
+        self.assertTrue(created)
+
+        # Back to the first state
+        self.set_units(range(10))
+        snapshot_name, created, publ = self.snapshot(**config)
+        self.assertEquals((first, False), (snapshot_name, created))
+        self.assertEquals(first, publ.reused_snapshot)
+        self.assertEquals([first, second], sorted(self.repos.repos))
+        # Current again from the publish that reused it
+        self.assertEquals(
+            [first, second, first],
+            [x.snapshot_id
+             for x in self.Module.index.get_snapshots("repo-1")])
+        self.assertEquals(
+            first, self.Module.index.as_of("repo-1", self.now).snapshot_id)
+        self.assertEquals(
+            second,
+            self.Module.index.as_of("repo-1", self.now - 1).snapshot_id)
+
+        # Unchanged since
+        snapshot_name, created, publ = self.snapshot(**config)
+        self.assertEquals((first, False), (snapshot_name, created))
+        self.assertEquals(None, publ.reused_snapshot)
+
+    def test_reuse_python(self):
+        self.check_reuse(snapshot_storage='full', diff_engine='python')
+
+    def test_reuse_aggregate(self):
+        self.check_reuse(snapshot_storage='full', diff_engine='aggregate')
+
+    def test_reuse_merge(self):
+        self.check_reuse(snapshot_storage='full', diff_engine='merge')
+
+    def test_reuse_delta(self):
+        self.check_reuse()
+
+    def test_deleted_snapshot(self):
+        first, _created, _publ = self.snapshot(snapshot_storage='full')
+        self.set_units(range(1, 12))
+        self.snapshot(snapshot_storage='full')
+        # Deleted, but still in the index
+        del self.repos.repos[first]
+
+        self.set_units(range(10))
+        snapshot_name, created, publ = self.snapshot(snapshot_storage='full')
+        self.assertTrue(created)
+        self.assertNotEquals(first, snapshot_name)
+        self.assertEquals(None, publ.reused_snapshot)
+
+    def test_publish(self):
+        first, _created, _publ = self.snapshot(snapshot_storage='full')
+        self.set_units(range(1, 12))
+        self.snapshot(snapshot_storage='full')
+        self.set_units(range(10))
+
+        publ = self.Module.Publisher(self.repo, self._config_conduit(), {})
+        with mock.patch.object(self.Module, "RepoGroup") as group:
+            publ.process_main()
+        group.get_collection.return_value.update.assert_called_once_with(
+            dict(repo_ids="repo-1"), {'$addToSet': dict(repo_ids=first)})
+        self.assertEquals(first, publ.repo_snapshot)
+        self.assertTrue(
+            publ.get_progress_report_summary()['reused_snapshot'])
@@ -0,0 +1,177 @@
+import unittest
+
+import mock
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+from pulp_snapshot.plugins.distributors import indexes
+from .test_delta import SnapshotsTestCase
+
+UNITS_INDEX = 'repo_id_1_unit_id_1_unit_type_id_1'
+COLLSCAN = dict(stage='COLLSCAN')
+SORTED_COLLSCAN = dict(stage='SORT', inputStage=dict(
+    stage='SORT_KEY_GENERATOR', inputStage=COLLSCAN))
+
+
+def ixscan(name):
+    return dict(stage='FETCH', inputStage=dict(stage='IXSCAN',
+                                               indexName=name))
+
+
+IXSCAN = ixscan(UNITS_INDEX)
+
+
+def explained(plan):
+    return dict(queryPlanner=dict(winningPlan=plan, rejectedPlans=[]))
+
+
+def collection(name, plan):
+    ret = mock.MagicMock()
+    ret.name = name
+    ret.find.return_value.sort.return_value.explain.return_value = \
+        explained(plan)
+    ret.find.return_value.explain.return_value = explained(plan)
+    return ret
+
+
+class TestIndexes(unittest.TestCase):
+    def test_ensure_indexes(self):
+        collections = {}
+
+        def get_collection(name, create=False):
+            return collections.setdefault(name, mock.MagicMock(**{
+                'create_index.return_value': "%s_index" % name}))
+        with mock.patch.object(indexes, "connection", **{
+                'get_collection.side_effect': get_collection}):
+            ret = indexes.ensure_indexes()
+        # Pulp's own collections are left alone
+        self.assertEquals(['repo_snapshot_deltas', 'repo_snapshot_index'],
+                          sorted(ret))
+        self.assertEquals(["repo_snapshot_index_index"],
+                          ret['repo_snapshot_index'])
+        collections['repo_snapshot_deltas'].create_index.assert_called_once_with(  # noqa
+            [('snapshot_id', 1), ('unit_type_id', 1), ('unit_id', 1)],
+            background=True)
+
+    def test_index_name(self):
+        self.assertEquals(UNITS_INDEX,
+                          indexes.index_name(indexes.UNITS_INDEX))
+        self.assertEquals('repo_ids_1',
+                          indexes.index_name(indexes.GROUPS_INDEX))
+
+    def test_plan_stages(self):
+        self.assertEquals(['FETCH', 'IXSCAN'],
+                          indexes.plan_stages(explained(IXSCAN)))
+        self.assertEquals(
+            ['OR', 'IXSCAN', 'COLLSCAN'],
+            indexes.plan_stages(explained(dict(
+                stage='OR', inputStages=[dict(stage='IXSCAN'), COLLSCAN]))))
+        # Servers before 3.0
+        self.assertEquals([], indexes.plan_stages(
+            dict(cursor='BtreeCursor repo_id_1', scanAndOrder=False)))
+        self.assertEquals(['SORT', 'COLLSCAN'], indexes.plan_stages(
+            dict(cursor='BasicCursor', scanAndOrder=True)))
+
+    def test_plan_indexes(self):
+        self.assertEquals([UNITS_INDEX],
+                          indexes.plan_indexes(explained(IXSCAN)))
+        self.assertEquals([], indexes.plan_indexes(explained(COLLSCAN)))
+        self.assertEquals(['repo_id_1'], indexes.plan_indexes(
+            dict(cursor='BtreeCursor repo_id_1', scanAndOrder=False)))
+        self.assertEquals([], indexes.plan_indexes(
+            dict(cursor='BasicCursor', scanAndOrder=True)))
+
+    def test_check_plans(self):
+        units = collection("repo_content_units", IXSCAN)
+        # An index on the same fields in another order
+        other = collection("repo_content_units", ixscan(
+            'repo_id_1_unit_type_id_1_unit_id_1'))
+        groups = collection("repo_groups", COLLSCAN)
+        deltas = collection("repo_snapshot_deltas", SORTED_COLLSCAN)
+        queries = [
+            indexes.HotQuery('units', units, dict(repo_id="repo-1"),
+                             [('unit_id', 1)], indexes.UNITS_INDEX),
+            indexes.HotQuery('other', other, dict(repo_id="repo-1"),
+                             [('unit_id', 1)], indexes.UNITS_INDEX),
+            indexes.HotQuery('groups', groups, dict(repo_ids="repo-1"),
+                             None, indexes.GROUPS_INDEX),
+            indexes.HotQuery('deltas', deltas, dict(snapshot_id="s"),
+                             [('unit_id', 1)], None),
+        ]
+        with mock.patch.object(indexes, "_LOG") as log:
+            ret = indexes.check_plans(queries)
+        self.assertEquals(dict(other=['INDEX_NOT_USED'],
+                               groups=['COLLSCAN', 'INDEX_NOT_USED'],
+                               deltas=['COLLSCAN', 'SORT']), ret)
+        self.assertEquals(3, log.warning.call_count)
+        units.find.assert_called_once_with(dict(repo_id="repo-1"))
+        units.find.return_value.sort.assert_called_once_with(
+            [('unit_id', 1)])
+        self.assertFalse(groups.find.return_value.sort.called)
+
+
+@unittest.skipIf(mongomock is None, "mongomock is not available")
+class TestPublishQueryPlans(SnapshotsTestCase):
+    def setUp(self):
+        super(TestPublishQueryPlans, self).setUp()
+        self.collections = {}
+        patch = mock.patch.object(indexes, "connection", **{
+            'get_collection.side_effect': self.get_collection})
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def get_collection(self, name, create=False):
+        plans = dict(repo_content_units=IXSCAN,
+                     repo_snapshot_deltas=ixscan(
+                         'snapshot_id_1_unit_type_id_1_unit_id_1'),
+                     repo_snapshot_index=ixscan('snapshots.snapshot_id_1'))
+        if name not in self.collections:
+            self.collections[name] = collection(name,
+                                                plans.get(name, COLLSCAN))
+            self.collections[name].distinct.return_value = [u"rpm"]
+        return self.collections[name]
+
+    def publish(self, **config):
+        publ = self.Module.Publisher(self.repo, self._config_conduit(),
+                                     config)
+        with mock.patch.object(self.Module, "RepoGroup"), \
+                mock.patch.object(publ, "prune"):
+            snapshot_name = publ.publish_snapshot()
+        return snapshot_name, publ
+
+    def test_check_query_plans(self):
+        snapshot_name, publ = self.publish(check_query_plans=True,
+                                           include_types=["rpm"])
+        self.assertEquals(
+            dict(repository_groups=['COLLSCAN', 'INDEX_NOT_USED']),
+            publ.get_progress_report_summary()['query_plan_warnings'])
+        units = self.collections['repo_content_units']
+        # Sorted units are read a unit type at a time
+        self.assertEquals(
+            [mock.call(dict(repo_id="repo-1", unit_type_id=u"rpm")),
+             mock.call(dict(repo_id=snapshot_name, unit_type_id=u"rpm"))],
+            units.find.call_args_list)
+        self.assertEquals(
+            [mock.call('unit_type_id',
+                       dict(repo_id="repo-1", unit_type_id={'$in': ['rpm']})),
+             mock.call('unit_type_id', dict(repo_id=snapshot_name))],
+            units.distinct.call_args_list)
+        units.find.return_value.sort.assert_called_with([('unit_id', 1)])
+        self.collections['repo_groups'].find.assert_called_once_with(
+            dict(repo_ids="repo-1"))
+
+    def test_disabled(self):
+        _snapshot_name, publ = self.publish()
+        self.assertEquals({}, self.collections)
+        self.assertNotIn('query_plan_warnings',
+                         publ.get_progress_report_summary())
+
+    def test_validate_config(self):
+        repo = mock.MagicMock(id="repo-1")
+        validate = self.Distributor.Snapshot_Distributor().validate_config
+        self.assertEquals((True, None),
+                          validate(repo, dict(check_query_plans=True), None))
+        self.assertFalse(
+            validate(repo, dict(check_query_plans="sometimes"), None)[0])
@@ -0,0 +1,205 @@
+import os
+import shutil
+import tempfile
+import unittest
+import uuid
+from StringIO import StringIO
+
+import mock
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+from pulp_snapshot.plugins.distributors import diff, manifest, unitkeys
+from .test_delta import SnapshotsTestCase
+
+UUIDS = sorted(unicode(uuid.UUID(int=i * 7919)) for i in range(1, 500))
+
+
+class ManifestTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.units = [(u"rpm", x) for x in UUIDS] + [
+            (u"erratum", u"RHBA-2017:0001"), (u"erratum", u"RHSA-2017:12")]
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def write(self, name, units, **info):
+        path = os.path.join(self.work_dir, name)
+        manifest.write(path, unitkeys.UnitKeySet(units), **info)
+        return path
+
+
+class TestManifest(ManifestTest):
+    def test_round_trip(self):
+        path = self.write("snap", self.units, snapshot_id="repo-1__1",
+                          timestamp=1.5)
+        self.assertEquals([], [x for x in os.listdir(self.work_dir)
+                               if x != "snap"])
+        with manifest.Manifest(path) as snapshot:
+            self.assertEquals(dict(snapshot_id="repo-1__1", timestamp=1.5),
+                              snapshot.info)
+            self.assertEquals(sorted(self.units), list(snapshot.units))
+            self.assertEquals(dict(rpm=499, erratum=2),
+                              snapshot.units.counts())
+            self.assertIn((u"erratum", u"RHSA-2017:12"), snapshot.units)
+        # 16 bytes per UUID
+        self.assertLess(os.path.getsize(path), 499 * 16 + 300)
+
+    def test_empty(self):
+        path = self.write("snap", [])
+        with manifest.Manifest(path) as snapshot:
+            self.assertEquals([], list(snapshot.units))
+
+    def test_invalid(self):
+        path = self.write("snap", self.units)
+        with open(path, 'rb') as f:
+            data = f.read()
+        with open(path, 'wb') as f:
+            f.write(data[:-1])
+        self.assertRaises(ValueError, manifest.Manifest, path)
+        with open(path, 'wb') as f:
+            f.write("not a manifest")
+        self.assertRaises(ValueError, manifest.Manifest, path)
+
+    def test_diff(self):
+        old = self.units[:300] + self.units[310:]
+        new = self.units[5:400] + [(u"srpm", u"x")] + self.units[401:]
+        old_path = self.write("old", old)
+        new_path = self.write("new", new)
+        self.assertEquals(
+            list(diff.merge_diff(sorted(new), sorted(old))),
+            list(manifest.diff(old_path, new_path)))
+        self.assertEquals([], list(manifest.diff(old_path, old_path)))
+
+    def test_main(self):
+        old_path = self.write("old", self.units[1:])
+        new_path = self.write("new", self.units[:-1])
+        with mock.patch("sys.stdout", new_callable=StringIO) as stdout:
+            self.assertEquals(
+                1, manifest.main(["manifest", "diff", old_path, new_path]))
+        self.assertEquals(
+            "- erratum RHSA-2017:12\n+ rpm %s\n" % UUIDS[0],
+            stdout.getvalue())
+        with mock.patch("sys.stdout", new_callable=StringIO):
+            self.assertEquals(
+                0, manifest.main(["manifest", "diff", old_path, old_path]))
+        with mock.patch("sys.stderr", new_callable=StringIO):
+            self.assertEquals(2, manifest.main(["manifest", "diff"]))
+
+
+@unittest.skipIf(mongomock is None, "mongomock is not available")
+class TestPublishManifest(SnapshotsTestCase):
+    def setUp(self):
+        super(TestPublishManifest, self).setUp()
+        self.config = dict(write_manifest=True, manifest_dir=os.path.join(
+            self.work_dir, "manifests"))
+
+    def publish(self, **config):
+        # Manifests are written by publish_snapshot(), once it has the
+        # snapshot
+        config.setdefault('snapshot_storage', 'delta')
+        config.setdefault('checkpoint_interval', 3)
+        publ = self.Module.Publisher(self.repo, self._config_conduit(),
+                                     config)
+        self.now += 1
+        with mock.patch.object(self.Module.time, "time",
+                               return_value=self.now), \
+                mock.patch.object(self.Module, "RepoGroup"), \
+                mock.patch.object(publ, "prune"):
+            snapshot_name = publ.publish_snapshot()
+        self.repo.notes['_repository_snapshot'] = snapshot_name
+        return snapshot_name, publ
+
+    def manifest_units(self, publ):
+        with manifest.Manifest(publ.manifest) as snapshot:
+            return snapshot.info, list(snapshot.units)
+
+    def test_write_manifest(self):
+        full, publ = self.publish(**self.config)
+        self.assertEquals(
+            os.path.join(self.config['manifest_dir'], full + ".manifest"),
+            publ.get_progress_report_summary()['manifest'])
+        info, units = self.manifest_units(publ)
+        self.assertEquals(self.units("repo-1"), units)
+        self.assertEquals(dict(snapshot_id=full, repo_id="repo-1",
+                               timestamp=self.now, repo_type=None,
+                               digest=self.notes(full)['_repository_digest']),
+                          info)
+
+        # Delta snapshots are written out in full
+        self.set_units(range(1, 12))
+        snap1, publ = self.publish(**self.config)
+        self.assertEquals(full, self.notes(snap1)['_repository_base'])
+        self.assertEquals(self.units("repo-1"), self.manifest_units(publ)[1])
+
+        # Only new snapshots are written
+        with mock.patch.object(manifest, "write") as write:
+            snap, publ = self.publish(**self.config)
+        self.assertEquals(snap1, snap)
+        self.assertFalse(write.called)
+        self.assertTrue(publ.manifest.endswith(snap1 + ".manifest"))
+
+    def test_no_manifest_dir(self):
+        # The working directory is deleted with the task, so nothing is
+        # written there
+        with mock.patch.object(manifest, "write") as write:
+            _full, publ = self.publish(write_manifest=True)
+        self.assertFalse(write.called)
+        self.assertIsNone(publ.manifest)
+        self.assertNotIn('manifest', publ.get_progress_report_summary())
+
+    def test_disabled(self):
+        _full, publ = self.publish()
+        self.assertNotIn('manifest', publ.get_progress_report_summary())
+
+    def test_import_manifest(self):
+        full, publ = self.publish(**self.config)
+        expected = self.units(full)
+        notes = dict(self.notes(full))
+        snapshot_id = self.Module.import_manifest(publ.manifest,
+                                                  "repo-2__copy")
+        self.assertEquals("repo-2__copy", snapshot_id)
+        self.assertEquals(expected, self.units("repo-2__copy"))
+        repo_obj = self.repos.repos["repo-2__copy"]
+        self.assertEquals(dict(rpm=5, srpm=5), repo_obj.content_unit_counts)
+        self.assertEquals("repo-2__copy",
+                          repo_obj.notes['_repository_snapshot'])
+        self.assertEquals(notes['_repository_digest'],
+                          repo_obj.notes['_repository_digest'])
+        self.assertFalse(
+            self.Module.checkpoint.is_incomplete(repo_obj.notes))
+        # Indexed as a snapshot of the repository it was taken of
+        query, update = self.index_collection.update_one.call_args[0]
+        self.assertEquals(dict(_id="repo-1"), query)
+        self.assertEquals(
+            "repo-2__copy",
+            update['$push']['snapshots']['$each'][0]['snapshot_id'])
+
+    def test_import_corrupt_manifest(self):
+        path = os.path.join(self.work_dir, "snap.manifest")
+        manifest.write(path, unitkeys.UnitKeySet([(u"rpm", u"1")]),
+                       snapshot_id="repo-1__1", digest="0" * 40)
+        self.assertRaises(ValueError, self.Module.import_manifest, path)
+        self.assertEquals({}, self.repos.repos)
+
+    def test_validate_config(self):
+        repo = mock.MagicMock(id="repo-1")
+        validate = self.Distributor.Snapshot_Distributor().validate_config
+        self.assertEquals(
+            (True, None),
+            validate(repo, dict(write_manifest=True,
+                                manifest_dir="/var/lib/pulp/manifests"),
+                     None))
+        self.assertEquals(
+            (False, 'Configuration key [manifest_dir] must be an absolute '
+             'path, but was [manifests]'),
+            validate(repo, dict(manifest_dir="manifests"), None))
+        self.assertEquals(
+            (False, 'Configuration key [manifest_dir] is required when '
+             '[write_manifest] is set'),
+            validate(repo, dict(write_manifest="true"), None))
+        self.assertEquals(
+            (True, None), validate(repo, dict(write_manifest=False), None))
@@ -0,0 +1,93 @@
+import unittest
+
+import mock
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+from pulp.server.exceptions import PulpCodedException
+
+from .test_delta import SnapshotsTestCase
+
+
+@unittest.skipIf(mongomock is None, "mongomock is not available")
+class TestRestore(SnapshotsTestCase):
+    def setUp(self):
+        super(TestRestore, self).setUp()
+        patch = mock.patch(
+            "pulp_snapshot.plugins.distributors.restore.RepoModel")
+        self._repomodel = patch.start()
+        self.patches.append(patch)
+
+    def restore(self, snapshot_id, **config):
+        config.update(restore_snapshot=snapshot_id, copy_batch_size=2)
+        publ = self.Module.Publisher(self.repo, self._config_conduit(),
+                                     config)
+        publ.process_main()
+        return publ
+
+    def test_restore(self):
+        snapshot, _created, _publ = self.snapshot()
+        self.set_units(range(3, 15))
+        self.repo.notes['_repository_snapshot'] = None
+
+        publ = self.restore(snapshot)
+
+        self.assertEquals(self.units(snapshot), self.units("repo-1"))
+        self.assertEquals(dict(added=3, removed=5), publ.units_diff)
+        self.assertEquals(snapshot, publ.repo_snapshot)
+        self.assertEquals(snapshot, self.repo.notes['_repository_snapshot'])
+        self._repomodel.objects.assert_called_once_with(repo_id="repo-1")
+        self._repomodel.objects.return_value.update_one.assert_called_once_with(  # noqa
+            set__notes___repository_snapshot=snapshot,
+            inc__content_unit_counts__rpm=-1,
+            inc__content_unit_counts__srpm=-1,
+            set__last_unit_added=mock.ANY,
+            set__last_unit_removed=mock.ANY)
+        self.assertEquals(8, publ.progress_successes)
+
+    def test_restore_delta(self):
+        self.snapshot()
+        self.set_units(range(5))
+        snapshot, _created, _publ = self.snapshot()
+        self.assertTrue(self.Delta.is_delta(self.notes(snapshot)))
+        self.set_units(range(2, 7))
+
+        publ = self.restore(snapshot)
+
+        self.assertEquals(self.units("repo-1"), sorted(
+            self.Delta.logical_units(self.units_coll, snapshot)))
+        self.assertEquals(dict(added=2, removed=2), publ.units_diff)
+        # Restoring is a no-op the second time
+        publ = self.restore(snapshot)
+        self.assertEquals(dict(added=0, removed=0), publ.units_diff)
+        self._repomodel.objects.return_value.update_one.assert_called_with(
+            set__notes___repository_snapshot=snapshot)
+
+    def test_restore_parallel(self):
+        snapshot, _created, _publ = self.snapshot(snapshot_storage='full')
+        self.set_units(range(3, 15))
+
+        publ = self.restore(snapshot, fetch_threads=4)
+
+        self.assertEquals(self.units(snapshot), self.units("repo-1"))
+        self.assertEquals(dict(added=3, removed=5), publ.units_diff)
+        self.assertEquals(22, publ.units_read['documents'])
+
+    def test_restore_unknown(self):
+        for snapshot_id in ["repo-1__20090213233130.1234Z",
+                            "repo-1", "repo-2__20090213233130.1234Z"]:
+            with self.assertRaises(PulpCodedException) as ctx:
+                self.restore(snapshot_id)
+            self.assertEquals("SNAP0101", ctx.exception.error_code.code)
+
+    def test_validate_config(self):
+        repo = mock.MagicMock(id="repo-1")
+        validate = self.Distributor.Snapshot_Distributor().validate_config
+        self.assertEquals(
+            (True, None),
+            validate(repo, dict(restore_snapshot="repo-1__1"), None))
+        self.assertEquals(
+            (False, 'Configuration key [restore_snapshot] must name a '
+             'snapshot of repository repo-1, but was [repo-2__1]'),
+            validate(repo, dict(restore_snapshot="repo-2__1"), None))
@@ -0,0 +1,195 @@
+import mock
+
+from .test_distributor import BaseTest
+
+DAY = 86400
+# 2009-02-13 23:31:30 UTC, a Friday
+NOW = 1234567890.1234
+
+
+class RetentionBaseTest(BaseTest):
+    def setUp(self):
+        super(RetentionBaseTest, self).setUp()
+        from pulp_snapshot.plugins.distributors import retention
+        self.Retention = retention
+
+
+class TestExpired(RetentionBaseTest):
+    def _snapshots(self, *ages):
+        return [("snap-%s" % age, NOW - age * DAY) for age in ages]
+
+    def test_no_policy(self):
+        self.assertEquals(
+            [], self.Retention.expired(self._snapshots(1, 2, 3), NOW))
+
+    def test_last(self):
+        self.assertEquals(
+            ["snap-3", "snap-4"],
+            self.Retention.expired(self._snapshots(3, 1, 4, 2), NOW, last=2))
+
+    def test_days(self):
+        self.assertEquals(
+            ["snap-3", "snap-4"],
+            self.Retention.expired(self._snapshots(0.5, 1, 2.5, 3, 4), NOW,
+                                   days=2.5))
+
+    def test_daily(self):
+        # Two snapshots today; the newest one is kept
+        self.assertEquals(
+            ["snap-0.5", "snap-5"],
+            self.Retention.expired(self._snapshots(0, 0.5, 2, 5), NOW,
+                                   daily=2))
+
+    def test_weekly(self):
+        # Friday, Monday, previous Sunday, and two weeks back
+        self.assertEquals(
+            ["snap-14", "snap-4", "snap-6"],
+            self.Retention.expired(self._snapshots(0, 4, 5, 6, 14), NOW,
+                                   weekly=2))
+
+    def test_combined(self):
+        self.assertEquals(
+            ["snap-30", "snap-4"],
+            self.Retention.expired(self._snapshots(1, 2, 3, 4, 30), NOW,
+                                   last=2, days=3, weekly=1, daily=0))
+
+
+class TestFindSnapshots(RetentionBaseTest):
+    def test_parse_timestamp(self):
+        self.assertEquals(
+            NOW,
+            round(self.Retention.parse_timestamp(
+                "repo-1__20090213233130.1234Z"), 4))
+        self.assertEquals(None, self.Retention.parse_timestamp("repo-1"))
+
+    @mock.patch("pulp_snapshot.plugins.distributors.retention.RepoModel")
+    def test_find_snapshots(self, _repomodel):
+        _repomodel.objects.return_value.only.return_value = [
+            mock.MagicMock(repo_id="repo-1__20090213233130.1234Z"),
+            mock.MagicMock(repo_id="repo-1__other"),
+            mock.MagicMock(repo_id="repo-1__other__20090213233130.1234Z"),
+        ]
+        self.assertEquals(
+            ["repo-1__20090213233130.1234Z"],
+            [x[0] for x in self.Retention.find_snapshots("repo-1")])
+        _repomodel.objects.assert_called_once_with(
+            repo_id__startswith="repo-1__")
+
+    @mock.patch("pulp_snapshot.plugins.distributors.retention.index")
+    @mock.patch("pulp_snapshot.plugins.distributors.retention.RepoModel")
+    def test_reused_snapshots(self, _repomodel, _index):
+        old = "repo-1__20090101000000.0000Z"
+        new = "repo-1__20090201000000.0000Z"
+        _repomodel.objects.return_value.only.return_value = [
+            mock.MagicMock(repo_id=old), mock.MagicMock(repo_id=new)]
+        # "old" was reused after "new" was taken
+        _index.get_snapshots.return_value = [
+            mock.MagicMock(snapshot_id=old, timestamp=NOW - 3 * DAY),
+            mock.MagicMock(snapshot_id=new, timestamp=NOW - 2 * DAY),
+            mock.MagicMock(snapshot_id=old, timestamp=NOW - DAY)]
+        snapshots = self.Retention.find_snapshots("repo-1")
+        self.assertEquals([(old, NOW - DAY), (new, NOW - 2 * DAY)],
+                          snapshots)
+        self.assertEquals([new], self.Retention.expired(snapshots, NOW,
+                                                        last=1))
+        _index.get_snapshots.assert_called_once_with("repo-1")
+
+        # Snapshots taken before the index fall back to their names
+        _index.get_snapshots.return_value = []
+        self.assertEquals(
+            [(old, self.Retention.parse_timestamp(old)),
+             (new, self.Retention.parse_timestamp(new))],
+            self.Retention.find_snapshots("repo-1"))
+
+
+class TestPrune(RetentionBaseTest):
+    @mock.patch("pulp_snapshot.plugins.distributors.retention.cache")
+    @mock.patch("pulp_snapshot.plugins.distributors.retention.delta")
+    @mock.patch("pulp_snapshot.plugins.distributors.retention.time.sleep")
+    @mock.patch("pulp_snapshot.plugins.distributors.retention.repo_controller")  # noqa
+    @mock.patch("pulp_snapshot.plugins.distributors.retention.RepoModel")
+    @mock.patch("pulp_snapshot.plugins.distributors.retention.RepoGroup")
+    @mock.patch("pulp_snapshot.plugins.distributors.retention.RepoContentUnit")  # noqa
+    def test_prune(self, _units, _repogroup, _repomodel, _repoctrl, _sleep,
+                   _delta, _cache):
+        # "d" is based on "c", and is kept
+        d = "repo-1__20240101120000.0000Z"
+        _delta.dependents.return_value = ["b", d]
+        self.Retention.prune(["a", "b", "c"], 2, 0.5, 50, 2)
+
+        _delta.dependents.assert_called_once_with(["a", "b", "c"])
+        _delta.materialize.assert_called_once_with(d, 50, retries=2)
+        self.assertEquals(
+            [mock.call({'snapshot_id': {'$in': ["a", "b"]}}),
+             mock.call({'snapshot_id': {'$in': ["c"]}})],
+            _delta.get_collection.return_value.delete_many.call_args_list)
+        self.assertEquals(
+            [mock.call({'snapshots.snapshot_id': {'$in': x}},
+                       {'$pull': {'snapshots': {'snapshot_id': {'$in': x}}}})
+             for x in [["a", "b"], ["c"]]],
+            self.index_collection.update_many.call_args_list)
+
+        units_coll = _units.get_collection.return_value
+        self.assertEquals(
+            [mock.call({'repo_id': {'$in': ["a", "b"]}}),
+             mock.call({'repo_id': {'$in': ["c"]}})],
+            units_coll.delete_many.call_args_list)
+        group_coll = _repogroup.get_collection.return_value
+        # Materialized, "d" joins the groups of its repository
+        (requests,), _kwargs = group_coll.bulk_write.call_args
+        self.assertEquals(
+            [(dict(repo_ids="repo-1"), {'$addToSet': dict(repo_ids=d)})],
+            [(x._filter, x._doc) for x in requests])
+        self.assertEquals(
+            [mock.call({'repo_ids': {'$in': ["a", "b"]}},
+                       {'$pull': {'repo_ids': {'$in': ["a", "b"]}}}),
+             mock.call({'repo_ids': {'$in': ["c"]}},
+                       {'$pull': {'repo_ids': {'$in': ["c"]}}})],
+            group_coll.update_many.call_args_list)
+        _repomodel.objects.assert_has_calls([
+            mock.call(repo_id__in=["a", "b"]),
+            mock.call().update(set__content_unit_counts={}),
+            mock.call(repo_id__in=["c"]),
+            mock.call().update(set__content_unit_counts={}),
+        ])
+        self.assertEquals([mock.call(x) for x in ["a", "b", "c"]],
+                          _repoctrl.delete.call_args_list)
+        self.assertEquals([mock.call(["a", "b"]), mock.call(["c"])],
+                          _cache.invalidate.call_args_list)
+        _sleep.assert_called_once_with(0.5)
+
+    @mock.patch("pulp_snapshot.plugins.distributors.publisher.index")
+    @mock.patch("pulp_snapshot.plugins.distributors.publisher.bookkeeping")
+    @mock.patch("pulp_snapshot.plugins.distributors.retention.prune")
+    @mock.patch("pulp_snapshot.plugins.distributors.retention.find_snapshots")  # noqa
+    def test_publisher_prune(self, _find_snapshots, _prune, _bookkeeping,
+                             _index):
+        repo = mock.MagicMock(
+            id="repo-1",
+            notes={'_repository_snapshot': "repo-1__2"})
+        conduit = self._config_conduit()
+        config = dict(retain_last=1, prune_batch_size=5)
+        _find_snapshots.return_value = [
+            ("repo-1__1", NOW - 3), ("repo-1__2", NOW - 2),
+            ("repo-1__3", NOW - 1), ("repo-1__4", NOW)]
+
+        publ = self.Module.Publisher(repo, conduit, config)
+        publ.prune(NOW, "repo-1__3")
+
+        _find_snapshots.assert_called_once_with("repo-1")
+        # The current snapshot, and the one in the notes, are kept. The
+        # others are deleted by the bookkeeping task, without holding up
+        # the publish.
+        self.assertFalse(_prune.called)
+        _index.remove.assert_called_once_with(["repo-1__1"])
+        _bookkeeping.defer_prune.assert_called_once_with(
+            ["repo-1__1"], 5, 1.0, 1000, 3)
+        _bookkeeping.schedule.assert_called_once_with()
+        self.assertEquals(["repo-1__1"], publ.pruned_snapshots)
+
+    @mock.patch("pulp_snapshot.plugins.distributors.retention.find_snapshots")  # noqa
+    def test_publisher_prune_no_policy(self, _find_snapshots):
+        repo = mock.MagicMock(id="repo-1", notes={})
+        publ = self.Module.Publisher(repo, self._config_conduit(), dict())
+        publ.prune(NOW, "repo-1__3")
+        _find_snapshots.assert_not_called()
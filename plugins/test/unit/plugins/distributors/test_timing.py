@@ -0,0 +1,59 @@
+import itertools
+
+import mock
+
+from pulp_snapshot.plugins.distributors import timing
+from .... import testbase
+
+
+@mock.patch("pulp_snapshot.plugins.distributors.timing.clock")
+class TestPhases(testbase.TestCase):
+    def test_phases(self, _clock):
+        _clock.side_effect = itertools.count()
+        phases = timing.Phases()
+        with phases.phase('fetch'):
+            phases.add_documents(3)
+        with phases.phase('copy'):
+            phases.add_documents(2)
+        # Phases running more than once accumulate
+        with phases.phase('fetch'):
+            phases.add_documents(1)
+        self.assertEquals(
+            dict(fetch=dict(seconds=2.0, documents=4),
+                 copy=dict(seconds=1.0, documents=2)),
+            phases.as_dict())
+        self.assertEquals(3.0, phases.seconds)
+        self.assertEquals(
+            "total_seconds=3.000000 "
+            "fetch_seconds=2.000000 fetch_documents=4 "
+            "copy_seconds=1.000000 copy_documents=2",
+            phases.format())
+
+    def test_nested(self, _clock):
+        _clock.side_effect = itertools.count()
+        phases = timing.Phases()
+        with phases.phase('copy'):
+            with phases.phase('fetch'):
+                phases.add_documents(5)
+            phases.add_documents(5)
+        self.assertEquals(
+            dict(copy=dict(seconds=3.0, documents=5),
+                 fetch=dict(seconds=1.0, documents=5)),
+            phases.as_dict())
+
+    def test_no_phase(self, _clock):
+        phases = timing.Phases()
+        phases.add_documents(5)
+        self.assertEquals({}, phases.as_dict())
+        phases.add_documents(5, name='prune')
+        self.assertEquals(dict(prune=dict(seconds=0.0, documents=5)),
+                          phases.as_dict())
+
+    def test_exception(self, _clock):
+        _clock.side_effect = [10, 12.5]
+        phases = timing.Phases()
+        with self.assertRaises(ValueError):
+            with phases.phase('diff'):
+                raise ValueError()
+        self.assertEquals(dict(diff=dict(seconds=2.5, documents=0)),
+                          phases.as_dict())
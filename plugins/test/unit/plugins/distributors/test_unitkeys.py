@@ -0,0 +1,96 @@
+import unittest
+import uuid
+
+from pulp_snapshot.plugins.distributors import diff, unitkeys
+
+UUIDS = sorted(unicode(uuid.UUID(int=i * 7919)) for i in range(1, 50))
+
+
+class TestUnitKeySet(unittest.TestCase):
+    def setUp(self):
+        self.units = [(u"rpm" if i % 3 else u"srpm", x)
+                      for i, x in enumerate(UUIDS)]
+
+    def test_uuids(self):
+        units = unitkeys.UnitKeySet(reversed(self.units + self.units[:5]))
+        self.assertEquals(sorted(self.units), list(units))
+        self.assertEquals(len(self.units), len(units))
+        self.assertEquals(dict(rpm=32, srpm=17), units.counts())
+        self.assertEquals(
+            ("uuid", 16), (units._keys[0].codec, units._keys[0].width))
+        for unit in self.units:
+            self.assertIn(unit, units)
+            self.assertIn(unitkeys.UnitKey(*unit), units)
+        self.assertNotIn((u"erratum", UUIDS[0]), units)
+        self.assertNotIn((u"rpm", UUIDS[0].upper()), units)
+        self.assertNotIn((u"rpm", u"abc"), units)
+
+    def test_other_ids(self):
+        keys = [(u"rpm", u"b"), (u"rpm", u"abc"), (u"rpm", u"ab"),
+                (u"rpm", u"\xe9t\xe9"), (u"srpm", u"")]
+        units = unitkeys.UnitKeySet(keys)
+        self.assertEquals(sorted(keys), list(units))
+        for unit in keys:
+            self.assertIn(unit, units)
+        self.assertNotIn((u"rpm", u"a"), units)
+        self.assertNotIn((u"rpm", u"abcd"), units)
+
+    def test_repack(self):
+        # An id that is not a UUID turns up after some that are
+        keys = self.units + [(u"rpm", u"legacy-id")]
+        units = unitkeys.UnitKeySet(keys)
+        self.assertEquals(sorted(keys), list(units))
+        self.assertEquals("raw", units._keys[0].codec)
+        self.assertIn((u"rpm", u"legacy-id"), units)
+
+    def test_equality(self):
+        units = unitkeys.UnitKeySet(self.units)
+        self.assertEquals(units, unitkeys.UnitKeySet(reversed(self.units)))
+        self.assertNotEquals(units, unitkeys.UnitKeySet(self.units[1:]))
+        self.assertNotEquals(units, unitkeys.UnitKeySet())
+        self.assertFalse(unitkeys.UnitKeySet())
+        # The same ids packed differently
+        mixed = unitkeys.UnitKeySet(self.units + [(u"rpm", u"x")])
+        packed = unitkeys.UnitKeySet(self.units)
+        self.assertNotEquals(mixed, packed)
+        self.assertEquals(
+            unitkeys.UnitKeySet(x for x in mixed if x.unit_id != u"x"),
+            packed)
+
+    def test_diff(self):
+        new = self.units[5:] + [(u"erratum", u"e1")]
+        old = self.units[:-5] + [(u"rpm", u"zzz")]
+        expected = list(diff.merge_diff(sorted(new), sorted(old)))
+        self.assertEquals(
+            expected, list(unitkeys.UnitKeySet(new).diff(
+                unitkeys.UnitKeySet(old))))
+        self.assertEquals(
+            expected, list(unitkeys.UnitKeySet(new).diff(sorted(old))))
+        self.assertEquals([], list(unitkeys.UnitKeySet(new).diff(
+            unitkeys.UnitKeySet(new))))
+
+    def test_diff_blocks(self):
+        # Changes on both sides of block boundaries, and long identical runs
+        ids = [u"%08x-0000-4000-8000-%012x" % (i, i) for i in range(1000)]
+        old = [(u"rpm", x) for i, x in enumerate(ids) if i % 97 and i != 64]
+        new = [(u"rpm", x) for i, x in enumerate(ids)
+               if i % 89 and i not in (127, 128, 999)]
+        self.assertEquals(
+            list(diff.merge_diff(new, old)),
+            list(unitkeys.UnitKeySet(new).diff(unitkeys.UnitKeySet(old))))
+
+    def test_combine(self):
+        rpms = unitkeys.UnitKeySet(x for x in self.units if x[0] == u"rpm")
+        srpms = unitkeys.UnitKeySet(x for x in self.units if x[0] != u"rpm")
+        units = unitkeys.UnitKeySet.combine([srpms, rpms])
+        self.assertEquals(unitkeys.UnitKeySet(self.units), units)
+        self.assertEquals(sorted(self.units), list(units))
+        self.assertRaises(ValueError, unitkeys.UnitKeySet.combine,
+                          [rpms, units])
+
+    def test_split_changes(self):
+        old = unitkeys.UnitKeySet(self.units[:30])
+        new = unitkeys.UnitKeySet(self.units[10:])
+        added, removed = unitkeys.split_changes(new.diff(old))
+        self.assertEquals(sorted(self.units[30:]), list(added))
+        self.assertEquals(sorted(self.units[:10]), list(removed))
@@ -0,0 +1,74 @@
+import importlib
+import unittest
+
+import mock
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+from ..distributors.test_distributor import BaseTest
+
+NOW = 1234567890.1234
+
+
+@unittest.skipIf(mongomock is None, "mongomock is not available")
+class TestMigration(BaseTest):
+    def setUp(self):
+        super(TestMigration, self).setUp()
+        self.Migration = importlib.import_module(
+            "pulp_snapshot.plugins.migrations.0001_snapshot_index")
+        db = mongomock.MongoClient().db
+        patch = mock.patch("pulp.server.db.connection.get_collection",
+                           side_effect=lambda name, create=False: db[name])
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.Module.index.get_collection.return_value = \
+            db.repo_snapshot_index
+        self.db = db
+
+    def test_migrate(self):
+        self.db.repos.insert_many([
+            dict(repo_id="repo-1",
+                 notes={'_repository_snapshot':
+                        "repo-1__20090213233130.1234Z"},
+                 content_unit_counts={'rpm': 7}),
+            dict(repo_id="repo-1__20090213233130.1234Z",
+                 notes={'_repository_snapshot': "repo-1__20090213233130.1234Z",
+                        '_repository_timestamp': NOW,
+                        '_repository_digest': '%040x' % 1,
+                        '_repository_unit_counts': {'rpm': 2, 'srpm': 1}}),
+            # A delta snapshot has no associations to count
+            dict(repo_id="repo-1__20090213233131.0000Z",
+                 notes={'_repository_snapshot': "repo-1__20090213233131.0000Z",
+                        '_repository_timestamp': NOW + 1,
+                        '_repository_base': "repo-1__20090213233130.1234Z",
+                        '_repository_unit_counts': {'rpm': 3, 'srpm': 1}},
+                 content_unit_counts={}),
+            # Not complete yet
+            dict(repo_id="repo-1__20090213233132.0000Z",
+                 notes={'_repository_snapshot': "repo-1__20090213233132.0000Z",
+                        '_repository_timestamp': NOW + 2,
+                        '_repository_snapshot_status': 'incomplete',
+                        '_repository_unit_counts': {'rpm': 3}}),
+            # Snapshots older than the timestamp and count notes
+            dict(repo_id="repo-1__20090212233130.0000Z",
+                 notes={'_repository_snapshot':
+                        "repo-1__20090212233130.0000Z"},
+                 content_unit_counts={'rpm': 1}),
+            dict(repo_id="repo-2", notes={}),
+        ])
+        self.Migration.migrate()
+
+        Index = self.Module.index
+        self.assertEquals(
+            [Index.SnapshotEntry("repo-1__20090212233130.0000Z",
+                                 1234481490.0, None, 1),
+             Index.SnapshotEntry("repo-1__20090213233130.1234Z",
+                                 NOW, '%040x' % 1, 3),
+             Index.SnapshotEntry("repo-1__20090213233131.0000Z",
+                                 NOW + 1, None, 4)],
+            Index.get_snapshots("repo-1"))
+        self.assertEquals([], Index.get_snapshots("repo-2"))
+        self.assertEquals(["repo-1"], [
+            x['_id'] for x in self.db.repo_snapshot_index.find()])
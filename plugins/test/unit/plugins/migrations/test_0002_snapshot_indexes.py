@@ -0,0 +1,46 @@
+import importlib
+import unittest
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+import mock
+
+
+@unittest.skipIf(mongomock is None, "mongomock is not available")
+class TestMigration(unittest.TestCase):
+    def setUp(self):
+        self.Migration = importlib.import_module(
+            "pulp_snapshot.plugins.migrations.0002_snapshot_indexes")
+        self.db = mongomock.MongoClient().db
+        patch = mock.patch("pulp.server.db.connection.get_collection",
+                           side_effect=lambda name, create=False:
+                           self.db[name])
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_migrate(self):
+        self.Migration.migrate()
+        # Running it again finds the indexes in place
+        self.Migration.migrate()
+        self.assertIn('snapshot_id_1_unit_type_id_1_unit_id_1',
+                      self.db.repo_snapshot_deltas.index_information())
+        self.assertIn('snapshots.snapshot_id_1',
+                      self.db.repo_snapshot_index.index_information())
+
+    def test_pulp_indexes(self):
+        # The indexes Pulp creates on its own collections
+        self.db.repo_content_units.create_index(
+            [('repo_id', 1), ('unit_id', 1), ('unit_type_id', 1)],
+            unique=True)
+        self.db.repo_groups.create_index([('repo_ids', 1)])
+        expected = dict(
+            (name, self.db[name].index_information())
+            for name in ('repo_content_units', 'repo_groups'))
+        self.Migration.migrate()
+        # Neither duplicated nor created again with other options
+        self.assertEquals(expected, dict(
+            (name, self.db[name].index_information())
+            for name in ('repo_content_units', 'repo_groups')))
@@ -104,6 +104,8 @@ Summary: Pulp Win plugins
 Group: Development/Languages
 Requires: python-%{name}-common = %{version}-%{release}
 Requires: pulp-server
+# monotonic clock for the publish phase timings
+Requires: python-monotonic
 # rpm-python needed for version comparison
 Requires: rpm-python
 